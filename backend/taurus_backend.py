@@ -7,6 +7,58 @@ import numpy as np
 
 FLOAT16 = 'float16'
 FLOAT32 = 'float32'
+FLOAT64 = 'float64'
+
+# 参数、激活值、im2col缓存和梯度统一使用的计算精度
+_FLOATX = FLOAT32
+
+# 只用于存储的精度，反向传播缓存的激活值和checkpoint按此精度保存，计算前转回floatx
+# None表示与计算精度相同，不做转换，例如set_storagex('float16')后才以半精度保存
+_STORAGEX = None
+
+
+def floatx():
+    return _FLOATX
+
+
+def set_floatx(dtype):
+    global _FLOATX
+
+    if dtype not in [FLOAT16, FLOAT32, FLOAT64]:
+        raise ValueError('不支持的精度：{}'.format(dtype))
+
+    _FLOATX = str(dtype)
+
+
+def storagex():
+    return _FLOATX if _STORAGEX is None else _STORAGEX
+
+
+def set_storagex(dtype):
+    """dtype为None时恢复为与计算精度相同"""
+    global _STORAGEX
+
+    if dtype is not None and dtype not in [FLOAT16, FLOAT32, FLOAT64]:
+        raise ValueError('不支持的精度：{}'.format(dtype))
+
+    _STORAGEX = None if dtype is None else str(dtype)
+
+
+def cast_to_floatx(x):
+    """转换为计算精度，已经是floatx时不拷贝"""
+    return np.asarray(x, dtype=_FLOATX)
+
+
+def to_storage(x):
+    """浮点数组转换为存储精度，其他类型原样返回，没有单独设置存储精度时不拷贝"""
+    if _STORAGEX is not None and isinstance(x, np.ndarray) and x.dtype.kind == 'f' and x.dtype != _STORAGEX:
+        return x.astype(_STORAGEX)
+    return x
+
+
+def from_storage(x):
+    """存储精度转回计算精度"""
+    return cast_to_floatx(x)
 
 
 def constant(value, dtype=None, shape=None, name=None):
@@ -7,12 +7,48 @@ import tensorflow as tf
 
 FLOAT16 = tf.float16
 FLOAT32 = tf.float32
+FLOAT64 = tf.float64
+
+_FLOATX = FLOAT32
+
+# None表示与计算精度相同
+_STORAGEX = None
+
+
+def floatx():
+    return _FLOATX
+
+
+def set_floatx(dtype):
+    global _FLOATX
+    _FLOATX = tf.as_dtype(dtype)
+
+
+def storagex():
+    return _FLOATX if _STORAGEX is None else _STORAGEX
+
+
+def set_storagex(dtype):
+    global _STORAGEX
+    _STORAGEX = None if dtype is None else tf.as_dtype(dtype)
+
+
+def cast_to_floatx(x):
+    return tf.cast(x, _FLOATX)
+
+
+def to_storage(x):
+    return tf.cast(x, storagex())
+
+
+def from_storage(x):
+    return tf.cast(x, _FLOATX)
 
 
 # 常量定义
 def constant(value, dtype=None, shape=None, name=None):
 
     if dtype is None:
-        dtype = FLOAT32
+        dtype = _FLOATX
 
     return tf.constant(value, dtype=dtype, shape=shape, name=name)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import sys
+sys.path.append('..')
+import argparse
+import time
+
+import numpy as np
+from taurus.operations.common import im2col, im2col_strided, col2im, col2im_strided
+from taurus.operations.convolution import Conv2D, DepthwiseConv2D, SeparableConv2D
+from taurus.operations import Relu, MaxPooling2D, FusedConv2D
+from taurus.models.cnn import NewCNN
+from taurus.core.autotune import Autotuner
+
+
+# (N, C, H, W, 卷积核, 步幅, 填充)
+IM2COL_CASES = [
+    ('lenet_conv1', (100, 1, 32, 32), 5, 1, 0),
+    ('lenet_conv2', (100, 6, 14, 14), 5, 1, 0),
+    ('lenet_pool1', (100, 6, 28, 28), 2, 2, 0),
+    ('conv3x3_64', (32, 64, 56, 56), 3, 1, 1),
+    ('conv5x5_32', (32, 32, 64, 64), 5, 1, 2),
+]
+
+
+def timeit(fn, *args, repeat=5):
+    """取多次运行的最小耗时"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        time1 = time.time()
+        result = fn(*args)
+        best = min(best, time.time() - time1)
+    return best, result
+
+
+def bench_im2col(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}{:>12}{:>12}'.format('case', 'im2col', 'strided', 'speedup', 'nhwc', 'virtual'))
+
+    for name, shape, k, stride, pad in IM2COL_CASES:
+
+        # 模拟卷积层中NHWC转置得到的非连续输入
+        nhwc = np.random.randn(shape[0], shape[2], shape[3], shape[1])
+        x = nhwc.transpose(0, 3, 1, 2)
+
+        t1, col1 = timeit(im2col, x, k, k, stride, pad, repeat=repeat)
+        t2, col2 = timeit(im2col_strided, x, k, k, stride, pad, repeat=repeat)
+
+        # 直接读取NHWC，填充缓存也是NHWC
+        padded = np.empty((shape[0], shape[2] + 2 * pad, shape[3] + 2 * pad, shape[1]))
+        t3, col3 = timeit(lambda: im2col_strided(nhwc, k, k, stride, pad, padded=padded, layout='NHWC'), repeat=repeat)
+
+        # 虚拟填充，不拷贝填充后的输入
+        t4, col4 = timeit(lambda: im2col_strided(nhwc, k, k, stride, pad, layout='NHWC'), repeat=repeat)
+
+        assert np.allclose(col1, col2) and np.allclose(col1, col3) and np.allclose(col1, col4), name
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x{:>11.4f}s{:>11.4f}s'.format(name, t1, t2, t1 / t2, t3, t4))
+
+
+def bench_col2im(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}'.format('case', 'col2im', 'strided', 'speedup'))
+
+    for name, shape, k, stride, pad in IM2COL_CASES:
+
+        N, C, H, W = shape
+        out_h = (H + 2 * pad - k) // stride + 1
+        out_w = (W + 2 * pad - k) // stride + 1
+        col = np.random.randn(N * out_h * out_w, C * k * k)
+        buffer = np.empty((N, H, W, C))
+
+        t1, img1 = timeit(col2im, col, shape, k, k, stride, pad, repeat=repeat)
+        t2, img2 = timeit(col2im_strided, col, shape, k, k, stride, pad, buffer, repeat=repeat)
+
+        assert np.allclose(img1, img2), name
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x'.format(name, t1, t2, t1 / t2))
+
+
+def bench_conv_cal_prime(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}'.format('case', 'loop', 'backprop', 'speedup'))
+
+    # 卷积层梯度：逐样本循环参考实现 vs GEMM
+    for name, shape, filters in [('lenet_conv1', (100, 32, 32, 1), 6), ('lenet_conv2', (100, 14, 14, 6), 16)]:
+
+        conv = Conv2D(filters=filters, kernel_size=5)
+        x = np.random.randn(*shape)
+        delta = np.random.randn(*conv(x).shape)
+        conv.backprop(delta)
+
+        def gemm():
+            # 梯度在backprop的GEMM中算出
+            conv.backprop(delta)
+            return conv.cal_prime()
+
+        t1, (w1, b1) = timeit(conv._cal_prime_backup, repeat=repeat)
+        t2, (w2, b2) = timeit(gemm, repeat=repeat)
+
+        # 计算精度为float32，按相对误差比较
+        assert np.allclose(w1.sum(axis=0), w2, rtol=1e-4, atol=1e-2) and np.allclose(b1.sum(axis=0), b2, rtol=1e-4, atol=1e-2), name
+
+        w3, b3 = conv.cal_prime(per_sample=True)
+        assert np.allclose(w1, w3, rtol=1e-4, atol=1e-3) and np.allclose(b1, b3, rtol=1e-4, atol=1e-3), name
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x'.format(name, t1, t2, t1 / t2))
+
+
+def bench_winograd(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}{:>12}'.format('case', 'im2col', 'winograd', 'speedup', 'max error'))
+
+    # 一次前向加一次反向传播，与im2col的结果比较精度
+    for name, shape, filters, k, pad in [('lenet_conv1', (100, 32, 32, 1), 6, 5, 0), ('lenet_conv2', (100, 14, 14, 6), 16, 5, 0),
+                                         ('conv3x3_32', (32, 32, 32, 32), 32, 3, 1), ('conv3x3_64', (16, 56, 56, 64), 64, 3, 1)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+
+        im2col_conv = Conv2D(filters=filters, kernel_size=k, pad=pad, algorithm='im2col')
+        winograd_conv = Conv2D(filters=filters, kernel_size=k, pad=pad, algorithm='winograd')
+        out = im2col_conv(x)
+        winograd_conv(x)
+        winograd_conv.weights[...] = im2col_conv.weights
+        winograd_conv.biases[...] = im2col_conv.biases
+
+        delta = np.random.randn(*out.shape).astype(np.float32)
+
+        def step(conv):
+            def run():
+                out = conv(x).copy()
+                return out, conv.backprop(delta).copy(), conv.dW.copy()
+            return run
+
+        t1, results1 = timeit(step(im2col_conv), repeat=repeat)
+        t2, results2 = timeit(step(winograd_conv), repeat=repeat)
+
+        # 相对误差，输出、输入梯度、卷积核梯度中最大的一个，F(2x2,5x5)的插值点有±2，float32下误差大一些
+        error = max(np.abs(r1 - r2).max() / np.abs(r1).max() for r1, r2 in zip(results1, results2))
+        assert error < 1e-3, name
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x{:>12.2e}'.format(name, t1, t2, t1 / t2, error))
+
+
+def bench_fft(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}{:>12}{:>8}'.format('case', 'im2col', 'fft', 'speedup', 'max error', 'auto'))
+
+    # 一次前向加一次反向传播，与im2col的结果比较精度，auto一列是Conv2D自动选择的算法
+    for name, shape, filters, k, stride, pad in [('lenet_conv1', (100, 32, 32, 1), 6, 5, 1, 0), ('lenet_conv2', (100, 14, 14, 6), 16, 5, 1, 0),
+                                                 ('conv5x5_32', (32, 64, 64, 32), 32, 5, 1, 2), ('conv7x7_s2', (8, 128, 128, 16), 16, 7, 2, 3),
+                                                 ('conv11x11_8', (8, 128, 128, 8), 8, 11, 1, 5)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+
+        im2col_conv = Conv2D(filters=filters, kernel_size=k, stride=stride, pad=pad, algorithm='im2col')
+        fft_conv = Conv2D(filters=filters, kernel_size=k, stride=stride, pad=pad, algorithm='fft')
+        out = im2col_conv(x)
+        fft_conv(x)
+        fft_conv.weights[...] = im2col_conv.weights
+        fft_conv.biases[...] = im2col_conv.biases
+
+        delta = np.random.randn(*out.shape).astype(np.float32)
+
+        def step(conv):
+            def run():
+                out = conv(x).copy()
+                return out, conv.backprop(delta).copy(), conv.dW.copy()
+            return run
+
+        t1, results1 = timeit(step(im2col_conv), repeat=repeat)
+        t2, results2 = timeit(step(fft_conv), repeat=repeat)
+
+        error = max(np.abs(r1 - r2).max() / np.abs(r1).max() for r1, r2 in zip(results1, results2))
+        assert error < 1e-4, name
+
+        auto = Conv2D(filters=filters, kernel_size=k, stride=stride, pad=pad).select_algorithm(shape)
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x{:>12.2e}{:>8}'.format(name, t1, t2, t1 / t2, error, auto))
+
+
+def bench_autotune(repeat=5):
+
+    algorithms = ['im2col', 'winograd', 'fft', 'direct']
+    print(('{:<14}' + '{:>12}' * len(algorithms) + '{:>10}').format('case', *(algorithms + ['tuned'])))
+
+    # 一次前向加一次反向传播，各算法的耗时和调优选出的算法，winograd不适用时为空
+    tuner = Autotuner(repeat=repeat)
+
+    for name, shape, filters, k, stride, pad in [('lenet_conv1', (100, 32, 32, 1), 6, 5, 1, 0), ('lenet_conv2', (100, 14, 14, 6), 16, 5, 1, 0),
+                                                 ('conv3x3_64', (16, 56, 56, 64), 64, 3, 1, 1), ('conv5x5_32', (16, 64, 64, 32), 32, 5, 1, 2),
+                                                 ('conv7x7_s2', (8, 128, 128, 16), 16, 7, 2, 3)]:
+
+        conv = Conv2D(filters=filters, kernel_size=k, stride=stride, pad=pad, algorithm='tune')
+        timings = tuner.tune(conv, shape)
+
+        cells = ['{:>11.4f}s'.format(timings[a]) if a in timings else '{:>12}'.format('-') for a in algorithms]
+        print('{:<14}'.format(name) + ''.join(cells) + '{:>10}'.format(min(timings, key=timings.get)))
+
+
+def bench_padding(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}{:>12}'.format('case', 'padded', 'virtual', 'speedup', 'max error'))
+
+    # padding='same'、上下左右不同的填充和膨胀卷积，一次前向加一次反向传播，
+    # 与np.pad填充后padding='valid'、卷积核插0的普通卷积比较输出、输入梯度和卷积核梯度
+    for name, shape, filters, k, stride, padding, dilation in [('same_odd', (8, 29, 27, 8), 8, 3, 1, 'same', 1),
+                                                               ('same_even_s2', (8, 28, 30, 8), 8, 3, 2, 'same', 1),
+                                                               ('same_k4_s2', (8, 27, 27, 8), 8, 4, 2, 'same', 1),
+                                                               ('dilated2', (8, 28, 28, 8), 8, 3, 1, 'valid', 2),
+                                                               ('dilated2_s2', (8, 29, 29, 8), 8, 3, 2, 'valid', 2),
+                                                               ('same_dil2_s2', (8, 30, 31, 8), 8, 3, 2, 'same', 2),
+                                                               ('conv3x3_64', (16, 56, 56, 64), 64, 3, 1, 'same', 1)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+        N, H, W, C = shape
+        span = dilation * (k - 1) + 1
+
+        def pads(size):
+            # TensorFlow的'same'：输出为 ceil(size / stride)，多出的一行、一列填充在下方和右方
+            if padding == 'valid':
+                return 0, 0
+            total = max((-(-size // stride) - 1) * stride + span - size, 0)
+            return total // 2, total - total // 2
+
+        (top, bottom), (left, right) = pads(H), pads(W)
+
+        conv = Conv2D(filters=filters, kernel_size=k, stride=stride, padding=padding, dilation=dilation, algorithm='im2col')
+        reference = Conv2D(filters=filters, kernel_size=span, stride=stride, algorithm='im2col')
+
+        out = conv(x)
+        reference(np.pad(x, ((0, 0), (top, bottom), (left, right), (0, 0))))
+        reference.weights[...] = 0
+        reference.weights[:, :, ::dilation, ::dilation] = conv.weights
+        reference.biases[...] = conv.biases
+
+        delta = np.random.randn(*out.shape).astype(np.float32)
+
+        def run_reference():
+            out = reference(np.pad(x, ((0, 0), (top, bottom), (left, right), (0, 0)))).copy()
+            dx = reference.backprop(delta)[:, top:top + H, left:left + W, :].copy()
+            return out, dx, reference.dW[:, :, ::dilation, ::dilation].copy()
+
+        def run():
+            out = conv(x).copy()
+            return out, conv.backprop(delta).copy(), conv.dW.copy()
+
+        t1, results1 = timeit(run_reference, repeat=repeat)
+        t2, results2 = timeit(run, repeat=repeat)
+
+        assert all(r1.shape == r2.shape for r1, r2 in zip(results1, results2)), name
+        error = max(np.abs(r1 - r2).max() / np.abs(r1).max() for r1, r2 in zip(results1, results2))
+        assert error < 1e-4, name
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x{:>12.2e}'.format(name, t1, t2, t1 / t2, error))
+
+
+def bench_grouped(repeat=5):
+
+    print('{:<18}{:>12}'.format('case', 'max error'))
+
+    def check(name, results1, results2):
+        # 输出、输入梯度、卷积核梯度中最大的相对误差
+        assert all(r1.shape == r2.shape for r1, r2 in zip(results1, results2)), name
+        error = max(np.abs(r1 - r2).max() / np.abs(r1).max() for r1, r2 in zip(results1, results2))
+        assert error < 1e-4, name
+        print('{:<18}{:>12.2e}'.format(name, error))
+
+    # 分组卷积 vs 每组输入通道上各一个普通卷积
+    for shape, filters, k, stride, groups in [((4, 15, 14, 8), 12, 3, 1, 2), ((4, 16, 17, 8), 8, 3, 2, 4)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+        conv = Conv2D(filters, k, stride, padding='same', groups=groups)
+        delta = np.random.randn(*conv(x).shape).astype(np.float32)
+        results1 = conv(x).copy(), conv.backprop(delta).copy(), conv.dW.copy()
+
+        C, F = shape[-1] // groups, filters // groups
+        outs, dxs, dWs = [], [], []
+        for g in range(groups):
+            dense = Conv2D(F, k, stride, padding='same', algorithm='im2col')
+            xg = x[..., g * C:(g + 1) * C]
+            dense(xg)
+            dense.weights[...] = conv.weights[g * F:(g + 1) * F]
+            dense.biases[...] = conv.biases[:, g * F:(g + 1) * F]
+
+            outs.append(dense(xg).copy())
+            dxs.append(dense.backprop(delta[..., g * F:(g + 1) * F]).copy())
+            dWs.append(dense.dW.copy())
+
+        check('groups={}_s{}'.format(groups, stride), results1, (np.concatenate(outs, -1), np.concatenate(dxs, -1), np.concatenate(dWs, 0)))
+
+    # depthwise算法 vs groups=C的im2col分组GEMM
+    for shape, k, stride, padding, multiplier, dilation in [((4, 15, 14, 8), 3, 1, 'same', 1, 1), ((4, 16, 17, 8), 5, 2, 'valid', 2, 1),
+                                                            ((4, 16, 17, 8), 3, 2, 'same', 3, 2)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+        C = shape[-1]
+
+        convs = [Conv2D(C * multiplier, k, stride, padding=padding, dilation=dilation, groups=C, algorithm=a) for a in ['depthwise', 'im2col']]
+        delta = np.random.randn(*convs[1](x).shape).astype(np.float32)
+        convs[0](x)
+        convs[0].weights[...] = convs[1].weights
+        convs[0].biases[...] = convs[1].biases
+
+        results = [(conv(x).copy(), conv.backprop(delta).copy(), conv.dW.copy()) for conv in convs]
+        check('depthwise_m{}_s{}_d{}'.format(multiplier, stride, dilation), *results)
+
+    # 深度可分离卷积 vs DepthwiseConv2D后接1x1的Conv2D
+    for shape, filters, k, stride, multiplier in [((4, 15, 14, 8), 12, 3, 1, 1), ((4, 16, 17, 8), 16, 3, 2, 2)]:
+
+        x = np.random.randn(*shape).astype(np.float32)
+        separable = SeparableConv2D(filters, k, stride, padding='same', depth_multiplier=multiplier)
+        depthwise = DepthwiseConv2D(k, stride, padding='same', depth_multiplier=multiplier)
+        pointwise = Conv2D(filters, 1, algorithm='im2col')
+
+        delta = np.random.randn(*separable(x).shape).astype(np.float32)
+        pointwise(depthwise(x))
+
+        # 深度可分离卷积只在逐点卷积后加偏置
+        depthwise.weights[...] = separable.depthwise.weights
+        depthwise.biases[...] = 0
+        pointwise.weights[...] = separable.weights
+        pointwise.biases[...] = separable.biases
+
+        results1 = separable(x).copy(), separable.backprop(delta).copy(), separable.depthwise.dW.copy(), separable.dW.copy()
+        out = pointwise(depthwise(x)).copy()
+        dx = depthwise.backprop(pointwise.backprop(delta)).copy()
+
+        check('separable_m{}_s{}'.format(multiplier, stride), results1, (out, dx, depthwise.dW.copy(), pointwise.dW.copy()))
+
+    print('{:<14}{:>12}{:>10}{:>12}{:>10}'.format('case', 'time', 'speedup', 'GFLOPs', 'reduction'))
+
+    # 同样感受野下普通卷积、分组卷积、逐通道卷积、深度可分离卷积，一次前向加一次反向传播
+    shape, filters = (16, 56, 56, 64), 64
+    x = np.random.randn(*shape).astype(np.float32)
+
+    layers = [('dense', Conv2D(filters, 3, padding='same', algorithm='im2col')),
+              ('groups=4', Conv2D(filters, 3, padding='same', groups=4)),
+              ('depthwise', DepthwiseConv2D(3, padding='same')),
+              ('separable', SeparableConv2D(filters, 3, padding='same'))]
+
+    base_time = base_flops = None
+
+    for name, conv in layers:
+
+        delta = np.random.randn(*conv(x).shape).astype(np.float32)
+
+        def step():
+            conv(x)
+            return conv.backprop(delta)
+
+        t, _ = timeit(step, repeat=repeat)
+        flops = conv.flops(shape)
+
+        if base_time is None:
+            base_time, base_flops = t, flops
+
+        print('{:<14}{:>11.4f}s{:>9.2f}x{:>12.3f}{:>9.2f}x'.format(name, t, base_time / t, flops / 1e9, base_flops / flops))
+
+
+def bench_memory_plan(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}'.format('case', 'no plan', 'planned', 'speedup'))
+
+    # LeNet一个训练步：每次新分配 vs 内存规划后复用
+    for batch_size in [32, 100]:
+
+        model = NewCNN()
+        x = np.random.randn(batch_size, 28, 28, 1).astype(np.float32)
+        y = np.eye(10, dtype=np.float32)[np.random.randint(0, 10, batch_size)].reshape(batch_size, 10, 1)
+
+        model.release()
+        t1, _ = timeit(model._backprop, x, y, repeat=repeat)
+        grad1 = model.arena.grad.copy()
+
+        model.plan_memory(batch_size)
+        t2, _ = timeit(model._backprop, x, y, repeat=repeat)
+
+        assert np.allclose(grad1, model.arena.grad, rtol=1e-4, atol=1e-4), batch_size
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x'.format('lenet_b{}'.format(batch_size), t1, t2, t1 / t2))
+
+
+def bench_fusion(repeat=5):
+
+    print('{:<14}{:>12}{:>12}{:>10}{:>12}{:>12}'.format('case', 'unfused', 'fused', 'speedup', 'unfused MB', 'fused MB'))
+
+    # LeNet的conv + relu + pool块，一次前向加一次反向传播
+    for name, shape, filters in [('lenet_block1', (100, 32, 32, 1), 6), ('lenet_block2', (100, 14, 14, 6), 16)]:
+
+        conv, relu, pool = Conv2D(filters=filters, kernel_size=5), Relu(), MaxPooling2D()
+        x = np.random.randn(*shape).astype(np.float32)
+        out = pool(relu(conv(x)))
+        delta = np.random.randn(*out.shape).astype(np.float32)
+
+        def unfused():
+            out = pool(relu(conv(x)))
+            return out.copy(), conv.backprop(relu.backward(pool.backprop(delta))).copy()
+
+        fused_layer = FusedConv2D(conv, relu, pool)
+
+        def fused():
+            out = fused_layer(x)
+            return out.copy(), fused_layer.backward(delta).copy()
+
+        t1, (out1, dx1) = timeit(unfused, repeat=repeat)
+        t2, (out2, dx2) = timeit(fused, repeat=repeat)
+
+        assert np.allclose(out1, out2, atol=1e-5) and np.allclose(dx1, dx2, atol=1e-4), name
+
+        # GEMM之后（偏置、激活、池化）的缓存大小，im2col和GEMM两边相同，不计入
+        conv_shape = (shape[0], conv._out_size(shape[1]), conv._out_size(shape[2]), filters)
+        conv_mb = memory_mb(conv.memory(shape, conv_shape))
+        mb1 = memory_mb(relu.memory(conv_shape, conv_shape) + pool.memory(conv_shape, out.shape))
+        mb2 = memory_mb(fused_layer.memory(shape, out.shape)) - conv_mb
+
+        print('{:<14}{:>11.4f}s{:>11.4f}s{:>9.2f}x{:>12.2f}{:>12.2f}'.format(name, t1, t2, t1 / t2, mb1, mb2))
+
+
+def memory_mb(buffers):
+    return sum(int(np.prod(buffer[1])) * np.dtype(buffer[2]).itemsize for buffer in buffers) / 1024 ** 2
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', '-r', default=5, type=int, help='repeat')
+    args = parser.parse_args(sys.argv[1:])
+
+    bench_im2col(args.repeat)
+    bench_col2im(args.repeat)
+    bench_conv_cal_prime(args.repeat)
+    bench_winograd(args.repeat)
+    bench_fft(args.repeat)
+    bench_autotune(args.repeat)
+    bench_padding(args.repeat)
+    bench_grouped(args.repeat)
+    bench_memory_plan(args.repeat)
+    bench_fusion(args.repeat)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from taurus import backend
+
+
+class ParameterArena(object):
+    """参数内存池
+
+    整个模型的参数放在一块连续的一维内存data中，梯度放在同样大小的grad中，
+    每个权重和偏置都是其中的视图。优化器可以对data和grad做一次整体的向量化更新，
+    保存时也只需要写一块连续数据。
+    """
+
+    def __init__(self, arrays, dtype=None):
+
+        if dtype is None:
+            dtype = backend.floatx()
+
+        self.shapes = [np.shape(a) for a in arrays]
+        self.offsets = []
+        self.size = 0
+
+        for shape in self.shapes:
+            self.offsets.append(self.size)
+            self.size += int(np.prod(shape))
+
+        self.data = np.empty(self.size, dtype=dtype)
+        self.grad = np.zeros(self.size, dtype=dtype)
+
+        # 参数和梯度的视图，与arrays一一对应
+        self.params = [self._view(self.data, i) for i in range(len(self.shapes))]
+        self.grads = [self._view(self.grad, i) for i in range(len(self.shapes))]
+
+        for param, a in zip(self.params, arrays):
+            param[...] = a
+
+    def _view(self, buffer, index):
+        offset = self.offsets[index]
+        shape = self.shapes[index]
+        return buffer[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def zero_grad(self):
+        self.grad.fill(0)
+
+    def load(self, data):
+        """从一整块数据恢复所有参数"""
+
+        data = np.asarray(data).reshape(-1)
+        if data.size != self.size:
+            raise ValueError('参数数量不一致，模型为{}，数据为{}'.format(self.size, data.size))
+
+        self.data[...] = data
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import json
+import os
+import time
+
+import numpy as np
+from taurus import backend
+
+
+class Autotuner(object):
+    """卷积算法的自动调优
+
+    第一次遇到一个 (N, H, W, C, F, k, stride, pad) 时，用随机数据对每种可用的算法
+    计时（推理时只计前向传播，训练时计前向加反向传播），选用最快的一个。
+    结果记在内存中的表里，可以保存为JSON，和模型权重放在一起，下次加载后直接使用。
+
+    Conv2D(algorithm='tune')时使用，algorithm='auto'时表中有结果就使用表中的结果
+    """
+
+    def __init__(self, repeat=3, verbose=False):
+
+        self.repeat = repeat
+
+        # 为True时打印每个新签名调优选出的算法
+        self.verbose = verbose
+
+        # 签名 -> 算法
+        self.table = {}
+
+        # 签名 -> {算法: 耗时}，只记录本次运行中实际计时的
+        self.timings = {}
+
+    @staticmethod
+    def signature(layer, input_shape):
+
+        N, H, W, C = input_shape
+        return (int(N), int(H), int(W), int(C), layer.filters, layer.kernel_size, layer.stride, layer._uniform_pad(input_shape))
+
+    def lookup(self, layer, input_shape):
+        return self.table.get(self.signature(layer, input_shape))
+
+    def select(self, layer, input_shape):
+        """表中没有时先调优"""
+
+        key = self.signature(layer, input_shape)
+
+        if key not in self.table:
+            self.timings[key] = self.tune(layer, input_shape)
+            self.table[key] = min(self.timings[key], key=self.timings[key].get)
+            if self.verbose:
+                print('autotune {} -> {}'.format(key, self.table[key]))
+
+        return self.table[key]
+
+    def tune(self, layer, input_shape):
+        """对layer的每种可用算法计时，返回 {算法: 耗时}，按layer.config()新建同样配置的层计时，不影响layer的参数和缓存"""
+
+        x = np.random.randn(*input_shape).astype(backend.floatx())
+        timings = {}
+
+        for algorithm in layer.candidates(input_shape):
+
+            conv = layer.__class__(**dict(layer.config(), algorithm=algorithm))
+            conv.training = layer.training
+
+            delta = np.random.randn(*conv(x).shape).astype(backend.floatx())
+
+            def run():
+                conv(x)
+                if conv.caching:
+                    conv.backprop(delta)
+
+            best = float('inf')
+            for _ in range(self.repeat):
+                time1 = time.time()
+                run()
+                best = min(best, time.time() - time1)
+
+            timings[algorithm] = best
+
+        return timings
+
+    def save(self, filepath):
+
+        entries = [{'signature': list(key), 'algorithm': algorithm} for key, algorithm in sorted(self.table.items())]
+
+        with open(filepath, 'w') as f:
+            json.dump(entries, f, indent=2)
+
+    def load(self, filepath):
+        """合并到当前的表中"""
+
+        with open(filepath, 'r') as f:
+            entries = json.load(f)
+
+        for entry in entries:
+            self.table[tuple(entry['signature'])] = entry['algorithm']
+
+    def clear(self):
+
+        self.table.clear()
+        self.timings.clear()
+
+
+def autotune_path(filepath):
+    """模型权重文件对应的调优结果文件，model.h5 -> model.autotune.json"""
+    return os.path.splitext(filepath)[0] + '.autotune.json'
+
+
+# 全局的调优表，所有Conv2D共用
+autotuner = Autotuner()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+from taurus.core.static_graph import ExecutionPlan
+from taurus.operations import Conv2D, FC, Relu, MaxPooling2D
+from taurus.operations.fused import FusedConv2D, FusedFC
+
+
+def fuse(plan):
+    """算子融合，返回新的静态执行计划
+
+    按顺序匹配 Conv2D -> [Relu] -> [MaxPooling2D] 和 FC -> [Relu]，
+    中间结果只被链上的下一层使用时，整条链替换为一个融合算子，一次前向、一次反向传播。
+    融合算子不计算层自带的激活，Conv2D、FC设置了activation时不融合。
+    被融合的层保留在模型中，参数、梯度和保存、加载都不受影响
+    """
+
+    steps = plan.steps
+    L = len(steps)
+
+    # 每个槽位被多少层使用
+    consumers = [0] * (L + 1)
+    for layer, src in steps:
+        consumers[src] += 1
+
+    def follows(i, cls):
+        """第i层存在、类型为cls，且只使用第i-1层的输出，第i-1层的输出不再被其他层使用"""
+        return i < L and isinstance(steps[i][0], cls) and steps[i][1] == i and consumers[i] == 1
+
+    layers, sources, shapes = [], [], []
+    layouts = [plan.layouts[0]]
+
+    # 旧槽位 -> 新槽位
+    slots = {0: 0}
+
+    i = 0
+    while i < L:
+
+        layer, src = steps[i]
+        end = i
+
+        if isinstance(layer, Conv2D) and layer.activation is None:
+
+            activation = pool = None
+
+            if follows(end + 1, Relu):
+                end += 1
+                activation = steps[end][0]
+
+            if follows(end + 1, MaxPooling2D) and _poolable(steps[end + 1][0]):
+                end += 1
+                pool = steps[end][0]
+
+            if end > i:
+                layer = FusedConv2D(layer, activation, pool)
+
+        elif isinstance(layer, FC) and layer.activation is None:
+
+            if follows(end + 1, Relu):
+                end += 1
+                layer = FusedFC(layer, steps[end][0])
+
+        layers.append(layer)
+        sources.append(slots[src])
+        shapes.append(plan.shapes[end])
+        layouts.append(plan.layouts[end + 1])
+        slots[end + 1] = len(layers)
+
+        i = end + 1
+
+    return ExecutionPlan(layers, sources, shapes, plan.input_shape, layouts)
+
+
+def _poolable(pool):
+    """融合只支持方形、无填充的池化窗口，窗口内序号用uint8保存"""
+    return pool.pad == 0 and pool.pool_h == pool.pool_w and pool.pool_h * pool.pool_w <= 256
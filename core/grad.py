@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+from contextlib import contextmanager
+
+
+class _GradMode(object):
+    enabled = True
+
+
+def is_grad_enabled():
+    return _GradMode.enabled
+
+
+@contextmanager
+def no_grad():
+    """不需要反向传播的前向计算，例如推理和评估
+
+    with no_grad():
+        y = model.inference(x)
+
+    在其中各层只计算输出，不保存反向传播需要的中间数据，也可以作为装饰器使用
+    """
+
+    previous = _GradMode.enabled
+    _GradMode.enabled = False
+
+    try:
+        yield
+    finally:
+        _GradMode.enabled = previous
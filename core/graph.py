@@ -9,12 +9,45 @@ from taurus.core.variable import VariableNode
 class ComputationalGraph(object):
 
     def __init__(self, nodes, edges):
+        """nodes 节点列表，每个节点有唯一的id
+        edges (输入节点id, 输出节点id) 列表"""
 
         self.nodes = nodes
         self.edges = edges
 
+        self.order = []
+
     def build(self):
-        pass
+        """拓扑排序，返回按执行顺序排列的节点，同一层级按id排序保证结果稳定"""
+
+        nodes = {node.id: node for node in self.nodes}
+        in_degree = {node_id: 0 for node_id in nodes}
+        outs = {node_id: [] for node_id in nodes}
+
+        for src, dst in self.edges:
+            outs[src].append(dst)
+            in_degree[dst] += 1
+
+        ready = sorted(node_id for node_id, degree in in_degree.items() if degree == 0)
+        order = []
+
+        while len(ready) > 0:
+
+            node_id = ready.pop(0)
+            order.append(nodes[node_id])
+
+            for dst in outs[node_id]:
+                in_degree[dst] -= 1
+                if in_degree[dst] == 0:
+                    ready.append(dst)
+            ready.sort()
+
+        if len(order) != len(nodes):
+            raise ValueError('计算图中存在环')
+
+        self.order = order
+
+        return order
 
 
 class Node(object):
@@ -33,3 +66,66 @@ class Edge():
 
     def __init__(self):
         pass
+
+
+class Tracer(object):
+    """静态图追踪
+
+    追踪期间每一层前向传播时调用Layer._trace，根据输入数组找到产生它的层，
+    记录到in_bounding_nodes、out_bounding_nodes中，同时记录各层的输出形状。
+    输入数组只能是模型的输入inputs或者某一层的输出，中间经过了层以外的运算（例如x + 0、x.reshape）时报错
+    """
+
+    current = None
+
+    def __init__(self, input_node=None, inputs=None):
+
+        self.input_node = input_node
+
+        self.nodes = []
+        self.edges = []
+        self.shapes = {}
+
+        # id(输出数组) -> 产生它的节点，同时持有数组，避免追踪期间id被复用
+        self.producers = {}
+        self.values = []
+
+        # 模型的输入来自输入节点
+        if inputs is not None:
+            self.producers[id(inputs)] = input_node
+            self.values.append(inputs)
+
+    def __enter__(self):
+        self.previous = Tracer.current
+        Tracer.current = self
+        return self
+
+    def __exit__(self, *args):
+        Tracer.current = self.previous
+
+    def record(self, node, inputs, outputs):
+
+        if isinstance(inputs, Node):
+            src = inputs
+        elif id(inputs) in self.producers:
+            src = self.producers[id(inputs)]
+        else:
+            raise ValueError('{}的输入不是模型的输入或其他层的输出，静态图只能追踪层的调用'.format(node.name))
+
+        if src is not None:
+
+            if node.id not in src.out_bounding_nodes:
+                src.out_bounding_nodes.append(node.id)
+            if src.id not in node.in_bounding_nodes:
+                node.in_bounding_nodes.append(src.id)
+
+            if src not in self.nodes:
+                self.nodes.append(src)
+            self.edges.append((src.id, node.id))
+
+        if node not in self.nodes:
+            self.nodes.append(node)
+
+        self.shapes[node.id] = outputs.shape
+        self.producers[id(outputs)] = node
+        self.values.append(outputs)
@@ -4,7 +4,8 @@
 
 import numpy as np
 from taurus.core.operation import OperationNode
-from taurus.core.graph import Node
+from taurus.core.graph import Node, Tracer
+from taurus.core.grad import is_grad_enabled
 
 
 class Layer(Node):
@@ -35,6 +36,25 @@ class Layer(Node):
         self.weights = np.array([])
         self.biases = np.array([])
 
+        # 训练模式下前向传播会保存反向传播需要的中间数据，推理模式下不保存
+        self.training = True
+
+        # 内存规划，名称 -> 内存池中分配给这一层的一段内存，见core/memory.py
+        self.regions = {}
+
+        # 输出是输入的视图（例如Flatten），内存规划时与输入共用同一块内存
+        self.output_alias = False
+
+        # 反向传播的输出是输入delta误差本身或其视图
+        self.grad_alias = False
+
+        # 前向传播保存输入供反向传播使用（例如FC），输入要一直保留到这一层反向传播
+        self.saves_input = False
+
+        # 要求输入的内存布局，例如'NHWC'，None表示与布局无关（例如逐元素的激活层）
+        # 编译静态图时在布局不一致的地方插入转置，见core/static_graph.py
+        self.layout = None
+
     def __call__(self, inputs, *args, **kwargs):
         """处理layer的节点信息"""
 
@@ -48,3 +68,52 @@ class Layer(Node):
 
         return layer.outputs
 
+    @property
+    def caching(self):
+        """训练模式且不在no_grad中时，前向传播保存反向传播需要的中间数据"""
+        return self.training and is_grad_enabled()
+
+    def parameters(self):
+        """放入模型参数内存池的参数，(所属的层, 参数属性名, 梯度属性名)，见BaseModel._build_arena"""
+        return [(self, 'weights', 'dW'), (self, 'biases', 'db')]
+
+    def release(self):
+        """释放保存的中间数据和工作区，子类按需实现"""
+        pass
+
+    def backward(self, delta):
+        """统一的反向传播接口，输入输出都是delta误差"""
+        return self.backprop(delta)
+
+    def memory(self, input_shape, output_shape):
+        """声明一个训练步中这一层需要的缓存，供内存规划使用
+        返回 [(名称, 形状, dtype, 阶段)]，阶段为
+        output   前向传播的输出，保留到最后一个使用它的层
+        forward  前向传播内部的临时缓存
+        saved    前向传播中保存、反向传播时使用
+        backward 反向传播内部的临时缓存
+        grad     反向传播的输出，保留到上一层反向传播
+        可以再加第5项，实际使用这块缓存的层，默认是这一层
+        """
+        return []
+
+    def _buffer(self, name, shape, dtype):
+        """取内存规划分配的缓存，没有规划或者放不下时（例如更大的batch）新分配"""
+
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        region = self.regions.get(name)
+        if region is None or nbytes > region.size:
+            return np.empty(shape, dtype=dtype)
+
+        return region[:nbytes].view(dtype).reshape(shape)
+
+    def _trace(self, inputs, outputs):
+        """静态图追踪时记录输入来源和输出形状，返回outputs"""
+
+        if Tracer.current is not None:
+            Tracer.current.record(self, inputs, outputs)
+
+        return outputs
+
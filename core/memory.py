@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+
+
+class Tensor(object):
+    """内存规划中的一块缓存，[start, end]为存活的时间区间"""
+
+    def __init__(self, layer, name, shape, dtype, start, end=None):
+
+        self.layer = layer
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.start = start
+        self.end = start if end is None else end
+
+        self.offset = None
+
+    def extend(self, time):
+        self.end = max(self.end, time)
+
+    def overlaps(self, other):
+        return self.start <= other.end and other.start <= self.end
+
+
+class MemoryPlanner(object):
+    """激活值内存规划
+
+    对一个训练步（前向传播 + 反向传播）做存活分析：
+    第i层前向传播的时刻为i，反向传播的时刻为2L - i，L为层数。
+    每层通过Layer.memory声明需要的缓存和所属阶段，得到每块缓存的存活区间，
+    存活区间不重叠的缓存共用同一段内存，所有缓存放在一块连续的内存池中。
+    按大小从大到小依次放到不冲突的最低偏移处。
+
+    规划完成后每层的Layer.regions指向内存池中的对应位置，
+    同样大小的batch训练时不再分配大块内存。
+    模型最后一层的输出会返回给调用方，不参与规划。
+    """
+
+    def __init__(self, plan, batch_size, alignment=64):
+
+        self.plan = plan
+        self.batch_size = batch_size
+        self.alignment = alignment
+
+        self.tensors = []
+        self.size = 0
+        self.arena = None
+
+    def analyze(self):
+        """存活分析，得到每块缓存的存活区间"""
+
+        plan = self.plan
+        L = len(plan)
+
+        def forward_time(i):
+            return i
+
+        def backward_time(i):
+            return 2 * L - i
+
+        shapes = [(self.batch_size,) + tuple(plan.input_shape)]
+        shapes += [(self.batch_size,) + tuple(shape) for shape in plan.shapes]
+
+        self.tensors = []
+        declared = []
+
+        # 前向传播：槽位 -> 存放该槽位数据的缓存
+        values = {0: None}
+
+        for i, (layer, src) in enumerate(plan.steps):
+
+            buffers = {}
+            for entry in layer.memory(shapes[src], shapes[i + 1]):
+
+                # 第5项是实际使用这块缓存的层，融合算子中为被融合的层
+                name, shape, dtype, phase = entry[:4]
+                owner = entry[4] if len(entry) > 4 else layer
+
+                # 最后一层的输出返回给调用方
+                if phase == 'output' and i == L - 1:
+                    continue
+
+                if phase == 'backward':
+                    tensor = Tensor(owner, name, shape, dtype, backward_time(i))
+                elif phase == 'saved':
+                    tensor = Tensor(owner, name, shape, dtype, forward_time(i), backward_time(i))
+                elif phase == 'grad':
+                    tensor = Tensor(owner, name, shape, dtype, backward_time(i))
+                else:
+                    tensor = Tensor(owner, name, shape, dtype, forward_time(i))
+
+                buffers[phase] = tensor
+                self.tensors.append(tensor)
+
+            declared.append(buffers)
+
+            # 输入在这一层前向传播时使用，保存输入的层要保留到反向传播
+            tensor = values[src]
+            if tensor is not None:
+                tensor.extend(forward_time(i))
+                if layer.saves_input:
+                    tensor.extend(backward_time(i))
+
+            if 'output' in buffers:
+                values[i + 1] = buffers['output']
+            elif layer.output_alias:
+                values[i + 1] = tensor
+            else:
+                values[i + 1] = None
+
+        # 反向传播：槽位 -> 存放该槽位delta误差的缓存，最后一层的delta误差由调用方给出
+        grads = {L: None}
+
+        for i in range(L - 1, -1, -1):
+
+            layer, src = plan.steps[i]
+
+            tensor = grads.pop(i + 1, None)
+            if tensor is not None:
+                tensor.extend(backward_time(i))
+
+            if 'grad' in declared[i]:
+                grad = declared[i]['grad']
+            elif layer.grad_alias:
+                grad = tensor
+            else:
+                grad = None
+
+            # 一个输出被多个层使用时，delta误差在后一个层反向传播时相加得到新的数组
+            if src in grads:
+                if grads[src] is not None:
+                    grads[src].extend(backward_time(i))
+                grads[src] = None
+            else:
+                grads[src] = grad
+
+        return self.tensors
+
+    def allocate(self):
+        """为每块缓存分配内存池中的偏移，返回内存池大小"""
+
+        placed = []
+        self.size = 0
+
+        for tensor in sorted(self.tensors, key=lambda t: t.nbytes, reverse=True):
+
+            conflicts = sorted((t for t in placed if t.overlaps(tensor)), key=lambda t: t.offset)
+
+            # 找到能放下的最低偏移
+            offset = 0
+            for other in conflicts:
+                if offset + tensor.nbytes <= other.offset:
+                    break
+                offset = max(offset, self._align(other.offset + other.nbytes))
+
+            tensor.offset = offset
+            placed.append(tensor)
+            self.size = max(self.size, offset + tensor.nbytes)
+
+        return self.size
+
+    def apply(self):
+        """分配内存池，每层的regions指向其中对应的位置"""
+
+        self.arena = np.empty(self.size, dtype=np.uint8)
+
+        for layer in self.plan.layers:
+            layer.regions.clear()
+
+        for tensor in self.tensors:
+            tensor.layer.regions.clear()
+
+        for tensor in self.tensors:
+            tensor.layer.regions[tensor.name] = self.arena[tensor.offset:tensor.offset + tensor.nbytes]
+
+        return self.arena
+
+    def run(self):
+
+        self.analyze()
+        self.allocate()
+        self.apply()
+
+        return self
+
+    @property
+    def total(self):
+        """不复用时所有缓存的大小之和"""
+        return sum(tensor.nbytes for tensor in self.tensors)
+
+    def _align(self, offset):
+        return (offset + self.alignment - 1) // self.alignment * self.alignment
+
+    def summary(self):
+
+        return 'memory plan: batch_size={}, {} buffers, peak {:.2f} MB, without reuse {:.2f} MB'.format(
+            self.batch_size, len(self.tensors), self.size / 1024 ** 2, self.total / 1024 ** 2)
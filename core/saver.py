@@ -3,6 +3,7 @@
 # Author:Speciallan
 
 import h5py
+from taurus import backend
 
 
 class Saver(object):
@@ -17,7 +18,8 @@ class Saver(object):
         for k,v in map.items():
             group = self.file.create_group(name=k)
             for k1,v1 in v.items():
-                group.create_dataset(name=k1, data=v1)
+                # 浮点数据按存储精度保存，可选float16
+                group.create_dataset(name=k1, data=backend.to_storage(v1))
 
         return self.file
 
@@ -1,3 +1,187 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
-# Author:Speciallan
\ No newline at end of file
+# Author:Speciallan
+
+import numpy as np
+from taurus import backend
+from taurus.core.graph import ComputationalGraph, Tracer
+from taurus.core.grad import no_grad
+from taurus.operations.common import Transpose, PERMUTATIONS
+
+
+class ExecutionPlan(object):
+    """静态执行计划
+
+    layers  按拓扑序排列的层
+    sources 每一层输入所在的槽位，槽位0是模型输入，槽位i+1是第i层的输出
+    shapes  每一层单个样本的输出形状
+    input_shape 单个样本的输入形状
+    layouts 每个槽位的内存布局，图片为'NHWC'等，向量为None
+
+    前向传播按顺序执行，反向传播按逆序调用layer.backward，
+    一个输出被多个层使用时，反向传播的delta误差在对应槽位上累加
+    """
+
+    def __init__(self, layers, sources, shapes, input_shape, layouts=None):
+
+        self.layers = layers
+        self.sources = sources
+        self.shapes = shapes
+        self.input_shape = input_shape
+        self.layouts = layouts if layouts is not None else [None] * (len(layers) + 1)
+
+        self.steps = list(zip(self.layers, self.sources))
+
+        # 各槽位的值，前向和反向传播复用
+        self.values = [None] * (len(self.layers) + 1)
+        self.grads = [None] * (len(self.layers) + 1)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def forward(self, x):
+
+        values = self.values
+        values[0] = x
+
+        for i, (layer, src) in enumerate(self.steps):
+            values[i + 1] = layer(values[src])
+
+        out = values[-1]
+
+        # 中间结果不在计划中保留，需要的数据由各层自己缓存
+        for i in range(len(values)):
+            values[i] = None
+
+        return out
+
+    def backward(self, delta):
+
+        grads = self.grads
+        grads[-1] = delta
+
+        for i in range(len(self.steps) - 1, -1, -1):
+
+            layer, src = self.steps[i]
+
+            delta = grads[i + 1]
+            grads[i + 1] = None
+
+            dx = layer.backward(delta)
+            grads[src] = dx if grads[src] is None else grads[src] + dx
+
+        dx = grads[0]
+        grads[0] = None
+
+        return dx
+
+    def summary(self):
+
+        lines = []
+        for layer, src, shape, layout in zip(self.layers, self.sources, self.shapes, self.layouts[1:]):
+            lines.append('{:<20}{:<16}{:<8}{:<8}{}'.format(str(layer.name), type(layer).__name__, src, str(layout), shape))
+
+        return '\n'.join(lines)
+
+
+def compile(model, batch_size=1):
+    """追踪model._forward，得到拓扑排序后的静态执行计划
+
+    用全0输入执行一次前向传播，各层通过Layer._trace记录输入来自哪一层，
+    构建计算图并拓扑排序，之后前向、反向传播不再依赖__dict__中层的定义顺序
+    """
+
+    input_layer = model.input
+
+    # 图片输入记录为(1, H, W, C)，向量输入记录为单个样本(in, 1)
+    shape = tuple(input_layer.output_shape)
+    sample_shape = shape[1:] if len(shape) == 4 else shape
+
+    x = np.zeros((batch_size,) + sample_shape, dtype=backend.floatx())
+
+    with no_grad(), Tracer(input_layer, x) as tracer:
+        output = model._forward(x)
+
+    graph = ComputationalGraph(tracer.nodes, tracer.edges)
+    order = [node for node in graph.build() if node is not input_layer]
+
+    slots = {input_layer.id: 0}
+    sources = []
+
+    for i, layer in enumerate(order):
+
+        inputs = [node_id for node_id in layer.in_bounding_nodes if node_id in slots]
+        if len(inputs) != 1:
+            raise ValueError('{}有{}个输入，静态图目前只支持单输入的层'.format(layer.name, len(inputs)))
+
+        sources.append(slots[inputs[0]])
+        slots[layer.id] = i + 1
+
+    if len(order) == 0 or tracer.producers.get(id(output)) is not order[-1]:
+        raise ValueError('静态图的最后一层不是模型的输出')
+
+    shapes = [tracer.shapes[layer.id][1:] for layer in order]
+
+    plan = ExecutionPlan(order, sources, shapes, sample_shape)
+
+    return propagate(plan, input_layer.layout)
+
+
+def propagate(plan, input_layout):
+    """内存布局传播，返回新的静态执行计划
+
+    图片在各层之间按槽位记录布局，与布局无关的层沿用输入的布局，
+    要求的布局与输入不一致时插入一次Transpose，同一个槽位转换过的结果复用。
+    模型的输出与输入的布局不一致时在最后转回，转置只发生在这些边界上
+    """
+
+    def layout_of(shape, layout):
+        # 只有图片 (H, W, C) 有布局
+        return layout if len(shape) == 3 else None
+
+    layers, sources, shapes = [], [], []
+    layouts = [layout_of(plan.input_shape, input_layout)]
+    all_shapes = [tuple(plan.input_shape)]
+
+    # 旧槽位 -> 新槽位，(新槽位, 布局) -> 转换后的新槽位
+    slots = {0: 0}
+    converted = {}
+
+    def append(layer, src, shape, layout):
+        layers.append(layer)
+        sources.append(src)
+        shapes.append(shape)
+        all_shapes.append(tuple(shape))
+        layouts.append(layout)
+        return len(layers)
+
+    def convert(src, layout):
+        if (src, layout) not in converted:
+            transpose = Transpose(layouts[src], layout)
+            shape = tuple(all_shapes[src][i - 1] for i in transpose.perm[1:])
+            converted[(src, layout)] = append(transpose, src, shape, layout)
+        return converted[(src, layout)]
+
+    for i, (layer, src) in enumerate(plan.steps):
+
+        src = slots[src]
+        current = layouts[src]
+
+        if layer.layout is not None and current is not None and layer.layout != current:
+            src = convert(src, layer.layout)
+            current = layer.layout
+
+        layout = layout_of(plan.shapes[i], layer.layout if layer.layout is not None else current)
+
+        # 追踪时没有转置，记录的形状都是输入布局下的形状，按实际布局转换
+        shape = tuple(plan.shapes[i])
+        if layout is not None and layout != input_layout:
+            shape = tuple(shape[j - 1] for j in PERMUTATIONS[(input_layout, layout)][1:])
+
+        slots[i + 1] = append(layer, src, shape, layout)
+
+    # 模型边界，输出转回输入的布局
+    if layouts[-1] is not None and layouts[0] is not None and layouts[-1] != layouts[0]:
+        convert(len(layers), layouts[0])
+
+    return ExecutionPlan(layers, sources, shapes, plan.input_shape, layouts)
@@ -2,30 +2,31 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+import os
+import glob
 import numpy as np
 import time
 from struct import unpack, unpack_from
+from taurus import backend
 
 
-def load_data(path):
+def load_data(path, lazy=False, cache=True):
     """
-    0.05s by cpu single core
-    [todo] multi processing
+    图片和标签都通过np.memmap映射文件，跳过IDX头部，只有真正用到的部分才会读入内存
+
+    lazy=True  返回uint8的原始图片映射，由调用方按batch归一化，例如normalize(x_batch)
+    cache=True 归一化后的图片缓存为同目录下的.npy文件，文件名带原始文件的修改时间和计算精度，
+               之后直接以mmap_mode='r'打开，启动几乎不耗时
     """
 
     # time1 = time.time()
 
-    X_train = read_image(path + 'train-images-idx3-ubyte')
-    y_train = read_label(path + 'train-labels-idx1-ubyte')
-    X_test = read_image(path + 't10k-images-idx3-ubyte')
-    y_test = read_label(path + 't10k-labels-idx1-ubyte')
+    X_train = load_image(path + 'train-images-idx3-ubyte', lazy, cache)
+    y_train = one_hot(read_label(path + 'train-labels-idx1-ubyte'))
+    X_test = load_image(path + 't10k-images-idx3-ubyte', lazy, cache)
+    y_test = one_hot(read_label(path + 't10k-labels-idx1-ubyte'))
 
-    X_train = normalize(X_train)
-    y_train = one_hot(y_train)
     y_train = y_train.reshape(y_train.shape[0], y_train.shape[1], 1)
-
-    X_test = normalize(X_test)
-    y_test = one_hot(y_test)
     y_test = y_test.reshape(y_test.shape[0], y_test.shape[1], 1)
 
     # print(f'load data time:{time.time() - time1}')
@@ -33,27 +34,59 @@ def load_data(path):
     return (X_train, y_train), (X_test, y_test)
 
 
+def load_image(path, lazy=False, cache=True):
+
+    image = read_image(path)
+
+    if lazy:
+        return image
+
+    if not cache:
+        return normalize(image)
+
+    # 修改时间或计算精度变化后都使用新的缓存
+    prefix = '{}.{}.'.format(path, os.stat(path).st_mtime_ns)
+    cache_path = prefix + '{}.npy'.format(np.dtype(backend.floatx()).name)
+
+    if not os.path.exists(cache_path):
+        try:
+            # 先写临时文件再改名，避免中断后留下不完整的缓存
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, normalize(image))
+            os.replace(tmp_path, cache_path)
+
+            # 删除原始文件修改前的旧缓存，当前文件其他精度的缓存保留
+            for old_path in glob.glob(glob.escape(path) + '.*.npy'):
+                if not old_path.startswith(prefix):
+                    os.remove(old_path)
+        except OSError:
+            # 目录不可写时不使用缓存
+            return normalize(image)
+
+    return np.load(cache_path, mmap_mode='r')
+
+
 def read_image(path):
     with open(path, 'rb') as f:
         magic, num, rows, cols = unpack('>4I', f.read(16))
-        img = np.fromfile(f, dtype=np.uint8).reshape(num, 784, 1)
+    img = np.memmap(path, dtype=np.uint8, mode='r', offset=16, shape=(num, rows * cols, 1))
     return img
 
 
 def read_label(path):
     with open(path, 'rb') as f:
         magic, num = unpack('>2I', f.read(8))
-        label = np.fromfile(f, dtype=np.uint8)
+    label = np.memmap(path, dtype=np.uint8, mode='r', offset=8, shape=(num,))
     return label
 
 
 def normalize(image):
-    img = image.astype(np.float32) / 255.0
+    img = np.multiply(image, 1. / 255, dtype=backend.floatx())
     return img
 
 
-def one_hot(label):
-    lab = np.zeros((label.size, 10))
-    for i, row in enumerate(lab):
-        row[label[i]] = 1
+def one_hot(label, num_classes=10):
+    lab = np.zeros((label.size, num_classes), dtype=backend.floatx())
+    lab[np.arange(label.size), label] = 1
     return lab
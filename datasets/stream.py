@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import os
+import glob
+import numpy as np
+from taurus import backend
+from taurus.preprocessing.generators import Generator
+from taurus.preprocessing.normalization import normalize
+
+
+class Stream(Generator):
+    """流式数据集
+
+    按块(chunk)从磁盘读取数据，每个mini-batch在用到时才reshape、padding和归一化，
+    写入预分配的batch缓存。内存占用只和chunk_size、batch_size有关，与数据集大小无关。
+    打乱时先打乱块的顺序，再打乱块内样本的顺序。
+
+    子类实现_chunks()，按给定顺序产出(x_chunk, y_chunk)。
+    返回的batch在缓存中复用，只在下一次迭代前有效。
+    """
+
+    def __init__(self, num_samples, sample_shape, y_shape, y_dtype, batch_size, image_shape=None, pad=0,
+                 scale=1. / 255, mean=None, std=None, shuffle=True, drop_last=False, seed=None):
+        super(Stream, self).__init__(None, None)
+
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.image_shape = tuple(image_shape) if image_shape is not None else tuple(sample_shape)
+        self.pad = pad
+        self.scale = scale
+        self.mean = mean
+        self.std = std
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random = np.random.RandomState(seed)
+
+        if len(self.image_shape) == 3 and pad > 0:
+            h, w, c = self.image_shape
+            self.output_shape = (h + 2 * pad, w + 2 * pad, c)
+        else:
+            self.output_shape = self.image_shape
+
+        # padding的边框只需要清零一次，之后只写中间部分
+        self.x_buffer = np.zeros((batch_size,) + self.output_shape, dtype=backend.floatx())
+        self.y_buffer = np.empty((batch_size,) + tuple(y_shape), dtype=y_dtype)
+
+        if self.output_shape != self.image_shape:
+            p = self.pad
+            self.x_center = self.x_buffer[:, p:p + self.image_shape[0], p:p + self.image_shape[1], :]
+        else:
+            self.x_center = self.x_buffer
+
+    def __len__(self):
+
+        num = self.num_samples // self.batch_size
+        if self.num_samples % self.batch_size != 0 and not self.drop_last:
+            num += 1
+
+        return num
+
+    def _chunks(self):
+        raise NotImplementedError
+
+    def _fill(self, x_chunk, y_chunk, index, start):
+
+        num = len(index)
+        images = np.take(x_chunk, index, axis=0).reshape((num,) + self.image_shape)
+
+        normalize(images, self.scale, self.mean, self.std, out=self.x_center[start:start + num])
+        np.take(y_chunk, index, axis=0, out=self.y_buffer[start:start + num], mode='clip')
+
+    def __iter__(self):
+
+        filled = 0
+
+        for x_chunk, y_chunk in self._chunks():
+
+            # 整块读入内存，之后的随机访问都在块内
+            x_chunk = np.asarray(x_chunk)
+            y_chunk = np.asarray(y_chunk)
+
+            order = np.arange(len(x_chunk))
+            if self.shuffle:
+                self.random.shuffle(order)
+
+            pos = 0
+            while pos < len(order):
+
+                # 一个batch可以跨越两个块
+                num = min(self.batch_size - filled, len(order) - pos)
+                self._fill(x_chunk, y_chunk, order[pos:pos + num], filled)
+
+                pos += num
+                filled += num
+
+                if filled == self.batch_size:
+                    yield self.x_buffer, self.y_buffer
+                    filled = 0
+
+        if filled > 0 and not self.drop_last:
+            yield self.x_buffer[:filled], self.y_buffer[:filled]
+
+
+class ArrayStream(Stream):
+    """对np.memmap（或任意支持切片的数组）按块顺序读取
+
+    例如 datasets.mnist.load_data(path, lazy=True) 返回的uint8映射
+    """
+
+    def __init__(self, x, y, batch_size, chunk_size=10000, **kwargs):
+        super(ArrayStream, self).__init__(len(x), x.shape[1:], y.shape[1:], y.dtype, batch_size, **kwargs)
+
+        self.x = x
+        self.y = y
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+
+        starts = np.arange(0, self.num_samples, self.chunk_size)
+        if self.shuffle:
+            self.random.shuffle(starts)
+
+        for start in starts:
+            yield self.x[start:start + self.chunk_size], self.y[start:start + self.chunk_size]
+
+
+class ShardStream(Stream):
+    """目录下的分片数据集，x_00000.npy y_00000.npy ...，可以用save_shards生成
+
+    每个分片以mmap_mode='r'打开，再按chunk_size分块读取
+    """
+
+    def __init__(self, directory, batch_size, chunk_size=10000, x_prefix='x_', y_prefix='y_', **kwargs):
+
+        self.x_files = sorted(glob.glob(os.path.join(directory, x_prefix + '*.npy')))
+        self.y_files = [os.path.join(directory, y_prefix + os.path.basename(f)[len(x_prefix):]) for f in self.x_files]
+
+        if len(self.x_files) == 0:
+            raise ValueError('{}中没有找到分片'.format(directory))
+
+        # 只读取头部得到形状
+        x = np.load(self.x_files[0], mmap_mode='r')
+        y = np.load(self.y_files[0], mmap_mode='r')
+        self.shard_sizes = [len(np.load(f, mmap_mode='r')) for f in self.x_files]
+
+        super(ShardStream, self).__init__(sum(self.shard_sizes), x.shape[1:], y.shape[1:], y.dtype, batch_size, **kwargs)
+
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+
+        order = np.arange(len(self.x_files))
+        if self.shuffle:
+            self.random.shuffle(order)
+
+        for i in order:
+
+            x = np.load(self.x_files[i], mmap_mode='r')
+            y = np.load(self.y_files[i], mmap_mode='r')
+
+            starts = np.arange(0, len(x), self.chunk_size)
+            if self.shuffle:
+                self.random.shuffle(starts)
+
+            for start in starts:
+                yield x[start:start + self.chunk_size], y[start:start + self.chunk_size]
+
+
+def save_shards(x, y, directory, shard_size=10000, x_prefix='x_', y_prefix='y_'):
+    """把数据集按shard_size切分保存为分片，x和y可以是memmap，每次只读取一个分片"""
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    for i, start in enumerate(range(0, len(x), shard_size)):
+        np.save(os.path.join(directory, '{}{:05d}.npy'.format(x_prefix, i)), np.asarray(x[start:start + shard_size]))
+        np.save(os.path.join(directory, '{}{:05d}.npy'.format(y_prefix, i)), np.asarray(y[start:start + shard_size]))
@@ -5,7 +5,6 @@
 import sys
 sys.path.append('..')
 
-import numpy as np
 from taurus.datasets.mnist import load_data
 from taurus.models.mlp import load_model
 from taurus.config import current_config as config
@@ -18,24 +17,14 @@ def main():
 
     _, (X_test, y_test) = load_data(data_path)
 
-    X_batch = X_test[:]
-    y_batch = y_test[:]
-
     model = load_model(model_path)
 
-    y_pred = model.inference(X_batch)
-
-    y_pred = np.argmax(y_pred, axis=1)
-    y_true = np.argmax(y_batch, axis=1)
-
-    true_num = 0
-    total = len(y_pred)
-
-    for i in range(len(y_pred)):
-        if y_pred[i] == y_true[i]:
-            true_num += 1
+    # 分块评估，同时得到损失和混淆矩阵
+    result = model.metrics(X_test, y_test)
 
-    print('accuracy: {:.2f}%'.format(true_num / total * 100))
+    print('accuracy: {:.2f}%'.format(result['accuracy'] * 100))
+    print('loss: {:.4f}'.format(result['loss']))
+    print(result['confusion_matrix'])
 
 
 if __name__ == '__main__':
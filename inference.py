@@ -57,11 +57,9 @@ def cnn_new():
     _, (X_test, y_test) = load_data(data_path)
     x_batch = X_test[:20]
 
-    # MLP可以用784 做卷积需要28x28
+    # MLP可以用784 做卷积需要28x28，零填充在第一层卷积中虚拟完成
     x_batch = np.reshape(x_batch, (len(x_batch), 28, 28, 1))
 
-    x_batch = padding(x_batch, 2)  # 对初始图像进行零填充，保证与LeNet输入结构一致60000*32*32*1
-
     model = NewCNN()
     model.load_weights(model_path)
 
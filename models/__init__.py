@@ -2,12 +2,22 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+import time
+
 import numpy as np
+from taurus import backend
 from taurus import optimizers
 from taurus.operations import sigmoid, sigmoid_prime, FC, Input
 from taurus.core.layer import Layer
+from taurus.core.arena import ParameterArena
+from taurus.core.grad import no_grad
+from taurus.core import static_graph
+from taurus.core.fusion import fuse as fuse_plan
+from taurus.core.memory import MemoryPlanner
+from taurus.preprocessing.generators import Generator, BatchIterator
 from taurus.core.saver import Saver, Loader
 from taurus.utils.spe import spe
+from taurus import losses
 
 
 class BaseModel(object):
@@ -26,6 +36,16 @@ class BaseModel(object):
         self.filters = []
         self.filters_biases = []
 
+        # 参数内存池
+        self.arena = None
+
+        # 训练/推理模式
+        self.training = True
+
+        # 静态执行计划和激活值内存规划
+        self.plan = None
+        self.memory_plan = None
+
         # nodes
         self.input = None
 
@@ -72,8 +92,28 @@ class BaseModel(object):
                 # print(layer.id, layer.input_shape, layer.output_shape)
                 # print(layer.weights.shape)
                 self.layers_avalible.append(layer)
-                self.weights.append(layer.weights)
-                self.biases.append(layer.biases)
+
+        # 参数放入连续内存
+        self._build_arena()
+
+        for layer in self.layers_avalible:
+            self.weights.append(layer.weights)
+            self.biases.append(layer.biases)
+
+        # 静态执行计划
+        self.compile()
+
+    def _build_arena(self):
+        """把所有层的权重和偏置合并到一块连续内存中
+        层内的weights、biases以及梯度dW、db都替换为内存池中的视图"""
+
+        entries = [entry for layer in self.layers_avalible for entry in layer.parameters()]
+
+        self.arena = ParameterArena([getattr(owner, param) for owner, param, grad in entries])
+
+        for (owner, param, grad), data, delta in zip(entries, self.arena.params, self.arena.grads):
+            setattr(owner, param, data)
+            setattr(owner, grad, delta)
 
     def set_optimizer(self, optimizer):
         self.optimizer = optimizer
@@ -82,17 +122,49 @@ class BaseModel(object):
         """前向传播"""
         raise NotImplementedError
 
+    def compile(self, fuse=True):
+        """追踪_forward得到静态执行计划，之后的前向、反向传播都按计划执行
+        fuse=True时把 conv/偏置/激活/池化、fc/偏置/激活 融合成一个算子，见core/fusion.py"""
+
+        self.plan = static_graph.compile(self)
+
+        if fuse:
+            self.plan = fuse_plan(self.plan)
+
+        return self.plan
+
+    def plan_memory(self, batch_size):
+        """按batch_size规划一个训练步的激活值内存，各层复用同一块内存池，打印规划的峰值内存"""
+
+        if self.plan is None:
+            return None
+
+        self.memory_plan = MemoryPlanner(self.plan, batch_size).run()
+        print(self.memory_plan.summary())
+
+        return self.memory_plan
+
+    def _predict(self, x):
+        """前向传播，编译过的模型按静态执行计划执行"""
+
+        if self.plan is not None:
+            return self.plan.forward(x)
+
+        return self._forward(x)
+
     def _backprop(self, x, y):
+        """整个batch一次前向、一次反向传播
+        数据排成(features, N)的矩阵，每层一次GEMM，单个样本(in, 1)即N=1
+        各层权重和偏置的梯度按batch求和后直接写入层内的梯度缓存 layer.dW layer.db，返回损失 (classes, N)"""
 
-        '''计算通过单幅图像求得的每层权重和偏置的梯度'''
-        delta_nabla_b = [np.zeros(b.shape) for b in self.biases]
-        delta_nabla_w = [np.zeros(w.shape) for w in self.weights]
+        N = len(x) if np.ndim(x) == 3 else 1
+        x = backend.cast_to_floatx(x).reshape(N, -1).T
+        y = backend.cast_to_floatx(y).reshape(N, -1).T
 
         # 前向传播，计算各层的激活前的输出值以及激活之后的输出值，为下一步反向传播计算作准备
         activations = [x]
         zs = []
 
-        # todo
         for i, layer in enumerate(self.layers_avalible):
             w, b = self.weights[i], self.biases[i]
             z = np.dot(w, activations[-1]) + b
@@ -100,70 +172,60 @@ class BaseModel(object):
             activation = layer.activation_func(z)
             activations.append(activation)
 
-        # 先求最后一层的delta误差以及b和W的导数
+        # 先求最后一层的delta误差
         cost = activations[-1] - y
         last_layer = self.layers_avalible[-1]
         delta = cost * last_layer.activation_prime_func(zs[-1])
-        delta_nabla_b[-1] = delta
-        delta_nabla_w[-1] = np.dot(delta, activations[-2].transpose())
 
-        # 将delta误差反向传播以及各层b和W的导数，一直计算到第二层
-        for l in range(2, len(self.layers_avalible) + 1):
-            prime_func = self.layers_avalible[-l+1].activation_prime_func
-            delta = np.dot(self.weights[-l + 1].transpose(), delta) * prime_func(zs[-l])
-            delta_nabla_b[-l] = delta
-            delta_nabla_w[-l] = np.dot(delta, activations[-l - 1].transpose())
+        # 从最后一层开始求b和W的导数，并将delta误差反向传播
+        num_layers = len(self.layers_avalible)
+        for l in range(1, num_layers + 1):
 
-        return delta_nabla_b, delta_nabla_w, cost
+            layer = self.layers_avalible[-l]
+            np.dot(delta, activations[-l - 1].T, out=layer.dW)
+            np.sum(delta, axis=1, keepdims=True, out=layer.db)
 
-    def _update(self, x_batch, y_batch):
+            if l < num_layers:
+                prime_func = self.layers_avalible[-l - 1].activation_prime_func
+                delta = np.dot(self.weights[-l].T, delta) * prime_func(zs[-l - 1])
 
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-        # spe(len(nabla_w), nabla_w[0].shape, nabla_w[1].shape)
+        return cost
 
-        # 把所有的delta误差求和
-        cost_all = 0
-        for x, y in zip(x_batch, y_batch):
-
-            delta_nabla_b, delta_nabla_w, cost = self._backprop(x, y)
-
-            # 误差求和
-            nabla_b = [nb + dnb for nb, dnb in zip(nabla_b, delta_nabla_b)]
-            nabla_w = [nw + dnw for nw, dnw in zip(nabla_w, delta_nabla_w)]
-            cost_all += sum(abs(cost))[0]
-
-            # print(np.sum(delta_nabla_w[0][:][:]))
-            # print(np.sum(delta_nabla_b[0][:][:]))
-            # print('--------------------')
+    def _update(self, x_batch, y_batch):
 
-        self.weights, self.biases = self.optimizer.optimize(self.weights, self.biases, nabla_w, nabla_b, len(x_batch))
+        # 各层梯度在反向传播时已经按batch求和，写入内存池中的梯度
+        cost = self._backprop(x_batch, y_batch)
+        cost_all = np.sum(np.abs(cost))
 
-        # 更新权重到每一个节点
-        for i, layer in enumerate(self.layers_avalible):
-            layer.weights = self.weights[i]
-            layer.biases = self.biases[i]
+        # 整个模型的参数一次更新，各层参数是内存池的视图，不需要再同步
+        self.optimizer.update(self.arena.data, self.arena.grad, len(x_batch))
 
         return cost_all
 
-    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[]):
+    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[], shuffle=True):
+
+        # 流式数据集、生成器直接交给train_by_generator
+        if isinstance(x, Generator):
+            return self.train_by_generator(x, batch_size, epochs, x_valid, y_valid)
 
         self.x_batch = x
         self.y_batch = y
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
         accuracy_history = []
         loss_history = []
         cost = 0
 
-        for i in range(epochs):
+        # 打乱索引取batch，所有batch复用同一块缓存
+        batches = BatchIterator(x, y, batch_size, shuffle=shuffle)
 
-            x_batches = [x[k:k + batch_size] for k in range(0, len(x), batch_size)]
-            y_batches = [y[k:k + batch_size] for k in range(0, len(y), batch_size)]
-            # spe(len(x_batches), x_batches[0].shape)
+        for i in range(epochs):
 
-            for x_batch, y_batch in zip(x_batches, y_batches):
+            for x_batch, y_batch in batches:
                 cost = self._update(x_batch, y_batch)
 
             (x_eval, y_eval) = (x, y) if len(x_valid) == 0 or len(y_valid) == 0 else (x_valid, y_valid)
@@ -176,38 +238,153 @@ class BaseModel(object):
 
         return (accuracy_history, loss_history)
 
-    def inference(self, x_batch):
+    def inference(self, x_batch, batch_size=None):
+        """批量推理，每次前向传播一整块数据，每层一次GEMM
+        结果写入预分配的数组，batch_size限制每块的大小，为空时整体一次计算"""
+
+        if batch_size is None:
+            batch_size = max(len(x_batch), 1)
 
         y_batch = np.array([])
 
-        for i in range(len(x_batch)):
-            y = self._forward(x_batch[i])
-            if i == 0:
-                y_batch = np.array([np.zeros(shape=(y.shape))])
-            y_batch = np.append(y_batch, [y], axis=0)
-        y_batch = np.delete(y_batch, [0], axis=0)
+        with no_grad():
+            for start in range(0, len(x_batch), batch_size):
+
+                y = self._predict(x_batch[start:start + batch_size])
+
+                # 第一块确定输出形状
+                if start == 0:
+                    y_batch = np.empty((len(x_batch),) + y.shape[1:], dtype=y.dtype)
+
+                y_batch[start:start + len(y)] = y
 
         return y_batch
 
-    def evaluate(self, x, y):
+    def evaluate(self, x, y, batch_size=1000):
+        """返回预测正确的数量"""
 
-        result = 0
-        for img, label in zip(x, y):
-            predict_label = self._forward(img)
-            if np.argmax(predict_label) == np.argmax(label):
-                result += 1
+        if len(x) == 0:
+            return 0
 
-        return result
+        return self.metrics(x, y, batch_size)['correct']
+
+    def metrics(self, x, y, batch_size=1000):
+        """评估模型，所有模型共用
+
+        按batch_size分块前向传播，在no_grad中不保存中间数据，内存占用与数据集大小无关。
+        返回 correct 正确数量, accuracy 准确率, loss 平均损失,
+        confusion_matrix 混淆矩阵，行为真实类别，列为预测类别
+        """
+
+        num_classes = int(np.prod(np.shape(y)[1:]))
+        confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        loss = 0.
+
+        # 不保存中间数据，各层上一次训练留下的缓存也不会被覆盖成整个数据集大小
+        with no_grad():
+            for start in range(0, len(x), batch_size):
+
+                x_batch = x[start:start + batch_size]
+                y_true = np.asarray(y[start:start + batch_size]).reshape(len(x_batch), -1)
+                y_pred = self._predict(x_batch).reshape(len(x_batch), -1)
+
+                loss += self._loss(y_pred, y_true)
+
+                # 真实类别和预测类别组合成一维编号，一次bincount得到整个batch的混淆矩阵
+                index = np.argmax(y_true, axis=1) * num_classes + np.argmax(y_pred, axis=1)
+                confusion_matrix += np.bincount(index, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+        correct = int(np.trace(confusion_matrix))
+
+        return {
+            'correct': correct,
+            'accuracy': correct / max(len(x), 1),
+            'loss': loss / max(len(x), 1),
+            'confusion_matrix': confusion_matrix,
+        }
+
+    def _loss(self, y_pred, y_true):
+        """整个batch的损失之和"""
+
+        if self.optimizer.loss == losses.CROSS_ENTROPY:
+            return float(losses.CrossEntropy.fn(y_pred, y_true))
+
+        return float(np.sum(np.abs(y_pred - y_true)))
+
+    def set_training(self, training=True):
+        """切换整个模型的训练/推理模式，返回切换前的模式
+        推理模式下各层不保存反向传播的中间数据，并释放已经保存的中间数据和工作区"""
+
+        previous = self.training
+        self.training = training
+
+        for layer in self.layers:
+            layer.training = training
+
+        if not training:
+            self.release()
+
+        return previous
+
+    def release(self):
+        """释放所有层保存的中间数据和工作区"""
+
+        layers = list(self.layers)
+        if self.plan is not None:
+            layers += [layer for layer in self.plan.layers if layer not in layers]
+
+        for layer in layers:
+            layer.release()
+            layer.regions.clear()
+
+        self.memory_plan = None
 
     def _validate(self, x, y):
         raise NotImplementedError
 
-    def train_by_generator(self, generator, batch_size, epochs):
+    def train_by_generator(self, generator, batch_size, epochs, x_valid=[], y_valid=[]):
+        """用生成器训练，generator每个epoch迭代一遍，产出(x_batch, y_batch)
+
+        ImageGenerator在后台线程中预取下一个batch，与当前batch的训练重叠，
+        datasets.stream中的流式数据集按块读取磁盘数据
+        """
 
         self.generator = generator
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
+        # 规划激活值内存，之后每个batch复用
+        self.plan_memory(batch_size or generator.batch_size)
+
+        accuracy_history = []
+        loss_history = []
+
+        for i in range(epochs):
+
+            cost = 0
+            num = 0
+            starttime = time.time()
+
+            for x_batch, y_batch in generator:
+                num += len(x_batch)
+                cost += self._update(x_batch, y_batch)
+                print("\rEpoch{0}:{1}".format(i + 1, num), end=' ')
+
+            loss_history.append(cost)
+            total_time = time.time() - starttime
+
+            if len(x_valid) > 0 and len(y_valid) > 0:
+                valid_result = self.evaluate(x_valid, y_valid)
+                accuracy_history.append(valid_result)
+                print("After epoch{0}: val_acc is {1}/{2}, loss is {3:.4f}, time:{4:.2f}".format(i + 1, valid_result, len(y_valid), cost, total_time))
+            else:
+                print("After epoch{0}: loss is {1:.4f}, time:{2:.2f}".format(i + 1, cost, total_time))
+
+        return (accuracy_history, loss_history)
+
     def save(self, filepath):
         pass
 
@@ -2,10 +2,14 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+import os
+
 from taurus import models
 from taurus.operations import *
 from taurus.operations.convolution import Conv2D, add_bias
 from taurus.core.saver import Saver, Loader
+from taurus.core.autotune import autotuner, autotune_path
+from taurus.preprocessing.generators import Generator, BatchIterator
 from taurus import optimizers
 from taurus import losses
 from taurus.utils.spe import spe
@@ -60,19 +64,28 @@ class NewCNN(models.BaseModel):
             if isinstance(layer, Layer) and layer.type in ['conv', 'fc']:
                 self.layers_avalible.append(layer)
 
-                if layer.type == layer.CONV:
-                    self.filters.append(layer.weights.transpose(0, 2, 3, 1))
-                    self.filters_biases.append(layer.biases.transpose(1, 0))
+        # 参数放入连续内存，filters等都是内存池的视图
+        self._build_arena()
+
+        for layer in self.layers_avalible:
+
+            if layer.type == layer.CONV:
+                self.filters.append(layer.weights.transpose(0, 2, 3, 1))
+                self.filters_biases.append(layer.biases.transpose(1, 0))
+
+            if layer.type == layer.FC:
+                self.weights.append(layer.weights)
+                self.biases.append(layer.biases)
 
-                if layer.type == layer.FC:
-                    self.weights.append(layer.weights)
-                    self.biases.append(layer.biases)
+        # 静态执行计划
+        self.compile()
 
     def _define(self):
 
-        self.input = Input(shape=(32,32,1))
+        # 28x28的MNIST直接输入，第一层卷积虚拟填充到32x32，与LeNet输入结构一致
+        self.input = Input(shape=(28,28,1))
 
-        self.conv1 = Conv2D(filters=6, kernel_size=5, initializer='normal')
+        self.conv1 = Conv2D(filters=6, kernel_size=5, padding='same', initializer='normal')
         self.relu1 = Relu()
         self.pool1 = MaxPooling2D()
 
@@ -130,7 +143,7 @@ class NewCNN(models.BaseModel):
         return output
 
     def _backprop(self, x, y):
-        """计算通过单幅图像求得梯度
+        """计算整个batch的梯度，梯度保存在各层的梯度缓存中，返回损失
         forward  优化前0.06单x，优化后0.0005，提升100倍
         backprop 优化前0.06单x，优化后0.008，提升10倍
         单个x总时间 0.12 -> 0.0085
@@ -140,7 +153,7 @@ class NewCNN(models.BaseModel):
         """
 
         # time1 = time.time()
-        output = self._forward(x)
+        output = self.plan.forward(x)
 
         # print('forward:{}'.format(time.time() - time1))
         # time1 = time.time()
@@ -148,90 +161,28 @@ class NewCNN(models.BaseModel):
         # loss
         cost = losses.get_loss_obj(self.optimizer.loss).fn(output, y)
 
-        val = cost
-
-        # 反向传播
-        layers_reversed = self.layers.copy()
-        layers_reversed.reverse()
-
-        for i, layer in enumerate(layers_reversed):
-            if layer.name not in ['input', 'output']:
-
-                if layer.type == layer.ACTIVATION:
-                    val = val * layer.backprop()
-                else:
-                    val = layer.backprop(val)
+        # 按静态执行计划的逆序反向传播
+        self.plan.backward(cost)
 
-        # 计算梯度
-        nabla_w, nabla_b, nabla_f, nabla_fb = [], [], [], []
-        # time1 = time.time()
-
-        for i, layer in enumerate(self.layers_avalible):
-
-            if layer.type == layer.CONV:
-                w, b = layer.cal_prime()
-                nabla_f.append(w)
-                nabla_fb.append(b)
-
-            if layer.type == layer.FC:
-                w, b = layer.cal_prime()
-                nabla_w.append(w)
-                nabla_b.append(b)
-
-        # print('cal_prime:{}'.format(time.time() - time1))
+        # 各层权重和偏置的梯度已经在backprop中写入层内的梯度缓存 layer.dW layer.db
         # print('backprop:{}'.format(time.time() - time1))
 
-        return nabla_w, nabla_b, nabla_f, nabla_fb, cost
+        return cost
 
     def _update(self, x_batch, y_batch):
 
         '''通过一个batch的数据对神经网络参数进行更新
         需要先求这个batch中每张图片的误差反向传播求得的权重梯度以及偏置梯度'''
 
-        # spe(self.filters[0].shape, self.weights[0].shape)
-
-        # (120,400)
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_f = [np.zeros(f.shape) for f in self.filters]
-        nabla_fb = [np.zeros(fb.shape) for fb in self.filters_biases]
-
-        delta_nabla_w, delta_nabla_b, delta_nabla_f, delta_nabla_fb, cost = self._backprop(x_batch, y_batch)
-
-        # [print(i.shape) for i in nabla_w]
-        # [print(i.shape) for i in delta_nabla_w]
-        # print(len(delta_nabla_w[0]))
-        # exit()
-
-        # fc 3层权重，每一层里面batch=200，每层为(120,400)
-        # delta_nabla_w (3,200,120,400) nabla_w (3,120,400)
-        # nabla_w = [print(nw.shape, dnw.shape) for nw, dnw in zip(nabla_w, delta_nabla_w)]
-        # exit()
-
-        # 先把batch=200的所有delta加起来
-        # print(len(delta_nabla_w), len(delta_nabla_w[0]))
-        for i in range(len(delta_nabla_w)): # 3
-            for j in range(len(delta_nabla_w[0])): # 200
-                nabla_w[i] = nabla_w[i] + delta_nabla_w[i][j]
-                nabla_b[i] = nabla_b[i] + delta_nabla_b[i][j]
-            # nabla_w[i], nabla_b[i] = nabla_w[i] / 200, nabla_b[i] / 200
-
-        for i in range(len(delta_nabla_f)): # 3
-            for j in range(len(delta_nabla_f[0])): # 200
-                nabla_f[i] = nabla_f[i] + delta_nabla_f[i][j]
-                nabla_fb[i] = nabla_fb[i] + delta_nabla_fb[i][j]
-            # nabla_f[i], nabla_fb[i] = nabla_f[i] / 200, nabla_fb[i] / 200
+        # 各层梯度在反向传播时已经用GEMM按batch求和，写入层内的梯度缓存
+        cost = self._backprop(x_batch, y_batch)
 
         # batch损失绝对值求和平均
-        cost_all = 0
-        for i in range(len(cost)):
-            cost_all += sum(abs(cost[i]))[0] / len(cost[i])
-        # cost_all = cost_all / len(cost)
+        cost_all = np.sum(np.abs(cost)) / cost.shape[1]
 
-        self.weights = [w - (self.optimizer.learning_rate / self.batch_size) * nw for w, nw in zip(self.weights, nabla_w)]
-        self.biases = [b - (self.optimizer.learning_rate / self.batch_size) * nb for b, nb in zip(self.biases, nabla_b)]
-        self.filters = [f - (self.optimizer.learning_rate / self.batch_size) * nf for f, nf in zip(self.filters, nabla_f)]
-        self.filters_biases = [fb - (self.optimizer.learning_rate / self.batch_size) * nfb for fb, nfb in zip(self.filters_biases, nabla_fb)]
+        # 整个模型的参数一次更新，各层参数和self.weights、self.filters等都是内存池的视图
+        # 最后一个batch可能不足batch_size，按实际样本数平均
+        self.optimizer.update(self.arena.data, self.arena.grad, len(x_batch))
 
         # spe(nabla_w[0].shape, delta_nabla_w[0].shape)
         # spe(22)
@@ -256,41 +207,45 @@ class NewCNN(models.BaseModel):
         # self.filters = [f - (self.optimizer.learning_rate / self.batch_size) * nf for f, nf in zip(self.filters, nabla_f)]
         # self.filters_biases = [fb - (self.optimizer.learning_rate / self.batch_size) * nfb for fb, nfb in zip(self.filters_biases, nabla_fb)]
 
-        # 更新全局权重到每一层 conv fc
-        self._update_weights_to_avaliable_layers()
-
         # spe(self.conv1.W.shape, self.filters[0].shape, self.conv1.b.shape, self.filters_biases[0].shape)
 
         return cost_all
 
-    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[]):
+    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[], shuffle=True):
+
+        # 流式数据集、生成器直接交给train_by_generator
+        if isinstance(x, Generator):
+            return self.train_by_generator(x, batch_size, epochs, x_valid, y_valid)
 
         self.x_batch = x
         self.y_batch = y
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
+        # 规划激活值内存，之后每个batch复用
+        self.plan_memory(batch_size)
+
         # self.optimizer.optimize(x, y, batch_size, epochs)
 
         accuracy_history = []
         loss_history = []
 
-        batch_num = 0
         print('Epoch train_acc val_acc')
 
+        # 打乱索引取batch，所有batch复用同一块缓存
+        batches = BatchIterator(x, y, self.batch_size, shuffle=shuffle)
+
         for j in range(epochs):
 
             cost = 0
             starttime = time.time()
+            num = 0
 
-            # 切分数据集到多个batch
-            x_batches = [x[k:k + self.batch_size] for k in range(0, len(x), self.batch_size)]
-            y_batches = [y[k:k + self.batch_size] for k in range(0, len(y), self.batch_size)]
-
-            for x_batch, y_batch in zip(x_batches, y_batches):
-                batch_num += 1
-                if batch_num * self.batch_size > len(x):
-                    batch_num = 1
+            for x_batch, y_batch in batches:
+                num += len(x_batch)
 
                 # 12s 优化后1.1s
                 cost += self._update(x_batch, y_batch)
@@ -299,20 +254,21 @@ class NewCNN(models.BaseModel):
                 # if batch_num % 100 == 0:
                 # print("after {0} training batch: accuracy is {1}/{2}".format(batch_num, self.evaluate(train_image[0:1000], train_label[0:1000]), len(train_image[0:1000])))
 
-                print("\rEpoch{0}:{1}/{2}".format(j + 1, batch_num * self.batch_size, len(x)), end=' ')
+                print("\rEpoch{0}:{1}/{2}".format(j + 1, num, len(x)), end=' ')
 
             total_time = time.time() - starttime
-            print("After epoch{0}: train_acc is {1}/{2}, val_acc is {3}/{4}, loss is {5:.4f}, time:{6:.2f}".format(j + 1, self._evaluate(x, y), len(x), self._evaluate(x_valid, y_valid), len(y_valid), cost, total_time))
+            print("After epoch{0}: train_acc is {1}/{2}, val_acc is {3}/{4}, loss is {5:.4f}, time:{6:.2f}".format(j + 1, self.evaluate(x, y), len(x), self.evaluate(x_valid, y_valid), len(y_valid), cost, total_time))
 
         # print('total time:{:2f} m'.format((time.time() - starttime) / 60))
 
         return (accuracy_history, loss_history)
 
-    def inference(self, x_batch):
+    def inference(self, x_batch, batch_size=None):
 
         starttime = time.time()
 
-        y_batch = self._forward(x_batch)
+        # 分块推理，不保存反向传播的中间数据
+        y_batch = super(NewCNN, self).inference(x_batch, batch_size)
         # y_batch = np.array([])
         # for i in range(len(x_batch)):
         #     y = self._forward(x_batch[i])
@@ -325,49 +281,35 @@ class NewCNN(models.BaseModel):
 
         return y_batch
 
-    def _evaluate(self, x, y):
-
-        predict_label = self._forward(x)
-
-        result = [1 if np.argmax(predict_label[i]) == np.argmax(y[i]) else 0 for i in range(len(x))]
-        result = sum(result)
-
-        # for img, label in zip(x, y):
-        #     predict_label = self._forward(img)
-        #     if np.argmax(predict_label) == np.argmax(label):
-        #         result += 1
-
-        return result
 
     def save_weights(self, filepath):
 
-        weights = {}
-
-        for k,v in enumerate(self.weights):
-            weights['w_' + str(k)] = v
-
-        for k,v in enumerate(self.biases):
-            weights['b_' + str(k)] = v
-
-        for k,v in enumerate(self.filters):
-            weights['fw_' + str(k)] = v
-
-        for k,v in enumerate(self.filters_biases):
-            weights['fb_' + str(k)] = v
-
+        # 参数内存池整块保存，各层参数都是其中的视图，不再逐个保存
         map = {'structure': {'structure': []},
-               'weights': weights}
+               'arena': {'data': self.arena.data}}
 
         saver = Saver(filepath)
         saver.save(map)
         print('save weights to {}'.format(filepath))
 
+        # 卷积算法的调优结果放在权重旁边，下次加载后不再重新计时
+        if autotuner.table:
+            autotuner.save(autotune_path(filepath))
+
     def load_weights(self, filepath):
 
+        if os.path.exists(autotune_path(filepath)):
+            autotuner.load(autotune_path(filepath))
+
         loader = Loader(filepath)
         data = loader.load()
 
-        # 解析数据
+        # 整块恢复参数内存池
+        if 'arena/data' in data:
+            self.arena.load(data['arena/data'])
+            return
+
+        # 旧版本逐个保存的权重，解析数据
         structure = data['structure/structure']
         weigths, biases, filters, filters_biases = [], [], [], []
 
@@ -386,29 +328,10 @@ class NewCNN(models.BaseModel):
 
     def _load_weights(self, weights, biases, filters, filters_biases):
 
-        self.weights = weights
-        self.biases = biases
-        self.filters = filters
-        self.filters_biases = filters_biases
-
-        # 更新全局权重到每一层 conv fc
-        self._update_weights_to_avaliable_layers()
-
-    def _update_weights_to_avaliable_layers(self):
-
-        # 更新全局权重到每一层 conv fc
-        conv_id, fc_id = 0, 0
-        for i, layer in enumerate(self.layers_avalible):
-
-            if layer.type == layer.CONV:
-                layer.weights = self.filters[conv_id].transpose(0, 3, 1, 2)
-                layer.biases = self.filters_biases[conv_id].transpose(1, 0)
-                conv_id += 1
-
-            if layer.type == layer.FC:
-                layer.weights = self.weights[fc_id]
-                layer.biases = self.biases[fc_id]
-                fc_id += 1
+        # 拷贝到内存池中，各层参数与这些列表共享内存，不需要再同步到每一层
+        for dst, src in zip(self.weights + self.biases + self.filters + self.filters_biases,
+                            weights + biases + filters + filters_biases):
+            dst[...] = src
 
 
 # ---------------------------------------------------------------------
@@ -423,6 +346,12 @@ class CNN(models.BaseModel):
         self.filters = []
         self.filters_biases = []
 
+        # 梯度，内存池中梯度的视图，形状与上面的参数一一对应
+        self.nabla_w = []
+        self.nabla_b = []
+        self.nabla_f = []
+        self.nabla_fb = []
+
         self.zs = []
         self.activations = []
 
@@ -458,13 +387,22 @@ class CNN(models.BaseModel):
             if isinstance(layer, Layer) and layer.type in ['conv', 'fc']:
                 self.layers_avalible.append(layer)
 
-                if layer.type == layer.CONV:
-                    self.filters.append(layer.weights.transpose(0, 3, 1, 2))
-                    self.filters_biases.append(layer.biases.transpose(1, 0))
+        # 参数放入连续内存，下面的列表都是各层参数和梯度的视图，优化器原地更新后不需要再同步到每一层
+        self._build_arena()
+
+        for layer in self.layers_avalible:
+
+            if layer.type == layer.CONV:
+                self.filters.append(layer.weights.transpose(0, 3, 1, 2))
+                self.filters_biases.append(layer.biases.transpose(1, 0))
+                self.nabla_f.append(layer.dW.transpose(0, 3, 1, 2))
+                self.nabla_fb.append(layer.db.transpose(1, 0))
 
-                if layer.type == layer.FC:
-                    self.weights.append(layer.weights)
-                    self.biases.append(layer.biases)
+            if layer.type == layer.FC:
+                self.weights.append(layer.weights)
+                self.biases.append(layer.biases)
+                self.nabla_w.append(layer.dW)
+                self.nabla_b.append(layer.db)
 
     def _define(self):
 
@@ -624,76 +562,52 @@ class CNN(models.BaseModel):
         '''通过一个batch的数据对神经网络参数进行更新
         需要先求这个batch中每张图片的误差反向传播求得的权重梯度以及偏置梯度'''
 
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-
-        nabla_f = [np.zeros(f.shape) for f in self.filters]
-        nabla_fb = [np.zeros(fb.shape) for fb in self.filters_biases]
+        # 梯度在内存池中累加
+        self.arena.zero_grad()
+        nablas = self.nabla_w + self.nabla_b + self.nabla_f + self.nabla_fb
 
         cost_all = 0
-        i = 0
         for x, y in zip(x_batch, y_batch):
 
-            # time1 = time.time()
-            # print('--------', i)
             delta_nabla_w, delta_nabla_b, delta_nabla_f, delta_nabla_fb, cost = self._backprop(x, y)
-            # print('{} backprop_total:{}'.format(i, time.time() - time1))
-            i += 1
-            # spe(nabla_w[0].shape, delta_nabla_w[0].shape)
-            # spe(nabla_f[0].shape, delta_nabla_f[0].shape)
-
-            nabla_w = [nw + dnw for nw, dnw in zip(nabla_w, delta_nabla_w)]
-            nabla_b = [nb + dnb for nb, dnb in zip(nabla_b, delta_nabla_b)]
-            nabla_f = [nf + dnf for nf, dnf in zip(nabla_f, delta_nabla_f)]
-            nabla_fb = [nfb + dnfb for nfb, dnfb in zip(nabla_fb, delta_nabla_fb)]
-            cost_all += sum(abs(cost))[0]
-
-        self.weights = [w - (self.optimizer.learning_rate / self.batch_size) * nw for w, nw in zip(self.weights, nabla_w)]
-        self.biases = [b - (self.optimizer.learning_rate / self.batch_size) * nb for b, nb in zip(self.biases, nabla_b)]
-        self.filters = [f - (self.optimizer.learning_rate / self.batch_size) * nf for f, nf in zip(self.filters, nabla_f)]
-        self.filters_biases = [fb - (self.optimizer.learning_rate / self.batch_size) * nfb for fb, nfb in zip(self.filters_biases, nabla_fb)]
-
-        # 更新全局权重到每一层 conv fc
-        conv_id, fc_id = 0, 0
-        for i, layer in enumerate(self.layers_avalible):
-
-            if layer.type == layer.CONV:
-                layer.weights = self.filters[conv_id].transpose(0, 3, 1, 2)
-                layer.biases = self.filters_biases[conv_id].transpose(1, 0)
-                conv_id += 1
 
-            if layer.type == layer.FC:
-                layer.weights = self.weights[fc_id]
-                layer.biases = self.biases[fc_id]
-                fc_id += 1
+            for nabla, delta in zip(nablas, delta_nabla_w + delta_nabla_b + delta_nabla_f + delta_nabla_fb):
+                nabla += delta
+            cost_all += sum(abs(cost))[0]
 
-        # spe(self.conv1.W.shape, self.filters[0].shape, self.conv1.b.shape, self.filters_biases[0].shape)
+        # 整个模型的参数一次更新，各层参数是内存池的视图
+        self.optimizer.update(self.arena.data, self.arena.grad, len(x_batch))
 
         return cost_all
 
-    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[]):
+    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[], shuffle=True):
+
+        # 流式数据集、生成器直接交给train_by_generator
+        if isinstance(x, Generator):
+            return self.train_by_generator(x, batch_size, epochs, x_valid, y_valid)
 
         self.x_batch = x
         self.y_batch = y
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
         # self.optimizer.optimize(x, y, batch_size, epochs)
 
         accuracy_history = []
         loss_history = []
         cost = 0
 
-        batch_num = 0
-        for j in range(epochs):
+        # 打乱索引取batch，所有batch复用同一块缓存
+        batches = BatchIterator(x, y, self.batch_size, shuffle=shuffle)
 
-            x_batches = [x[k:k + self.batch_size] for k in range(0, len(x), self.batch_size)]
-            y_batches = [y[k:k + self.batch_size] for k in range(0, len(y), self.batch_size)]
+        for j in range(epochs):
 
-            for x_batch, y_batch in zip(x_batches, y_batches):
-                batch_num += 1
-                if batch_num * self.batch_size > len(x):
-                    batch_num = 1
+            num = 0
+            for x_batch, y_batch in batches:
+                num += len(x_batch)
 
                 # 12s
                 # time1 = time.time()
@@ -703,9 +617,9 @@ class CNN(models.BaseModel):
                 # if batch_num % 100 == 0:
                 # print("after {0} training batch: accuracy is {1}/{2}".format(batch_num, self.evaluate(train_image[0:1000], train_label[0:1000]), len(train_image[0:1000])))
 
-                print("\rEpoch{0}:{1}/{2}".format(j + 1, batch_num * self.batch_size, len(x)), end=' ')
+                print("\rEpoch{0}:{1}/{2}".format(j + 1, num, len(x)), end=' ')
 
-            print("After epoch{0}: train_acc is {1}/{2}, val_acc is {3}/{4}, lost is {5:.4f}".format(j + 1, self._evaluate(x, y), len(y_valid), self._evaluate(x_valid, y_valid), len(y_valid), cost))
+            print("After epoch{0}: train_acc is {1}/{2}, val_acc is {3}/{4}, lost is {5:.4f}".format(j + 1, self.evaluate(x, y), len(y_valid), self.evaluate(x_valid, y_valid), len(y_valid), cost))
 
         return (accuracy_history, loss_history)
 
@@ -725,16 +639,6 @@ class CNN(models.BaseModel):
 
         return y_batch
 
-    def _evaluate(self, x, y):
-
-        result = 0
-        for img, label in zip(x, y):
-            predict_label = self._forward(img)
-            if np.argmax(predict_label) == np.argmax(label):
-                result += 1
-
-        return result
-
     def save_weights(self, filepath):
 
         weights = {}
@@ -782,8 +686,8 @@ class CNN(models.BaseModel):
 
     def _load_weights(self, weights, biases, filters, filters_biases):
 
-        self.weights = weights
-        self.biases = biases
-        self.filters = filters
-        self.filters_biases = filters_biases
+        # 拷贝到内存池中，各层参数与这些列表共享内存
+        for dst, src in zip(self.weights + self.biases + self.filters + self.filters_biases,
+                            weights + biases + filters + filters_biases):
+            dst[...] = src
 
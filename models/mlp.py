@@ -4,11 +4,14 @@
 
 import numpy as np
 
+from taurus import backend
 from taurus import models
 from taurus import optimizers
 from taurus.operations import sigmoid, sigmoid_prime, FC, Input
 from taurus.core.saver import Saver, Loader
 from taurus.core.layer import Layer
+from taurus.core.arena import ParameterArena
+from taurus.preprocessing.generators import Generator, BatchIterator
 from taurus.utils.spe import spe
 
 
@@ -31,7 +34,13 @@ def load_model(filepath):
 
     # 加载到模型
     model = MLP(structure)
-    model._load_weights(weigths, biases)
+    model._init_weights()
+
+    # 整块恢复参数内存池
+    if 'arena/data' in data:
+        model.arena.load(data['arena/data'])
+    else:
+        model._load_weights(weigths, biases)
 
     return model
 
@@ -90,8 +99,16 @@ class NewMLP(models.BaseModel):
                 # print(layer.id, layer.input_shape, layer.output_shape)
                 # print(layer.weights.shape)
                 self.layers_avalible.append(layer)
-                self.weights.append(layer.weights)
-                self.biases.append(layer.biases)
+
+        # 参数放入连续内存
+        self._build_arena()
+
+        for layer in self.layers_avalible:
+            self.weights.append(layer.weights)
+            self.biases.append(layer.biases)
+
+        # 静态执行计划
+        self.compile()
 
     def _define(self):
         """定义网络结构"""
@@ -108,86 +125,30 @@ class NewMLP(models.BaseModel):
 
         return x
 
-    def _backprop(self, x, y):
-
-        '''计算通过单幅图像求得的每层权重和偏置的梯度'''
-        delta_nabla_b = [np.zeros(b.shape) for b in self.biases]
-        delta_nabla_w = [np.zeros(w.shape) for w in self.weights]
-
-        # 前向传播，计算各层的激活前的输出值以及激活之后的输出值，为下一步反向传播计算作准备
-        activations = [x]
-        zs = []
-
-        # todo
-        for i, layer in enumerate(self.layers_avalible):
-            w, b = self.weights[i], self.biases[i]
-            z = np.dot(w, activations[-1]) + b
-            zs.append(z)
-            activation = layer.activation_func(z)
-            activations.append(activation)
-
-        # 先求最后一层的delta误差以及b和W的导数
-        cost = activations[-1] - y
-        last_layer = self.layers_avalible[-1]
-        delta = cost * last_layer.activation_prime_func(zs[-1])
-        delta_nabla_b[-1] = delta
-        delta_nabla_w[-1] = np.dot(delta, activations[-2].transpose())
-
-        # 将delta误差反向传播以及各层b和W的导数，一直计算到第二层
-        for l in range(2, len(self.layers_avalible) + 1):
-            prime_func = self.layers_avalible[-l+1].activation_prime_func
-            delta = np.dot(self.weights[-l + 1].transpose(), delta) * prime_func(zs[-l])
-            delta_nabla_b[-l] = delta
-            delta_nabla_w[-l] = np.dot(delta, activations[-l - 1].transpose())
-
-        return delta_nabla_b, delta_nabla_w, cost
-
-    def _update(self, x_batch, y_batch):
-
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-        # spe(len(nabla_w), nabla_w[0].shape, nabla_w[1].shape)
-
-        # 把所有的delta误差求和
-        cost_all = 0
-        for x, y in zip(x_batch, y_batch):
-
-            delta_nabla_b, delta_nabla_w, cost = self._backprop(x, y)
-
-            # 误差求和
-            nabla_b = [nb + dnb for nb, dnb in zip(nabla_b, delta_nabla_b)]
-            nabla_w = [nw + dnw for nw, dnw in zip(nabla_w, delta_nabla_w)]
-            cost_all += sum(abs(cost))[0]
-
-            # print(np.sum(delta_nabla_w[0][:][:]))
-            # print(np.sum(delta_nabla_b[0][:][:]))
-            # print('--------------------')
-
-        self.weights, self.biases = self.optimizer.optimize(self.weights, self.biases, nabla_w, nabla_b, len(x_batch))
-
-        # 更新权重到每一个节点
-        self._update_weights_to_avaliable_layers()
+    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[], shuffle=True):
 
-        return cost_all
-
-    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[]):
+        # 流式数据集、生成器直接交给train_by_generator
+        if isinstance(x, Generator):
+            return self.train_by_generator(x, batch_size, epochs, x_valid, y_valid)
 
         self.x_batch = x
         self.y_batch = y
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
         accuracy_history = []
         loss_history = []
         cost = 0
 
-        for i in range(epochs):
+        # 打乱索引取batch，所有batch复用同一块缓存
+        batches = BatchIterator(x, y, batch_size, shuffle=shuffle)
 
-            x_batches = [x[k:k + batch_size] for k in range(0, len(x), batch_size)]
-            y_batches = [y[k:k + batch_size] for k in range(0, len(y), batch_size)]
-            # spe(len(x_batches), x_batches[0].shape)
+        for i in range(epochs):
 
-            for x_batch, y_batch in zip(x_batches, y_batches):
+            for x_batch, y_batch in batches:
                 cost = self._update(x_batch, y_batch)
 
             (x_eval, y_eval) = (x, y) if len(x_valid) == 0 or len(y_valid) == 0 else (x_valid, y_valid)
@@ -200,41 +161,11 @@ class NewMLP(models.BaseModel):
 
         return (accuracy_history, loss_history)
 
-    def inference(self, x_batch):
-
-        y_batch = np.array([])
-
-        for i in range(len(x_batch)):
-            y = self._forward(x_batch[i])
-            if i == 0:
-                y_batch = np.array([np.zeros(shape=(y.shape))])
-            y_batch = np.append(y_batch, [y], axis=0)
-        y_batch = np.delete(y_batch, [0], axis=0)
-
-        return y_batch
-
-    def evaluate(self, x, y):
-
-        result = 0
-        for img, label in zip(x, y):
-            predict_label = self._forward(img)
-            if np.argmax(predict_label) == np.argmax(label):
-                result += 1
-
-        return result
-
     def save_weights(self, filepath):
 
-        weights = {}
-
-        for k,v in enumerate(self.weights):
-            weights['w_' + str(k)] = v
-
-        for k,v in enumerate(self.biases):
-            weights['b_' + str(k)] = v
-
+        # 参数内存池整块保存，各层参数都是其中的视图，不再逐个保存
         map = {'structure': {'structure': []},
-               'weights': weights}
+               'arena': {'data': self.arena.data}}
 
         saver = Saver(filepath)
         saver.save(map)
@@ -245,7 +176,12 @@ class NewMLP(models.BaseModel):
         loader = Loader(filepath)
         data = loader.load()
 
-        # 解析数据
+        # 整块恢复参数内存池
+        if 'arena/data' in data:
+            self.arena.load(data['arena/data'])
+            return
+
+        # 旧版本逐个保存的权重，解析数据
         structure = data['structure/structure']
         weigths, biases = [], []
 
@@ -258,19 +194,13 @@ class NewMLP(models.BaseModel):
         # 加载权重
         self._load_weights(weigths, biases)
 
-        # 更新权重到每一个节点
-        self._update_weights_to_avaliable_layers()
-
     def _load_weights(self, weights, biases):
-        self.weights = weights
-        self.biases = biases
-
-    def _update_weights_to_avaliable_layers(self):
 
-        # 更新权重到每一个节点
-        for i, layer in enumerate(self.layers_avalible):
-            layer.weights = self.weights[i]
-            layer.biases = self.biases[i]
+        # 拷贝到内存池中，各层参数是内存池的视图
+        for w, loaded in zip(self.weights, weights):
+            w[...] = loaded
+        for b, loaded in zip(self.biases, biases):
+            b[...] = loaded
 
 class MLP(models.BaseModel):
 
@@ -287,15 +217,56 @@ class MLP(models.BaseModel):
         pass
 
     def _forward(self, x):
+        """单个样本(in, 1)，或者一个batch (N, in, 1)，batch时每层一次GEMM"""
 
-        value = x
+        if x.ndim == 2:
+            value = x
+            for i in range(len(self.weights)):
+                value = sigmoid(np.dot(self.weights[i], value) + self.biases[i])
+            return value
+
+        N = x.shape[0]
+        value = x.reshape(N, -1)
         for i in range(len(self.weights)):
-            value = sigmoid(np.dot(self.weights[i], value) + self.biases[i])
-        y = value
+            value = sigmoid(np.dot(value, self.weights[i].T) + self.biases[i].T)
+        y = value.reshape(N, -1, 1)
         return y
 
     def _backprop(self, x, y):
-        """计算通过单幅图像求得的每层权重和偏置的梯度"""
+        """整个batch一次前向、一次反向传播
+        数据排成(features, N)的矩阵，每层一次GEMM，单个样本(in, 1)即N=1
+        梯度按batch求和后直接写入内存池中的self.nabla_w self.nabla_b，返回损失 (classes, N)"""
+
+        N = len(x) if np.ndim(x) == 3 else 1
+        x = backend.cast_to_floatx(x).reshape(N, -1).T
+        y = backend.cast_to_floatx(y).reshape(N, -1).T
+
+        # 前向传播，计算各层的激活前的输出值以及激活之后的输出值，为下一步反向传播计算作准备
+        activations = [x]
+        zs = []
+        for b, w in zip(self.biases, self.weights):
+            z = np.dot(w, activations[-1]) + b
+            zs.append(z)
+            activation = sigmoid(z)
+            activations.append(activation)
+
+        # 先求最后一层的delta误差
+        cost = activations[-1] - y
+        delta = cost * sigmoid_prime(zs[-1])
+
+        # 从最后一层开始求b和W的导数，并将delta误差反向传播，一直计算到第二层
+        for l in range(1, self.num_layers):
+
+            np.dot(delta, activations[-l - 1].T, out=self.nabla_w[-l])
+            np.sum(delta, axis=1, keepdims=True, out=self.nabla_b[-l])
+
+            if l < self.num_layers - 1:
+                delta = np.dot(self.weights[-l].T, delta) * sigmoid_prime(zs[-l - 1])
+
+        return cost
+
+    def _backprop_backup(self, x, y):
+        """计算通过单幅图像求得的每层权重和偏置的梯度，作为参考实现"""
         delta_nabla_b = [np.zeros(b.shape) for b in self.biases]
         delta_nabla_w = [np.zeros(w.shape) for w in self.weights]
 
@@ -325,53 +296,57 @@ class MLP(models.BaseModel):
     def _update(self, x_batch, y_batch):
 
         '''通过一个batch的数据对神经网络参数进行更新
-        需要对当前batch中每张图片调用backprop函数将误差反向传播
-        求每张图片对应的权重梯度以及偏置梯度，最后进行平均使用梯度下降法更新参数'''
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
-
-        # 把所有的delta误差求和
-        cost_all = 0
-        for x, y in zip(x_batch, y_batch):
-            delta_nabla_b, delta_nabla_w, cost = self._backprop(x, y)
-            nabla_b = [nb + dnb for nb, dnb in zip(nabla_b, delta_nabla_b)]
-            nabla_w = [nw + dnw for nw, dnw in zip(nabla_w, delta_nabla_w)]
-            cost_all += sum(abs(cost))[0]
+        整个batch一起反向传播，梯度按batch求和后使用梯度下降法更新参数'''
 
-        self.weights, self.biases = self.optimizer.optimize(self.weights, self.biases, nabla_w, nabla_b, len(x_batch))
+        # 梯度直接写入内存池
+        cost = self._backprop(x_batch, y_batch)
+        cost_all = np.sum(np.abs(cost))
 
-        # print(self.weights[0][:5][:5])
-        # print(self.biases[0][:5][:5])
-        # print('--------------------')
+        # 整个模型的参数一次更新
+        self.optimizer.update(self.arena.data, self.arena.grad, len(x_batch))
 
         return cost_all
 
     def _init_weights(self):
 
-        self.weights = [np.random.randn(n, m) for m, n in zip(self.sizes[:-1], self.sizes[1:])]
-        self.biases = [np.random.randn(n, 1) for n in self.sizes[1:]]
+        weights = [np.random.randn(n, m) for m, n in zip(self.sizes[:-1], self.sizes[1:])]
+        biases = [np.random.randn(n, 1) for n in self.sizes[1:]]
+
+        # 参数放入连续内存，weights在前biases在后，权重和梯度都是内存池的视图
+        self.arena = ParameterArena(weights + biases)
 
-    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[]):
+        num = len(weights)
+        self.weights, self.biases = self.arena.params[:num], self.arena.params[num:]
+        self.nabla_w, self.nabla_b = self.arena.grads[:num], self.arena.grads[num:]
+
+    def train(self, x, y, batch_size, epochs, x_valid=[], y_valid=[], shuffle=True):
 
         self.x_batch = x
         self.y_batch = y
         self.batch_size = batch_size
         self.epochs = epochs
 
+        # 训练模式，各层保存反向传播需要的中间数据
+        self.set_training(True)
+
         # self.optimizer.optimize(x, y, batch_size, epochs)
 
         self._init_weights()
 
+        # 流式数据集、生成器在初始化权重之后交给train_by_generator
+        if isinstance(x, Generator):
+            return self.train_by_generator(x, batch_size, epochs, x_valid, y_valid)
+
         accuracy_history = []
         loss_history = []
         cost = 0
 
-        for i in range(epochs):
+        # 打乱索引取batch，所有batch复用同一块缓存
+        batches = BatchIterator(x, y, batch_size, shuffle=shuffle)
 
-            x_batches = [x[k:k + batch_size] for k in range(0, len(x), batch_size)]
-            y_batches = [y[k:k + batch_size] for k in range(0, len(y), batch_size)]
+        for i in range(epochs):
 
-            for x_batch, y_batch in zip(x_batches, y_batches):
+            for x_batch, y_batch in batches:
                 cost = self._update(x_batch, y_batch)
 
             (x_eval, y_eval) = (x, y) if len(x_valid) == 0 or len(y_valid) == 0 else (x_valid, y_valid)
@@ -384,44 +359,11 @@ class MLP(models.BaseModel):
 
         return (accuracy_history, loss_history)
 
-    def inference(self, x_batch):
-
-        y_batch = np.array([])
-
-        for i in range(len(x_batch)):
-
-            y = self._forward(x_batch[i])
-            if i == 0:
-                y_batch = np.array([np.zeros(shape=(y.shape))])
-
-            y_batch = np.append(y_batch, [y], axis=0)
-
-        y_batch = np.delete(y_batch, [0], axis=0)
-
-        return y_batch
-
-    def evaluate(self, x, y):
-
-        result = 0
-        for img, label in zip(x, y):
-            predict_label = self._forward(img)
-            if np.argmax(predict_label) == np.argmax(label):
-                result += 1
-
-        return result
-
     def save(self, filepath):
 
-        weights = {}
-
-        for k,v in enumerate(self.weights):
-            weights['w_' + str(k)] = v
-
-        for k,v in enumerate(self.biases):
-            weights['b_' + str(k)] = v
-
+        # 参数内存池整块保存，加载时按structure重建模型后整块拷贝
         map = {'structure': {'structure': self.sizes},
-               'weights': weights}
+               'arena': {'data': self.arena.data}}
 
         saver = Saver(filepath)
         saver.save(map)
@@ -437,8 +379,15 @@ class MLP(models.BaseModel):
         pass
 
     def _load_weights(self, weights, biases):
-        self.weights = weights
-        self.biases = biases
+
+        if self.arena is None:
+            self._init_weights()
+
+        # 拷贝到内存池中
+        for w, loaded in zip(self.weights, weights):
+            w[...] = loaded
+        for b, loaded in zip(self.biases, biases):
+            b[...] = loaded
 
     def _define(self):
         pass
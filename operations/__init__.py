@@ -18,5 +18,6 @@ from taurus.operations.fc import *
 from taurus.operations.normalization import *
 from taurus.operations.pooling import *
 from taurus.operations.common import *
+from taurus.operations.fused import *
 
 
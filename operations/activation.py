@@ -4,6 +4,7 @@
 
 import numpy as np
 import time
+from taurus import backend
 from taurus import operations
 from taurus.utils.spe import spe
 
@@ -27,6 +28,10 @@ class Activation(operations.Operation):
     def __call__(self, inputs, *args, **kwargs):
         pass
 
+    def backward(self, delta):
+        """激活层的backprop返回激活函数的导数，与delta逐元素相乘"""
+        return delta * self.backprop()
+
 
 class Sigmoid(operations.Operation):
 
@@ -45,18 +50,36 @@ class Relu(Activation):
 
     def __init__(self):
         super(Relu, self).__init__()
-        self.x = np.array([])
+
+        # 反向传播只需要知道哪些位置大于0，保存布尔掩码而不是输入
+        self.mask = np.array([], dtype=bool)
 
     def __call__(self, x, *args, **kwargs):
 
-        self.x = x
-        out = relu(x)
-        return out
+        if self.caching:
+            self.mask = np.greater(x, 0, out=self._buffer('mask', x.shape, bool))
+
+        out = np.maximum(x, 0, out=self._buffer('output', x.shape, x.dtype))
+        return self._trace(x, out)
 
     def backprop(self):
-        out = relu_prime(self.x)
+        out = self.mask.astype(backend.floatx())
         return out
 
+    def backward(self, delta):
+        return np.multiply(delta, self.mask, out=self._buffer('dx', delta.shape, delta.dtype))
+
+    def memory(self, input_shape, output_shape):
+
+        return [
+            ('mask', input_shape, bool, 'saved'),
+            ('output', output_shape, backend.floatx(), 'output'),
+            ('dx', input_shape, backend.floatx(), 'grad'),
+        ]
+
+    def release(self):
+        self.mask = np.array([], dtype=bool)
+
 def relu(feature, version=0):
     '''Relu激活函数，有两种情况会使用到
     当在卷积层中使用时，feature为一个三维张量，，[行，列，通道]
@@ -69,7 +92,7 @@ def relu(feature, version=0):
     if version == 0:
         relu_out = np.where(feature <= 0, 0, feature)
     else:
-        relu_out = np.zeros(feature.shape)
+        relu_out = np.zeros(feature.shape, dtype=feature.dtype)
 
         if len(feature.shape) > 2:
             for ch_num in range(feature.shape[-1]):
@@ -92,9 +115,10 @@ def relu_prime(feature, version=0):  # 对relu函数的求导
     # time1 = time.time()
 
     if version == 0:
-        relu_prime_out = np.where(feature <= 0, 0, 1)
+        # 与输入同精度，避免整型掩码把后续乘积提升为float64
+        relu_prime_out = (feature > 0).astype(feature.dtype)
     else:
-        relu_prime_out = np.zeros(feature.shape)
+        relu_prime_out = np.zeros(feature.shape, dtype=feature.dtype)
 
         if len(feature.shape) > 2:
             for ch_num in range(feature.shape[-1]):
@@ -127,19 +151,27 @@ class Softmax(Activation):
     def __init__(self, *args, **kargs):
         super(Softmax, self).__init__()
 
+        # 反向传播直接返回delta误差
+        self.grad_alias = True
+
     def __call__(self, inputs, *args, **kwargs):
-        return self._forward_cpu(inputs)
+        return self._trace(inputs, self._forward_cpu(inputs))
 
     def backprop(self):
         return self._backprop_cpu()
 
+    def backward(self, delta):
+        return delta
+
     def _forward_cpu(self, z):
 
-        tmp = np.max(z)
-        z -= tmp  # 用于缩放每行的元素，避免溢出，有效
+        # 每个样本单独归一化，(N, classes, 1)按样本，单个样本(classes, 1)整体
+        # 否则分块推理时结果会随batch大小变化
+        axis = tuple(range(1, z.ndim)) if z.ndim > 2 else None
+
+        z = z - np.max(z, axis=axis, keepdims=True)  # 用于缩放每行的元素，避免溢出，有效
         z = np.exp(z)
-        tmp = np.sum(z)
-        z /= tmp
+        z /= np.sum(z, axis=axis, keepdims=True)
 
         return z
 
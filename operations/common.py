@@ -3,6 +3,8 @@
 # Author:Speciallan
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from taurus import backend
 from taurus import operations
 
 
@@ -13,21 +15,77 @@ class Flatten(operations.Operation):
         self.type = self.FLATTEN
         self.shape = None
 
+        # 只改变形状，前向反向都是视图
+        self.output_alias = True
+        self.grad_alias = True
+
+        # 拉直的顺序与FC权重对应，按NHWC展开
+        self.layout = 'NHWC'
+
     def __call__(self, inputs, *args, **kwargs):
 
         x = inputs
 
-        self.shape = x.shape
+        if self.caching:
+            self.shape = x.shape
 
         flatten = x.reshape(x.shape[0], x.shape[1] * x.shape[2] * x.shape[3], 1)
 
-        return flatten
+        return self._trace(inputs, flatten)
 
     def backprop(self, x):
 
         out = x.reshape(self.shape)
         return out
 
+    def release(self):
+        self.shape = None
+
+
+# 布局转换的轴顺序
+PERMUTATIONS = {
+    ('NHWC', 'NCHW'): (0, 3, 1, 2),
+    ('NCHW', 'NHWC'): (0, 2, 3, 1),
+}
+
+
+class Transpose(operations.Operation):
+    """内存布局转换，只在编译静态图时插入到布局不一致的两层之间，输出是连续数组"""
+
+    def __init__(self, src, dst):
+        super(Transpose, self).__init__()
+
+        self.src = src
+        self.dst = dst
+        self.name = '{}->{}'.format(src, dst)
+
+        self.layout = src
+        self.perm = PERMUTATIONS[(src, dst)]
+        self.inverse = tuple(np.argsort(self.perm))
+
+    def __call__(self, inputs, *args, **kwargs):
+
+        x = inputs.transpose(self.perm)
+        out = self._buffer('output', x.shape, x.dtype)
+        np.copyto(out, x)
+
+        return self._trace(inputs, out)
+
+    def backward(self, delta):
+
+        dx = delta.transpose(self.inverse)
+        out = self._buffer('dx', dx.shape, dx.dtype)
+        np.copyto(out, dx)
+
+        return out
+
+    def memory(self, input_shape, output_shape):
+
+        return [
+            ('output', output_shape, backend.floatx(), 'output'),
+            ('dx', input_shape, backend.floatx(), 'grad'),
+        ]
+
 
 def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
     """
@@ -51,7 +109,7 @@ def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
     # 填充 H,W
     img = np.pad(input_data, [(0, 0), (0, 0), (pad, pad), (pad, pad)], 'constant')
     # (N, C, filter_h, filter_w, out_h, out_w)的0矩阵
-    col = np.zeros((N, C, filter_h, filter_w, out_h, out_w))
+    col = np.zeros((N, C, filter_h, filter_w, out_h, out_w), dtype=input_data.dtype)
 
     for y in range(filter_h):
         y_max = y + stride * out_h
@@ -63,6 +121,148 @@ def im2col(input_data, filter_h, filter_w, stride=1, pad=0):
     return col
 
 
+def im2col_strided(input_data, filter_h, filter_w, stride=1, pad=0, out=None, padded=None, layout='NCHW', dilation=1):
+    """
+    im2col的步幅视图实现，结果与im2col一致
+
+    通过as_strided构造(N, out_h, out_w, C, filter_h, filter_w)的只读视图，
+    不分配6维临时数组，只在最后一步拷贝一次成GEMM需要的连续2维矩阵。
+    输入可以是任意strides的视图，layout='NHWC'时直接读取NHWC数据，不需要转置。
+
+    有填充且没有给padded时按虚拟填充处理：不拷贝填充后的输入，
+    卷积核每个位置只拷贝落在输入内的部分，落在填充上的部分直接写0
+
+    Parameters
+    ----------
+    input_data : 由(数据量, 通道, 高, 长)的4维数组构成的输入数据，layout='NHWC'时为(数据量, 高, 长, 通道)
+    filter_h : 卷积核的高
+    filter_w : 卷积核的长
+    stride : 步幅
+    pad : 填充，整数或 ((上, 下), (左, 右))
+    out : 可复用的输出缓存，形状为(N * out_h * out_w, C * filter_h * filter_w)
+    padded : 可复用的填充缓存，与输入的layout相同，高和长各加上两边的填充
+    layout : 输入的内存布局，'NCHW'或'NHWC'
+    dilation : 卷积核的膨胀率，卷积核相邻两个位置在输入上相隔dilation
+
+    Returns
+    -------
+    col : 2维数组 (N * out_h * out_w, C * filter_h * filter_w)，列顺序与layout无关
+    """
+    h, w, c = _axes(layout)
+    N, C, H, W = input_data.shape[0], input_data.shape[c], input_data.shape[h], input_data.shape[w]
+    (top, bottom), (left, right) = _pads(pad)
+    out_h = (H + top + bottom - dilation * (filter_h - 1) - 1) // stride + 1
+    out_w = (W + left + right - dilation * (filter_w - 1) - 1) // stride + 1
+
+    if out is None:
+        out = np.empty((N * out_h * out_w, C * filter_h * filter_w), dtype=input_data.dtype)
+
+    img = input_data
+    if top or bottom or left or right:
+
+        if padded is None:
+            return _im2col_virtual(input_data.transpose(0, h, w, c), filter_h, filter_w, stride, (top, left), dilation,
+                                   out.reshape(N, out_h, out_w, C, filter_h, filter_w))
+
+        pad_width = [(0, 0)] * 4
+        pad_width[h], pad_width[w] = (top, bottom), (left, right)
+
+        img = padded
+        img.fill(0)
+        img[tuple(slice(p, size - q) for (p, q), size in zip(pad_width, img.shape))] = input_data
+
+    strides = img.strides
+    patches = as_strided(img,
+                         shape=(N, out_h, out_w, C, filter_h, filter_w),
+                         strides=(strides[0], strides[h] * stride, strides[w] * stride, strides[c], strides[h] * dilation, strides[w] * dilation),
+                         writeable=False)
+
+    # 唯一的一次拷贝，直接得到GEMM布局
+    np.copyto(out.reshape(patches.shape), patches)
+    return out
+
+
+def _pads(pad):
+    """整数或 ((上, 下), (左, 右)) 统一为 ((上, 下), (左, 右))"""
+
+    if np.isscalar(pad):
+        return (pad, pad), (pad, pad)
+
+    return tuple(pad[0]), tuple(pad[1])
+
+
+def _valid(size, out_size, offset, stride):
+    """卷积核一个位置上，输入坐标 o * stride + offset 落在 [0, size) 内的输出范围 [lo, hi)"""
+
+    lo = min(max(-(offset // stride), 0), out_size)
+    hi = max(min((size - 1 - offset) // stride + 1, out_size), lo)
+
+    return lo, hi
+
+
+def _window(lo, hi, offset, stride):
+    """输出范围 [lo, hi) 在输入上对应的步幅切片"""
+    return slice(lo * stride + offset, (hi - 1) * stride + offset + 1, stride)
+
+
+def _im2col_virtual(img, filter_h, filter_w, stride, origin, dilation, col):
+    """虚拟填充的im2col，img为 (N, H, W, C) 视图，col为 (N, out_h, out_w, C, filter_h, filter_w) 视图
+
+    卷积核所有位置都落在输入内的中间部分，直接在输入上构造步幅视图；
+    四周的边框各自只把用到的几行、几列拷贝到一小块补0的缓存中再构造步幅视图，
+    不分配整个填充后输入大小的缓存
+    """
+
+    N, H, W, C = img.shape
+    out_h, out_w = col.shape[1:3]
+    top, left = origin
+    span_h, span_w = dilation * (filter_h - 1) + 1, dilation * (filter_w - 1) + 1
+
+    y0, y1 = _valid(H, out_h, -top, stride)[0], _valid(H, out_h, span_h - 1 - top, stride)[1]
+    x0, x1 = _valid(W, out_w, -left, stride)[0], _valid(W, out_w, span_w - 1 - left, stride)[1]
+
+    if y0 >= y1 or x0 >= x1:
+        y0 = y1 = x0 = x1 = 0
+
+    # 中间部分和上、下、左、右四条边框
+    for ya, yb, xa, xb in [(y0, y1, x0, x1), (0, y0, 0, out_w), (y1, out_h, 0, out_w), (y0, y1, 0, x0), (y0, y1, x1, out_w)]:
+
+        if ya >= yb or xa >= xb:
+            continue
+
+        # 该部分用到的输入范围，填充后的坐标 [ha, hb) x [wa, wb)
+        ha, hb = ya * stride, (yb - 1) * stride + span_h
+        wa, wb = xa * stride, (xb - 1) * stride + span_w
+
+        if ha >= top and hb <= top + H and wa >= left and wb <= left + W:
+            tile = img[:, ha - top:hb - top, wa - left:wb - left, :]
+        else:
+            tile = np.zeros((N, hb - ha, wb - wa, C), dtype=img.dtype)
+            ia, ib = max(ha, top), min(hb, top + H)
+            ja, jb = max(wa, left), min(wb, left + W)
+            if ia < ib and ja < jb:
+                tile[:, ia - ha:ib - ha, ja - wa:jb - wa, :] = img[:, ia - top:ib - top, ja - left:jb - left, :]
+
+        s0, s1, s2, s3 = tile.strides
+        col[:, ya:yb, xa:xb] = as_strided(tile,
+                                          shape=(N, yb - ya, xb - xa, C, filter_h, filter_w),
+                                          strides=(s0, s1 * stride, s2 * stride, s3, s1 * dilation, s2 * dilation),
+                                          writeable=False)
+
+    return col.reshape(N * out_h * out_w, -1)
+
+
+def _axes(layout):
+    """(高, 长, 通道) 所在的轴"""
+
+    if layout == 'NHWC':
+        return 1, 2, 3
+    if layout == 'NCHW':
+        return 2, 3, 1
+
+    raise ValueError('不支持的layout：{}'.format(layout))
+
+
 def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
 
     N, C, H, W = input_shape
@@ -70,7 +270,7 @@ def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
     out_w = (W + 2*pad - filter_w)//stride + 1
     col = col.reshape(N, out_h, out_w, C, filter_h, filter_w).transpose(0, 3, 4, 5, 1, 2)
 
-    img = np.zeros((N, C, H + 2*pad + stride - 1, W + 2*pad + stride - 1))
+    img = np.zeros((N, C, H + 2*pad + stride - 1, W + 2*pad + stride - 1), dtype=col.dtype)
     for y in range(filter_h):
         y_max = y + stride*out_h
         for x in range(filter_w):
@@ -78,3 +278,71 @@ def col2im(col, input_shape, filter_h, filter_w, stride=1, pad=0):
             img[:, :, y:y_max:stride, x:x_max:stride] += col[:, :, y, x, :, :]
 
     return img[:, :, pad:H + pad, pad:W + pad]
+
+
+def workspace(buffer, shape, dtype):
+    """复用工作区缓存，形状或类型变化时才重新分配"""
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def col2im_strided(col, input_shape, filter_h, filter_w, stride=1, pad=0, out=None, layout='NCHW', dilation=1):
+    """
+    col2im的视图实现，结果与col2im一致
+
+    col只做reshape得到(N, out_h, out_w, C, filter_h, filter_w)视图，不再转置拷贝，
+    按卷积核位置直接累加到(N, H, W, C)的输出中，输出与col的轴顺序一致，累加时不需要跨步转置访问。
+    填充是虚拟的，落在填充上的部分直接丢弃，不分配填充后大小的缓存。
+    步幅等于卷积核大小时窗口互不重叠，只需一次赋值，不需要累加。
+
+    Parameters
+    ----------
+    col : 2维数组 (N * out_h * out_w, C * filter_h * filter_w)
+    input_shape : 输入数据的形状，与layout一致
+    pad : 填充，整数或 ((上, 下), (左, 右))
+    out : 可复用的输出缓存，形状为(N, H, W, C)
+    layout : 输入的内存布局，'NCHW'或'NHWC'
+    dilation : 卷积核的膨胀率
+
+    Returns
+    -------
+    img : layout='NCHW'时为out的(N, C, H, W)转置视图，'NHWC'时为out，都不拷贝
+    """
+    h, w, c = _axes(layout)
+    N, C, H, W = input_shape[0], input_shape[c], input_shape[h], input_shape[w]
+    (top, bottom), (left, right) = _pads(pad)
+    out_h = (H + top + bottom - dilation * (filter_h - 1) - 1) // stride + 1
+    out_w = (W + left + right - dilation * (filter_w - 1) - 1) // stride + 1
+
+    col = col.reshape(N, out_h, out_w, C, filter_h, filter_w)
+    img = workspace(out, (N, H, W, C), col.dtype)
+
+    if stride == filter_h and stride == filter_w and dilation == 1 and not (top or bottom or left or right):
+
+        # 窗口不重叠，每个像素最多被一个窗口覆盖
+        if out_h * filter_h != H or out_w * filter_w != W:
+            img.fill(0)
+
+        s0, s1, s2, s3 = img.strides
+        blocks = as_strided(img,
+                            shape=(N, out_h, filter_h, out_w, filter_w, C),
+                            strides=(s0, s1 * filter_h, s1, s2 * filter_w, s2, s3))
+        blocks[...] = col.transpose(0, 1, 4, 2, 5, 3)
+
+    else:
+
+        img.fill(0)
+        for y in range(filter_h):
+            y_lo, y_hi = _valid(H, out_h, y * dilation - top, stride)
+            for x in range(filter_w):
+                x_lo, x_hi = _valid(W, out_w, x * dilation - left, stride)
+                if y_lo == y_hi or x_lo == x_hi:
+                    continue
+                img[:, _window(y_lo, y_hi, y * dilation - top, stride), _window(x_lo, x_hi, x * dilation - left, stride), :] \
+                    += col[:, y_lo:y_hi, x_lo:x_hi, :, y, x]
+
+    if layout == 'NHWC':
+        return img
+
+    return img.transpose(0, 3, 1, 2)
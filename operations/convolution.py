@@ -6,12 +6,25 @@ import sys
 import time
 
 import numpy as np
+from taurus import backend
 from taurus import operations
-from taurus.operations.common import im2col, col2im
+from taurus.operations.common import im2col_strided, col2im_strided
+from taurus.operations.winograd import WINOGRAD, WINOGRAD_M, winograd_shape, winograd_weights, winograd_forward, winograd_backward
+from taurus.operations.fft import fft_shape, fft_weights, fft_forward, fft_backward, fft_flops
+from taurus.operations.direct import direct_forward, direct_backward
+from taurus.operations.depthwise import depthwise_shapes, depthwise_forward, depthwise_backward
+from taurus.core.autotune import autotuner
 from taurus.core.layer import Layer
 from taurus.utils.spe import spe
 
 
+# algorithm='auto'时im2col矩阵允许的最大字节数，超过时改用FFT
+IM2COL_WORKSPACE_LIMIT = 256 * 1024 ** 2
+
+# FFT和小的复数GEMM受内存带宽限制，每次浮点运算的耗时按im2col的GEMM的倍数估计（实测约4倍）
+FFT_COST = 4.
+
+
 class Conv(operations.Operation):
 
     def __init__(self):
@@ -20,8 +33,30 @@ class Conv(operations.Operation):
 
 
 class Conv2D(Conv):
-
-    def __init__(self, filters, kernel_size=3, stride=1, padding='valid', biases=None, pad=0, activation=None, initializer='normal'):
+    """二维卷积，输入输出都是NHWC
+
+    padding 'valid'时四周各填充pad，'same'时按输入大小计算填充，输出大小为 ceil(输入大小 / stride)，
+            多出的一行、一列填充在下方和右方。填充是虚拟的，不拷贝填充后的输入
+    dilation 卷积核的膨胀率，大于1时只能使用im2col
+    groups 分组数，输入、输出通道各分成groups组，每组只和对应的输入通道卷积，计算量是普通卷积的 1 / groups，
+           卷积核为 (F, C / groups, k, k)，各组在一次批量GEMM（einsum）中计算，
+           groups等于输入通道数（逐通道卷积）时使用depthwise
+
+    algorithm 卷积的计算方法
+        'auto'     调优表中有该形状的结果时直接使用，否则按估算的计算量在im2col和fft中选择，im2col矩阵过大时使用fft
+        'tune'     第一次遇到一个输入形状时对各算法计时，选最快的，见core/autotune.py
+        'im2col'   按步幅视图展开成 (N * out_h * out_w, C * k * k) 的矩阵后一次GEMM
+        'winograd' Winograd F(2x2, 3x3) / F(2x2, 5x5)，只支持步幅1，乘法次数和中间数据都更少
+        'fft'      基于rfft2，计算量与卷积核大小无关，适合大卷积核和大图片
+        'direct'   卷积核每个位置一次GEMM并累加，不展开im2col矩阵
+        'depthwise' 只用于逐通道卷积，在输入的步幅视图上按通道einsum，不展开im2col矩阵
+    """
+
+    ALGORITHMS = ['auto', 'tune', 'im2col', 'winograd', 'fft', 'direct', 'depthwise']
+    PADDINGS = ['valid', 'same']
+
+    def __init__(self, filters, kernel_size=3, stride=1, padding='valid', biases=None, pad=0, activation=None, initializer='normal', algorithm='auto',
+                 dilation=1, groups=1):
         super(Conv2D, self).__init__()
 
         self.type = self.CONV
@@ -34,18 +69,54 @@ class Conv2D(Conv):
         self.weights = None
         self.biases = None
         self.pad = pad
+        self.dilation = dilation
+        self.groups = groups
 
         self.activation = activation
         self.initializer = initializer
 
+        if padding not in self.PADDINGS:
+            raise ValueError('不支持的填充方式：{}，可选{}'.format(padding, self.PADDINGS))
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('不支持的卷积算法：{}，可选{}'.format(algorithm, self.ALGORITHMS))
+        if algorithm == 'winograd' and (stride != 1 or kernel_size not in WINOGRAD):
+            raise ValueError('winograd只支持步幅1、卷积核大小为{}的卷积'.format(sorted(WINOGRAD)))
+        if algorithm in ['winograd', 'fft', 'direct'] and (dilation != 1 or groups != 1):
+            raise ValueError('dilation、groups大于1时只支持im2col算法')
+        if filters is not None and filters % groups != 0:
+            raise ValueError('卷积核数{}不能被groups={}整除'.format(filters, groups))
+
+        self.algorithm = algorithm
+
+        # 最近一次前向传播实际使用的算法，反向传播使用同一个
+        self.selected = None
+
         # 中间数据（backward时使用）
         self.x = None
         self.col = None
         self.col_W = None
 
-        # 权重和偏置参数的梯度
+        # winograd的输入变换和卷积核变换
+        self.V = None
+        self.U = None
+
+        # fft的输入和卷积核的频域表示
+        self.X = None
+        self.fft_weights = None
+
+        # direct填充后的输入
+        self.padded = None
+
+        # 最近一次前向传播的输入形状 (N, H, W, C)
+        self.x_shape = None
+
+        # 输入输出都是NHWC，静态图按各层的layout在需要时插入转置，见core/static_graph.py
+        self.layout = 'NHWC'
+
+        # 权重和偏置参数的梯度，初始化权重时预分配，反向传播时原地写入
         self.dW = None
         self.db = None
+        self.dout = None
 
         self.input = None
         self.delta = None
@@ -62,39 +133,262 @@ class Conv2D(Conv):
         else:
             x = inputs
 
+        # 统一为计算精度
+        x = backend.cast_to_floatx(x)
+
         # 初始化权重
         if not self.has_inited:
-
-            n, h, w, c = x.shape
-            self.in_channel = c
-            self.out_channel = self.filters
-
-            self.weights = np.zeros(shape=(self.out_channel, self.kernel_size, self.kernel_size, self.in_channel))
-            self.biases = np.zeros(shape=(self.out_channel, 1))
-
-            # 初始化
-            self._init_weights()
-            self.has_inited = True
+            self._init_params(x.shape[-1])
 
         if x.ndim == 3:
             x = np.expand_dims(x, axis=0)
 
-        self.input = x
+        if self.caching:
+            self.input = x
 
         out = self._forward_cpu(x)
 
-        return out
+        return self._trace(inputs, out)
+
+    def _init_params(self, channels):
+        """按输入通道数创建参数和梯度缓存"""
+
+        self._configure(channels)
+
+        self.weights = np.zeros(shape=(self.out_channel, self.kernel_size, self.kernel_size, self.in_channel), dtype=backend.floatx())
+        self.biases = np.zeros(shape=(self.out_channel, 1), dtype=backend.floatx())
+
+        # 初始化
+        self._init_weights()
+        self._init_grads()
+        self.has_inited = True
+
+    def _configure(self, channels):
+
+        if channels % self.groups != 0:
+            raise ValueError('输入通道数{}不能被groups={}整除'.format(channels, self.groups))
+
+        # 每组的输入通道数
+        self.in_channel = channels // self.groups
+        self.out_channel = self.filters
 
     def _init_weights(self):
 
         if self.initializer == 'normal':
-            self.weights = np.random.randn(self.out_channel, self.kernel_size, self.kernel_size, self.in_channel)
-            self.biases = np.random.randn(self.out_channel, 1)
+            self.weights = np.random.randn(self.out_channel, self.kernel_size, self.kernel_size, self.in_channel).astype(backend.floatx())
+            self.biases = np.random.randn(self.out_channel, 1).astype(backend.floatx())
 
         # 转换shape
         self.weights = self.weights.transpose(0, 3, 1, 2)
         self.biases = self.biases.transpose(1, 0)
 
+    def select_algorithm(self, input_shape):
+        """algorithm='auto'时按输入形状选择算法，否则返回algorithm"""
+
+        # 逐通道卷积
+        if self.groups != 1 and self.groups == input_shape[-1] and self.algorithm in ['auto', 'tune', 'depthwise']:
+            return 'depthwise'
+
+        if self.algorithm == 'depthwise':
+            raise ValueError('depthwise算法只支持groups等于输入通道数的逐通道卷积，当前输入{}，groups={}'.format(input_shape, self.groups))
+
+        # 上下、左右填充不同，有膨胀或分组时只有im2col支持
+        if self.dilation != 1 or self.groups != 1 or self._uniform_pad(input_shape) is None:
+            if self.algorithm not in ['auto', 'tune', 'im2col']:
+                raise ValueError('{}算法只支持四周相同的填充，当前输入{}的填充为{}'.format(
+                    self.algorithm, input_shape, (self._pads(input_shape[1]), self._pads(input_shape[2]))))
+            return 'im2col'
+
+        if self.algorithm == 'tune':
+            return autotuner.select(self, input_shape)
+
+        if self.algorithm != 'auto':
+            return self.algorithm
+
+        tuned = autotuner.lookup(self, input_shape)
+        if tuned is not None:
+            return tuned
+
+        N, H, W, C = input_shape
+        k = self.kernel_size
+        rows = N * self._out_size(H) * self._out_size(W)
+
+        im2col = 2. * rows * C * k * k * self.filters
+        col_bytes = rows * C * k * k * np.dtype(backend.floatx()).itemsize
+
+        if col_bytes > IM2COL_WORKSPACE_LIMIT or FFT_COST * fft_flops(input_shape, self.filters, k, self.stride, self._uniform_pad(input_shape)) < im2col:
+            return 'fft'
+
+        return 'im2col'
+
+    def config(self):
+        """构造参数，自动调优时按同样的配置新建一层计时，子类的构造参数不同时重写"""
+
+        return dict(filters=self.filters, kernel_size=self.kernel_size, stride=self.stride, padding=self.padding, pad=self.pad,
+                    activation=self.activation, initializer=self.initializer, algorithm=self.algorithm, dilation=self.dilation, groups=self.groups)
+
+    def candidates(self, input_shape):
+        """可用于当前配置和输入形状的具体算法，自动调优时逐个计时，与select_algorithm的限制一致"""
+
+        if self.dilation != 1 or self.groups != 1 or self._uniform_pad(input_shape) is None:
+            if self.groups != 1 and self.groups == input_shape[-1]:
+                return ['im2col', 'depthwise']
+            return ['im2col']
+
+        algorithms = ['im2col', 'fft', 'direct']
+
+        if self.stride == 1 and self.kernel_size in WINOGRAD:
+            algorithms.append('winograd')
+
+        return algorithms
+
+    def flops(self, input_shape):
+        """一次前向传播的浮点运算次数（乘、加各算一次），不含偏置"""
+
+        N, H, W, C = input_shape
+        return 2 * N * self._out_size(H) * self._out_size(W) * (C // self.groups) * self.kernel_size ** 2 * self.filters
+
+    def memory(self, input_shape, output_shape):
+
+        algorithm = self.select_algorithm(input_shape)
+
+        if algorithm == 'winograd':
+            return self._winograd_memory(input_shape, output_shape)
+
+        if algorithm == 'fft':
+            return self._fft_memory(input_shape, output_shape)
+
+        if algorithm == 'direct':
+            return self._direct_memory(input_shape, output_shape)
+
+        if algorithm == 'depthwise':
+            return self._depthwise_memory(input_shape, output_shape)
+
+        N, H, W, C = input_shape
+        _, out_h, out_w, FN = output_shape
+        K = C * self.kernel_size * self.kernel_size
+        rows = N * out_h * out_w
+
+        # 存储精度与计算精度不同时，保存的是col的副本
+        col_phase = 'saved' if backend.storagex() == backend.floatx() else 'forward'
+
+        buffers = [
+            ('col', (rows, K), backend.floatx(), col_phase),
+            ('gemm', (rows, FN), backend.floatx(), 'output'),
+            ('dcol', (rows, K), backend.floatx(), 'backward'),
+            ('dx', input_shape, backend.floatx(), 'grad'),
+        ]
+
+        return buffers
+
+    def _winograd_memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        FN = output_shape[-1]
+        out_h, out_w, tiles_h, tiles_w, n = winograd_shape(input_shape, self.kernel_size, self._uniform_pad(input_shape))
+        P = N * tiles_h * tiles_w
+        m = WINOGRAD_M
+        padded = (N, tiles_h * m + n - m, tiles_w * m + n - m, C)
+
+        buffers = [
+            ('padded', padded, 'forward'),
+            ('U', (n * n, C, FN), 'saved'),
+            ('V', (n * n, P, C), 'saved'),
+            ('D', (n * n, P, C), 'forward'),
+            ('M', (n * n, P, FN), 'forward'),
+            ('Y1', (m * n, P, FN), 'forward'),
+            ('Y', (m * m, P, FN), 'forward'),
+            ('dY', (m * m, P, FN), 'backward'),
+            ('dY1', (n * m, P, FN), 'backward'),
+            ('Z', (n * n, P, FN), 'backward'),
+            ('dV', (n * n, P, C), 'backward'),
+            ('dD', (n * n, P, C), 'backward'),
+            ('dx', padded, 'grad'),
+        ]
+
+        # 输出正好分成整数个块时直接作为输出，否则裁剪后拷贝到gemm
+        if tiles_h * m == out_h and tiles_w * m == out_w:
+            buffers.append(('tiles', (N, out_h, out_w, FN), 'output'))
+        else:
+            buffers.append(('tiles', (N, tiles_h * m, tiles_w * m, FN), 'forward'))
+            buffers.append(('gemm', (N * out_h * out_w, FN), 'output'))
+
+        return [(name, shape, backend.floatx(), phase) for name, shape, phase in buffers]
+
+    def _fft_memory(self, input_shape, output_shape):
+        """频域的中间数据由numpy.fft分配，不参与规划"""
+
+        N, H, W, C = input_shape
+        _, out_h, out_w, FN = output_shape
+
+        buffers = [
+            ('gemm', (N * out_h * out_w, FN), backend.floatx(), 'output'),
+            ('dx', input_shape, backend.floatx(), 'grad'),
+        ]
+
+        pad = self._uniform_pad(input_shape)
+        if pad > 0:
+            buffers.append(('padded', (N, H + 2 * pad, W + 2 * pad, C), backend.floatx(), 'forward'))
+
+        return buffers
+
+    def _direct_memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        _, out_h, out_w, FN = output_shape
+        rows = N * out_h * out_w
+        pad = self._uniform_pad(input_shape)
+        padded = (N, H + 2 * pad, W + 2 * pad, C)
+
+        buffers = [
+            ('window', (rows, C), 'forward'),
+            ('product', (rows, FN), 'forward'),
+            ('gemm', (rows, FN), 'output'),
+            ('dwindow', (rows, C), 'backward'),
+            ('dx', padded, 'grad'),
+        ]
+
+        # 反向传播时从填充后的输入重新取窗口
+        if pad > 0:
+            buffers.append(('padded', padded, 'saved'))
+
+        return [(name, shape, backend.floatx(), phase) for name, shape, phase in buffers]
+
+    def _depthwise_memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        FN = output_shape[-1]
+        padded, out_h, out_w, full = depthwise_shapes(input_shape, FN, self.kernel_size, self.stride, (self._pads(H), self._pads(W)), self.dilation)
+
+        buffers = [
+            ('padded', padded, 'saved'),
+            ('gemm', (N * out_h * out_w, FN), 'output'),
+            ('full', full, 'backward'),
+            ('dx', input_shape, 'grad'),
+        ]
+
+        return [(name, shape, backend.floatx(), phase) for name, shape, phase in buffers]
+
+    def release(self):
+
+        self.x = None
+        self.col = None
+        self.col_W = None
+        self.V = None
+        self.U = None
+        self.X = None
+        self.fft_weights = None
+        self.padded = None
+        self.dout = None
+        self.input = None
+        self.delta = None
+
+    def _init_grads(self):
+
+        # 梯度缓存与参数同形状，内存只和参数量有关，与batch大小无关
+        self.dW = np.zeros(self.weights.shape, dtype=self.weights.dtype)
+        self.db = np.zeros(self.biases.shape, dtype=self.biases.dtype)
+
     def backprop(self, delta):
 
         # 保存反向传播的输出
@@ -105,7 +399,34 @@ class Conv2D(Conv):
 
         return out
 
-    def cal_prime(self):
+    def cal_prime(self, per_sample=False):
+        """计算卷积核和偏置的梯度，直接使用_backprop_cpu中GEMM的结果
+        默认返回整个batch求和后的梯度 (F, FH, FW, C) (F, 1)
+        per_sample=True时返回每个样本的梯度 (N, F, FH, FW, C) (N, F, 1)"""
+
+        if not per_sample:
+            nabla_w = self.dW.transpose(0, 2, 3, 1)
+            nabla_b = self.db.reshape(-1, 1)
+            return nabla_w, nabla_b
+
+        if self.selected != 'im2col' or self.groups != 1:
+            raise ValueError('逐样本的梯度只支持不分组的im2col算法')
+
+        FN, C, FH, FW = self.weights.shape
+        N = self.x.shape[0]
+
+        # (N, out_h * out_w, F) 和 (N, out_h * out_w, C * FH * FW) 批量矩阵乘
+        dout = self.dout.reshape(N, -1, FN)
+        col = backend.from_storage(self.col).reshape(N, -1, C * FH * FW)
+
+        nabla_w = np.matmul(dout.transpose(0, 2, 1), col)
+        nabla_w = nabla_w.reshape(N, FN, C, FH, FW).transpose(0, 1, 3, 4, 2)
+        nabla_b = np.sum(dout, axis=1).reshape(N, FN, 1)
+
+        return nabla_w, nabla_b
+
+    def _cal_prime_backup(self):
+        """逐个样本循环计算梯度，作为参考实现"""
 
         nabla_w, nabla_b = [], []
 
@@ -121,44 +442,170 @@ class Conv2D(Conv):
 
         # print('w', self.weights.shape, 'b', self.biases.shape)
 
+        out = self._convolve(x)
+        out += self.biases
+
+        # (N * out_h * out_w, FN) 的行顺序就是NHWC
+        N, H, W, C = self.x_shape
+        return out.reshape(N, self._out_size(H), self._out_size(W), -1)
+
+    def _pads(self, size):
+        """输入一个方向的大小为size时，该方向两边的填充 (前, 后)"""
+
+        if self.padding == 'same':
+            span = self.dilation * (self.kernel_size - 1) + 1
+            total = max((-(-size // self.stride) - 1) * self.stride + span - size, 0)
+            return total // 2, total - total // 2
+
+        return self.pad, self.pad
+
+    def _uniform_pad(self, input_shape):
+        """四周的填充相同时返回填充大小，否则返回None"""
+
+        pads = set(self._pads(input_shape[1]) + self._pads(input_shape[2]))
+        return pads.pop() if len(pads) == 1 else None
+
+    def _out_size(self, size):
+        before, after = self._pads(size)
+        return 1 + (size + before + after - self.dilation * (self.kernel_size - 1) - 1) // self.stride
+
+    def _convolve(self, x):
+        """按algorithm计算卷积，返回不加偏置的 (N * out_h * out_w, FN)，融合算子在此基础上继续计算"""
+
         if x.ndim == 3:
             x = np.expand_dims(x, axis=0)
 
-        x = x.transpose(0, 3, 1, 2)
+        self.x_shape = x.shape
+        self.selected = self.select_algorithm(x.shape)
+
+        if self.selected == 'winograd':
+            return self._winograd(x)
+
+        if self.selected == 'fft':
+            return self._fft(x)
+
+        if self.selected == 'direct':
+            return self._direct(x)
+
+        if self.selected == 'depthwise':
+            return self._depthwise(x)
+
+        return self._gemm(x)
+
+    def _gemm(self, x):
+        """im2col + GEMM"""
 
-        # (1,1,32,32) (6,1,5,5)
+        # (1,32,32,1) (6,1,5,5)
         # spe(x.shape, self.weights.shape)
 
         # 卷积核大小
         FN, C, FH, FW = self.weights.shape
 
-        # 数据数据大小
-        N, C, H, W = x.shape
+        # 数据数据大小，直接使用NHWC，im2col按strides读取，不转置
+        N, H, W, C = x.shape
         # print(x.shape, self.weights.shape)
 
         # 计算输出数据大小
-        out_h = 1 + int((H + 2 * self.pad - FH) / self.stride)
-        out_w = 1 + int((W + 2 * self.pad - FW) / self.stride)
+        out_h = self._out_size(H)
+        out_w = self._out_size(W)
 
-        # 利用im2col转换为行
+        # 利用im2col转换为行，写入规划好的缓存，填充是虚拟的
         # print(x.shape, self.weights.shape)
-        col = im2col(x, FH, FW, self.stride, self.pad)
+        col = im2col_strided(x, FH, FW, self.stride, (self._pads(H), self._pads(W)),
+                             out=self._buffer('col', (N * out_h * out_w, C * FH * FW), x.dtype), layout=self.layout, dilation=self.dilation)
 
         # 卷积核转换为列，展开为2维数组
         col_W = self.weights.reshape(FN, -1).T
 
         # 计算正向传播
         # print(col.shape, col_W.shape, self.biases.shape)
-        out = np.dot(col, col_W) + self.biases
-        # print(out.shape)
-        out = out.reshape(N, out_h, out_w, -1).transpose(0, 3, 1, 2)
-        # print(out.shape)
+        out = self._buffer('gemm', (N * out_h * out_w, FN), x.dtype)
+        if self.groups == 1:
+            np.dot(col, col_W, out=out)
+        else:
+            group_dot(col, self.weights, self.groups, out)
+
+        if self.caching:
+            self.x = x
+            self.col = backend.to_storage(col)
+            self.col_W = col_W
+
+        return out
+
+    def _winograd(self, x):
+        """Winograd卷积，见operations/winograd.py"""
+
+        FN, C, FH, FW = self.weights.shape
+        N, H, W, C = x.shape
+
+        pad = self._uniform_pad(x.shape)
+        out_h, out_w, tiles_h, tiles_w, n = winograd_shape(x.shape, self.kernel_size, pad)
+        m = WINOGRAD_M
+
+        U = winograd_weights(self.weights, out=self._buffer('U', (n * n, C, FN), x.dtype))
+
+        out, V = winograd_forward(x, U, self.kernel_size, pad, buffer=lambda name, shape: self._buffer(name, shape, x.dtype))
+
+        if self.caching:
+            self.x = x
+            self.U = U
+            self.V = V
+
+        # 裁掉补齐块多出来的部分
+        if tiles_h * m != out_h or tiles_w * m != out_w:
+            gemm = self._buffer('gemm', (N * out_h * out_w, FN), x.dtype)
+            np.copyto(gemm.reshape(N, out_h, out_w, FN), out[:, :out_h, :out_w, :])
+            out = gemm
+
+        return out.reshape(N * out_h * out_w, FN)
+
+    def _fft(self, x):
+        """FFT卷积，见operations/fft.py"""
+
+        FN = self.weights.shape[0]
+        N, H, W, C = x.shape
+        pad = self._uniform_pad(x.shape)
+        out_h, out_w, full_h, full_w, Hp, Wp = fft_shape(x.shape, self.kernel_size, self.stride, pad)
 
-        self.x = x
-        self.col = col
-        self.col_W = col_W
+        # 卷积核的频域表示在前向、反向传播中共用
+        Wf = fft_weights(self.weights, (Hp, Wp))
 
-        out = out.transpose(0, 2, 3, 1)
+        out = self._buffer('gemm', (N * out_h * out_w, FN), x.dtype)
+        padded = self._buffer('padded', (N, Hp, Wp, C), x.dtype) if pad > 0 else None
+        _, X = fft_forward(x, Wf, self.kernel_size, self.stride, pad, padded=padded, out=out.reshape(N, out_h, out_w, FN))
+
+        if self.caching:
+            self.x = x
+            self.X = X
+            self.fft_weights = Wf
+
+        return out
+
+    def _direct(self, x):
+        """直接卷积，见operations/direct.py"""
+
+        out, padded = direct_forward(x, self.weights, self.stride, self._uniform_pad(x.shape), buffer=lambda name, shape: self._buffer(name, shape, x.dtype))
+
+        if self.caching:
+            self.x = x
+            self.padded = padded
+
+        return out
+
+    def _depthwise(self, x):
+        """逐通道卷积，见operations/depthwise.py，填充后的输入总是拷贝一份，反向传播时从中取窗口"""
+
+        N, H, W, C = x.shape
+        FN = self.weights.shape[0]
+        pads = (self._pads(H), self._pads(W))
+        padded, out_h, out_w = depthwise_shapes(x.shape, FN, self.kernel_size, self.stride, pads, self.dilation)[:3]
+
+        out, padded = depthwise_forward(x, self.weights, self.stride, pads, self.dilation, padded=self._buffer('padded', padded, x.dtype),
+                                        out=self._buffer('gemm', (N * out_h * out_w, FN), x.dtype))
+
+        if self.caching:
+            self.x = x
+            self.padded = padded
 
         return out
 
@@ -168,24 +615,94 @@ class Conv2D(Conv):
         if dout.ndim == 3:
             dout = np.expand_dims(dout, axis=0)
 
-        dout = dout.transpose(0, 3, 1, 2)
-
         # 卷积核大小
         FN, C, FH, FW = self.weights.shape
-        # dout = dout.transpose(0, 2, 3, 1).reshape(-1, FN)
-        dout = dout.reshape(-1, FN)
 
-        self.db = np.sum(dout, axis=0)
-        self.dW = np.dot(self.col.T, dout)
-        self.dW = self.dW.transpose(1, 0).reshape(FN, C, FH, FW)
+        # dout是NHWC，展开后每行对应一个输出像素，与col的行顺序一致
+        dout = backend.cast_to_floatx(dout).reshape(-1, FN)
+        self.dout = dout
+
+        if self.selected == 'winograd':
+            return self._winograd_backprop(dout)
 
-        dcol = np.dot(dout, self.col_W.T)
+        if self.selected == 'fft':
+            return self._fft_backprop(dout)
 
-        # 逆转换
-        dx = col2im(dcol, self.x.shape, FH, FW, self.stride, self.pad)
+        if self.selected == 'direct':
+            return self._direct_backprop(dout)
 
-        # (1,6,14,14) -> (1,14,14,6)
-        dx = dx.transpose(0, 2, 3, 1)
+        if self.selected == 'depthwise':
+            return self._depthwise_backprop(dout)
+
+        # 一次GEMM完成整个batch梯度的累加，直接写入梯度缓存
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+        dcol = self._buffer('dcol', self.col.shape, dout.dtype)
+
+        if self.groups == 1:
+            np.dot(dout.T, backend.from_storage(self.col), out=self.dW.reshape(FN, -1))
+            np.dot(dout, self.col_W.T, out=dcol)
+        else:
+            group_dot_backward(dout, backend.from_storage(self.col), self.weights, self.groups, self.dW, dcol)
+
+        # 逆转换，直接得到NHWC
+        N, H, W, C = self.x.shape
+        dx = col2im_strided(dcol, self.x.shape, FH, FW, self.stride, (self._pads(H), self._pads(W)),
+                            out=self._buffer('dx', self.x.shape, dcol.dtype), layout=self.layout, dilation=self.dilation)
+
+        return dx
+
+    def _winograd_backprop(self, dout):
+
+        FN = dout.shape[1]
+        N = self.x.shape[0]
+        pad = self._uniform_pad(self.x.shape)
+        out_h, out_w = winograd_shape(self.x.shape, self.kernel_size, pad)[:2]
+
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+
+        dx, dW = winograd_backward(dout.reshape(N, out_h, out_w, FN), self.V, self.U, self.kernel_size, self.x.shape, pad,
+                                   buffer=lambda name, shape: self._buffer(name, shape, dout.dtype))
+        self.dW[...] = dW
+
+        return dx
+
+    def _fft_backprop(self, dout):
+
+        FN = dout.shape[1]
+        N = self.x.shape[0]
+        pad = self._uniform_pad(self.x.shape)
+        out_h, out_w = fft_shape(self.x.shape, self.kernel_size, self.stride, pad)[:2]
+
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+
+        dx, dW = fft_backward(dout.reshape(N, out_h, out_w, FN), self.X, self.fft_weights, self.kernel_size, self.x.shape,
+                              self.stride, pad, dx=self._buffer('dx', self.x.shape, dout.dtype))
+        self.dW[...] = dW
+
+        return dx
+
+    def _direct_backprop(self, dout):
+
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+
+        dx, dW = direct_backward(dout, self.padded, self.weights, self.x.shape, self.stride, self._uniform_pad(self.x.shape),
+                                 buffer=lambda name, shape: self._buffer(name, shape, dout.dtype))
+        self.dW[...] = dW
+
+        return dx
+
+    def _depthwise_backprop(self, dout):
+
+        N, H, W, C = self.x.shape
+        FN = dout.shape[1]
+        pads = (self._pads(H), self._pads(W))
+        full = depthwise_shapes(self.x.shape, FN, self.kernel_size, self.stride, pads, self.dilation)[3]
+
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+
+        dx, dW = depthwise_backward(dout, self.padded, self.weights, self.x.shape, self.stride, pads, self.dilation,
+                                    full=self._buffer('full', full, dout.dtype), dx=self._buffer('dx', self.x.shape, dout.dtype))
+        self.dW[...] = dW
 
         return dx
 
@@ -240,13 +757,228 @@ class Conv2D(Conv):
 
         return img_out
 
+class DepthwiseConv2D(Conv2D):
+    """逐通道卷积，每个输入通道用自己的depth_multiplier个卷积核，输出 C * depth_multiplier 个通道
+
+    相当于groups=C的分组卷积，输入通道数在第一次前向传播时确定，默认使用depthwise算法，algorithm='im2col'时按分组GEMM计算
+    """
+
+    def __init__(self, kernel_size=3, stride=1, padding='valid', pad=0, depth_multiplier=1, activation=None, initializer='normal', dilation=1,
+                 algorithm='auto'):
+        super(DepthwiseConv2D, self).__init__(None, kernel_size, stride, padding, pad=pad, activation=activation, initializer=initializer,
+                                              algorithm=algorithm, dilation=dilation)
+
+        self.depth_multiplier = depth_multiplier
+
+    def config(self):
+
+        return dict(kernel_size=self.kernel_size, stride=self.stride, padding=self.padding, pad=self.pad, depth_multiplier=self.depth_multiplier,
+                    activation=self.activation, initializer=self.initializer, dilation=self.dilation, algorithm=self.algorithm)
+
+    def candidates(self, input_shape):
+
+        # 只有一个输入通道时就是普通卷积
+        if input_shape[-1] == 1:
+            return super(DepthwiseConv2D, self).candidates(input_shape)
+
+        return ['im2col', 'depthwise']
+
+    def _configure(self, channels):
+
+        self.groups = channels
+        self.filters = channels * self.depth_multiplier
+
+        super(DepthwiseConv2D, self)._configure(channels)
+
+    def flops(self, input_shape):
+
+        N, H, W, C = input_shape
+        return 2 * N * self._out_size(H) * self._out_size(W) * self.kernel_size ** 2 * C * self.depth_multiplier
+
+
+class SeparableConv2D(Conv2D):
+    """深度可分离卷积，逐通道卷积后接1x1的逐点卷积和偏置
+
+    逐通道卷积由内部的DepthwiseConv2D计算（不加偏置），其输出 (N * out_h * out_w, C * depth_multiplier)
+    直接作为逐点卷积GEMM的输入。weights是逐点卷积的卷积核 (F, C * depth_multiplier, 1, 1)，
+    逐通道卷积的卷积核和梯度在depthwise层中，都放入模型的参数内存池，见parameters。
+    计算量约为普通卷积的 1 / F + 1 / (k * k)
+
+    algorithm 逐通道卷积使用的算法，逐点卷积总是一次GEMM
+    """
+
+    def __init__(self, filters, kernel_size=3, stride=1, padding='valid', pad=0, depth_multiplier=1, activation=None, initializer='normal', dilation=1,
+                 algorithm='auto'):
+        super(SeparableConv2D, self).__init__(filters, kernel_size, stride, padding, pad=pad, activation=activation, initializer=initializer,
+                                              algorithm='im2col', dilation=dilation)
+
+        self.depth_multiplier = depth_multiplier
+        self.depthwise = DepthwiseConv2D(kernel_size, stride, padding, pad=pad, depth_multiplier=depth_multiplier, initializer=initializer, dilation=dilation,
+                                         algorithm=algorithm)
+
+        # 逐通道卷积的输出，逐点卷积求卷积核梯度时使用
+        self.mid = None
+
+    def parameters(self):
+        return self.depthwise.parameters()[:1] + super(SeparableConv2D, self).parameters()
+
+    def _init_params(self, channels):
+
+        self.depthwise._init_params(channels)
+
+        mid = channels * self.depth_multiplier
+        self.in_channel = mid
+        self.out_channel = self.filters
+
+        self.weights = np.random.randn(self.filters, mid, 1, 1).astype(backend.floatx())
+        self.biases = np.random.randn(1, self.filters).astype(backend.floatx())
+
+        self._init_grads()
+        self.has_inited = True
+
+    def select_algorithm(self, input_shape):
+        return 'im2col'
+
+    def config(self):
+
+        return dict(filters=self.filters, kernel_size=self.kernel_size, stride=self.stride, padding=self.padding, pad=self.pad,
+                    depth_multiplier=self.depth_multiplier, activation=self.activation, initializer=self.initializer, dilation=self.dilation,
+                    algorithm=self.depthwise.algorithm)
+
+    def candidates(self, input_shape):
+        return self.depthwise.candidates(input_shape)
+
+    def flops(self, input_shape):
+
+        N, H, W, C = input_shape
+        rows = N * self._out_size(H) * self._out_size(W)
+
+        return self.depthwise.flops(input_shape) + 2 * rows * C * self.depth_multiplier * self.filters
+
+    def cal_prime(self, per_sample=False):
+
+        if per_sample:
+            raise ValueError('深度可分离卷积不支持逐样本的梯度')
+
+        return super(SeparableConv2D, self).cal_prime()
+
+    def _convolve(self, x):
+
+        if x.ndim == 3:
+            x = np.expand_dims(x, axis=0)
+
+        self.x_shape = x.shape
+        self.selected = 'im2col'
+
+        # 逐通道卷积的训练/推理模式跟随本层
+        self.depthwise.training = self.training
+        mid = self.depthwise._convolve(x)
+
+        out = np.dot(mid, self.weights.reshape(self.filters, -1).T, out=self._buffer('gemm', (mid.shape[0], self.filters), x.dtype))
+
+        if self.caching:
+            self.mid = mid
+
+        return out
+
+    def _backprop_cpu(self, dout):
+
+        if dout.ndim == 3:
+            dout = np.expand_dims(dout, axis=0)
+
+        dout = backend.cast_to_floatx(dout).reshape(-1, self.filters)
+        self.dout = dout
+
+        # 逐点卷积
+        np.sum(dout, axis=0, out=self.db.reshape(-1))
+        np.dot(dout.T, self.mid, out=self.dW.reshape(self.filters, -1))
+        dmid = np.dot(dout, self.weights.reshape(self.filters, -1), out=self._buffer('dmid', self.mid.shape, dout.dtype))
+
+        # 逐通道卷积，偏置没有使用，其梯度不进入参数内存池
+        return self.depthwise._backprop_cpu(dmid)
+
+    def memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        _, out_h, out_w, FN = output_shape
+        mid_shape = (N, out_h, out_w, C * self.depth_multiplier)
+        rows = N * out_h * out_w
+
+        buffers = []
+        for name, shape, dtype, phase in self.depthwise.memory(input_shape, mid_shape):
+
+            # 逐通道卷积的输出要保留到逐点卷积的反向传播
+            if phase == 'output':
+                phase = 'saved'
+
+            buffers.append((name, shape, dtype, phase, self.depthwise))
+
+        buffers += [
+            ('gemm', (rows, FN), backend.floatx(), 'output'),
+            ('dmid', (rows, mid_shape[-1]), backend.floatx(), 'backward'),
+        ]
+
+        return buffers
+
+    def release(self):
+
+        super(SeparableConv2D, self).release()
+
+        self.depthwise.release()
+        self.mid = None
+
+
+def group_dot(col, weights, groups, out):
+    """分组卷积的GEMM，col (rows, C * k * k) 的列按通道分组，weights (F, C / groups, k, k)
+
+    每组输出通道只使用同组的列，所有组在一次einsum / 批量matmul中计算，不按组循环。
+    每组只有一个卷积核（逐通道卷积）时einsum直接按通道乘加，否则按组批量GEMM
+    """
+
+    rows = col.shape[0]
+    FN = weights.shape[0]
+
+    col = col.reshape(rows, groups, -1)
+    weights = weights.reshape(groups, FN // groups, -1)
+    out3 = out.reshape(rows, groups, FN // groups)
+
+    if weights.shape[1] == 1:
+        np.einsum('rgk,gk->rg', col, weights[:, 0], out=out3[:, :, 0])
+    else:
+        np.matmul(col.transpose(1, 0, 2), weights.transpose(0, 2, 1), out=out3.transpose(1, 0, 2))
+
+    return out
+
+
+def group_dot_backward(dout, col, weights, groups, dW, dcol):
+    """group_dot的反向传播，卷积核梯度写入dW (F, C / groups, k, k)，col的梯度写入dcol (rows, C * k * k)"""
+
+    rows = col.shape[0]
+    FN = weights.shape[0]
+
+    dout = dout.reshape(rows, groups, FN // groups)
+    col = col.reshape(rows, groups, -1)
+    weights = weights.reshape(groups, FN // groups, -1)
+    dW = dW.reshape(weights.shape)
+    dcol3 = dcol.reshape(col.shape)
+
+    if weights.shape[1] == 1:
+        np.einsum('rg,rgk->gk', dout[:, :, 0], col, out=dW[:, 0])
+        np.einsum('rg,gk->rgk', dout[:, :, 0], weights[:, 0], out=dcol3)
+    else:
+        np.matmul(dout.transpose(1, 2, 0), col.transpose(1, 0, 2), out=dW)
+        np.matmul(dout.transpose(1, 0, 2), weights, out=dcol3.transpose(1, 0, 2))
+
+    return dcol
+
+
 def padding(image, zero_num):
     if len(image.shape) == 4:
         image_padding = np.zeros(
-            (image.shape[0], image.shape[1] + 2 * zero_num, image.shape[2] + 2 * zero_num, image.shape[3]))
+            (image.shape[0], image.shape[1] + 2 * zero_num, image.shape[2] + 2 * zero_num, image.shape[3]), dtype=image.dtype)
         image_padding[:, zero_num:image.shape[1] + zero_num, zero_num:image.shape[2] + zero_num, :] = image
     elif len(image.shape) == 3:
-        image_padding = np.zeros((image.shape[0] + 2 * zero_num, image.shape[1] + 2 * zero_num, image.shape[2]))
+        image_padding = np.zeros((image.shape[0] + 2 * zero_num, image.shape[1] + 2 * zero_num, image.shape[2]), dtype=image.dtype)
         image_padding[zero_num:image.shape[0] + zero_num, zero_num:image.shape[1] + zero_num, :] = image
     else:
         print("维度错误")
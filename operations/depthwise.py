@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def depthwise_windows(x, kernel_size, stride=1, dilation=1, size=None):
+    """NHWC输入上卷积核每个位置的步幅视图 (k, k, N, out_h, out_w, C, ...)，不拷贝数据
+
+    x 可以有通道之后的维度（depth_multiplier），size为 (out_h, out_w)
+    """
+
+    strides = x.strides
+    shape = (kernel_size, kernel_size, x.shape[0]) + tuple(size) + x.shape[3:]
+
+    return as_strided(x, shape=shape, strides=(strides[1] * dilation, strides[2] * dilation, strides[0],
+                                               strides[1] * stride, strides[2] * stride) + strides[3:], writeable=False)
+
+
+def depthwise_forward(x, weights, stride=1, pads=((0, 0), (0, 0)), dilation=1, padded=None, out=None):
+    """逐通道卷积，每个通道只和自己的depth_multiplier个卷积核相关
+
+    在填充后输入的步幅视图 (k, k, N, out_h, out_w, C) 上按通道einsum，
+    不展开k * k倍的im2col矩阵，也不按通道或分组循环
+
+    Parameters
+    ----------
+    x : NHWC输入 (N, H, W, C)
+    weights : 卷积核 (C * m, 1, k, k)，第c个通道的卷积核为 c * m 到 c * m + m - 1
+    pads : ((上, 下), (左, 右))
+    padded : 可复用的填充缓存 (N, H + 上 + 下, W + 左 + 右, C)，反向传播时从中重新取窗口
+    out : 可复用的输出缓存 (N * out_h * out_w, C * m)
+
+    Returns
+    -------
+    out : (N * out_h * out_w, C * m)
+    padded : 填充后的输入
+    """
+
+    (top, bottom), (left, right) = pads
+    N, H, W, C = x.shape
+    FN, _, k, _ = weights.shape
+    m = FN // C
+
+    padded_shape, out_h, out_w = depthwise_shapes(x.shape, FN, k, stride, pads, dilation)[:3]
+
+    if padded is None:
+        padded = np.empty(padded_shape, dtype=x.dtype)
+    if top or bottom or left or right:
+        padded.fill(0)
+    padded[:, top:top + H, left:left + W, :] = x
+
+    if out is None:
+        out = np.empty((N * out_h * out_w, FN), dtype=x.dtype)
+
+    windows = depthwise_windows(padded, k, stride, dilation, (out_h, out_w))
+
+    # (m, k, k, C)，einsum的操作数不连续时会慢数倍
+    kernels = np.ascontiguousarray(weights.reshape(C, m, k, k).transpose(1, 2, 3, 0))
+    out5 = out.reshape(N, out_h, out_w, C, m)
+
+    for i in range(m):
+        np.einsum('ijnhwc,ijc->nhwc', windows, kernels[i], out=out5[..., i])
+
+    return out, padded
+
+
+def depthwise_backward(dout, padded, weights, input_shape, stride=1, pads=((0, 0), (0, 0)), dilation=1, full=None, dx=None):
+    """depthwise_forward的反向传播
+
+    dW 是delta误差与输入窗口按通道的乘积对 N、out_h、out_w 求和
+    dx 是按步幅插0并四周补 (k - 1) * dilation 后的delta误差与翻转卷积核的相关，
+       同样在步幅视图上一次einsum，对卷积核位置和depth_multiplier求和
+
+    Parameters
+    ----------
+    dout : delta误差 (N * out_h * out_w, C * m)
+    padded : depthwise_forward返回的填充后的输入
+    input_shape : 输入的形状 (N, H, W, C)
+    full : 可复用的缓存，插0补齐后的delta误差，形状见depthwise_shapes
+    dx : 可复用的输入梯度缓存 (N, H, W, C)
+
+    Returns
+    -------
+    dx : (N, H, W, C)
+    dW : (C * m, 1, k, k)
+    """
+
+    (top, bottom), (left, right) = pads
+    N, H, W, C = input_shape
+    FN, _, k, _ = weights.shape
+    m = FN // C
+    out_h, out_w, full_shape = depthwise_shapes(input_shape, FN, k, stride, pads, dilation)[1:]
+
+    dout5 = dout.reshape(N, out_h, out_w, C, m)
+
+    # 卷积核的梯度 (k, k, C, m)
+    windows = depthwise_windows(padded, k, stride, dilation, (out_h, out_w))
+    dW = np.einsum('nhwcm,ijnhwc->ijcm', dout5, windows)
+
+    # delta误差按步幅插0，四周补 (k - 1) * dilation
+    if full is None:
+        full = np.empty(full_shape, dtype=dout.dtype)
+    e = (k - 1) * dilation
+    full.fill(0)
+    full5 = full.reshape(full_shape[:3] + (C, m))
+    full5[:, e:e + (out_h - 1) * stride + 1:stride, e:e + (out_w - 1) * stride + 1:stride] = dout5
+
+    # 填充后第y行的梯度只来自 y < (out_h - 1) * stride + 1 + e 的行，只计算去掉填充后的部分，其余为0
+    rows = max(0, min(H, full_shape[1] - e - top))
+    cols = max(0, min(W, full_shape[2] - e - left))
+
+    if dx is None:
+        dx = np.empty(input_shape, dtype=dout.dtype)
+    if rows < H or cols < W:
+        dx.fill(0)
+
+    kernels = np.ascontiguousarray(weights.reshape(C, m, k, k).transpose(2, 3, 0, 1)[::-1, ::-1])
+    windows = depthwise_windows(full5[:, top:, left:], k, 1, dilation, (rows, cols))
+    np.einsum('ijnhwcm,ijcm->nhwc', windows, kernels, out=dx[:, :rows, :cols])
+
+    return dx, dW.transpose(2, 3, 0, 1).reshape(FN, 1, k, k)
+
+
+def depthwise_shapes(input_shape, filters, kernel_size, stride=1, pads=((0, 0), (0, 0)), dilation=1):
+    """(填充后的输入形状, out_h, out_w, 反向传播插0补齐后的delta误差形状)"""
+
+    (top, bottom), (left, right) = pads
+    N, H, W, C = input_shape
+
+    Hp, Wp = H + top + bottom, W + left + right
+    out_h = (Hp - dilation * (kernel_size - 1) - 1) // stride + 1
+    out_w = (Wp - dilation * (kernel_size - 1) - 1) // stride + 1
+
+    e = (kernel_size - 1) * dilation
+    full = (N, (out_h - 1) * stride + 1 + 2 * e, (out_w - 1) * stride + 1 + 2 * e, filters)
+
+    return (N, Hp, Wp, C), out_h, out_w, full
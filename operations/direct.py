@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+
+
+def direct_windows(input_shape, kernel_size, stride=1, pad=0):
+    """卷积核每个位置 (i, j) 在填充后的NHWC输入上对应的步幅切片，(i, j, 切片)"""
+
+    N, H, W, C = input_shape
+    out_h = (H + 2 * pad - kernel_size) // stride + 1
+    out_w = (W + 2 * pad - kernel_size) // stride + 1
+
+    for i in range(kernel_size):
+        for j in range(kernel_size):
+            yield i, j, np.s_[:, i:i + stride * (out_h - 1) + 1:stride, j:j + stride * (out_w - 1) + 1:stride, :]
+
+
+def direct_forward(x, weights, stride=1, pad=0, buffer=None):
+    """直接卷积，对卷积核的k * k个位置各做一次 (N * out_h * out_w, C) x (C, F) 的GEMM并累加
+
+    不展开im2col矩阵，中间数据只有一个位置的窗口，适合im2col矩阵放不进缓存的情况
+
+    Parameters
+    ----------
+    x : NHWC输入 (N, H, W, C)
+    weights : 卷积核 (F, C, r, r)
+    buffer : buffer(名称, 形状)返回可复用的缓存，默认新分配，名称见Conv2D._direct_memory
+
+    Returns
+    -------
+    out : (N * out_h * out_w, F)
+    padded : 填充后的输入，反向传播时使用
+    """
+
+    if buffer is None:
+        buffer = lambda name, shape: np.empty(shape, dtype=x.dtype)
+
+    FN, C, k, _ = weights.shape
+    N, H, W, C = x.shape
+    out_h = (H + 2 * pad - k) // stride + 1
+    out_w = (W + 2 * pad - k) // stride + 1
+    rows = N * out_h * out_w
+
+    if pad > 0:
+        padded = buffer('padded', (N, H + 2 * pad, W + 2 * pad, C))
+        padded.fill(0)
+        padded[:, pad:pad + H, pad:pad + W, :] = x
+        x = padded
+
+    # (r, r, C, F)，每个位置一个连续的 (C, F) 矩阵
+    kernels = np.ascontiguousarray(weights.transpose(2, 3, 1, 0))
+
+    window = buffer('window', (rows, C))
+    product = buffer('product', (rows, FN))
+    out = buffer('gemm', (rows, FN))
+    out.fill(0)
+
+    for i, j, s in direct_windows((N, H, W, C), k, stride, pad):
+        np.copyto(window.reshape(N, out_h, out_w, C), x[s])
+        np.dot(window, kernels[i, j], out=product)
+        out += product
+
+    return out, x
+
+
+def direct_backward(dout, padded, weights, input_shape, stride=1, pad=0, buffer=None):
+    """直接卷积的反向传播，对卷积核的每个位置：
+
+    dW[:, :, i, j] = doutT window
+    dwindow = dout W[:, :, i, j]T，累加回输入的对应位置
+
+    Parameters
+    ----------
+    dout : delta误差 (N * out_h * out_w, F)
+    padded : direct_forward返回的填充后的输入
+    input_shape : 输入的形状 (N, H, W, C)
+    buffer : 同direct_forward
+
+    Returns
+    -------
+    dx : (N, H, W, C)，去掉填充的视图
+    dW : (F, C, r, r)
+    """
+
+    if buffer is None:
+        buffer = lambda name, shape: np.empty(shape, dtype=dout.dtype)
+
+    FN, C, k, _ = weights.shape
+    N, H, W, C = input_shape
+    out_h = (H + 2 * pad - k) // stride + 1
+    out_w = (W + 2 * pad - k) // stride + 1
+    rows = N * out_h * out_w
+
+    # (r, r, F, C)
+    kernels = np.ascontiguousarray(weights.transpose(2, 3, 0, 1))
+
+    window = buffer('window', (rows, C))
+    dwindow = buffer('dwindow', (rows, C))
+
+    dW = np.empty(weights.shape, dtype=dout.dtype)
+    dpadded = buffer('dx', padded.shape)
+    dpadded.fill(0)
+
+    for i, j, s in direct_windows(input_shape, k, stride, pad):
+        np.copyto(window.reshape(N, out_h, out_w, C), padded[s])
+        dW[:, :, i, j] = np.dot(dout.T, window)
+
+        np.dot(dout, kernels[i, j], out=dwindow)
+        dpadded[s] += dwindow.reshape(N, out_h, out_w, C)
+
+    return dpadded[:, pad:pad + H, pad:pad + W, :], dW
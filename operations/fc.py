@@ -3,6 +3,7 @@
 # Author:Speciallan
 
 import numpy as np
+from taurus import backend
 from taurus.core.layer import Layer
 from taurus import operations
 from taurus.operations import sigmoid, sigmoid_prime, relu, relu_prime
@@ -24,10 +25,20 @@ class FC(operations.Operation):
         self.activation = activation
         self.initializer = initializer
 
-        # 记录前向反向传播的输入
+        # 记录前向反向传播的输入，都是(N, features)的2维矩阵
         self.input = None
         self.delta = None
 
+        # 输入的形状，反向传播时还原
+        self.x_shape = None
+
+        # 反向传播求梯度时使用前向传播的输入
+        self.saves_input = True
+
+        # 权重和偏置参数的梯度，初始化权重时预分配，反向传播时原地写入
+        self.dW = None
+        self.db = None
+
         self.activation_func = None
         self.activation_prime_func = None
 
@@ -41,7 +52,12 @@ class FC(operations.Operation):
         else:
             x = inputs
 
-        x = np.array(x)
+        # 统一为计算精度
+        x = backend.cast_to_floatx(x)
+
+        # conv是3->4，fc是2->3，单个样本(in, 1)扩展为(1, in, 1)
+        if x.ndim == 2:
+            x = np.expand_dims(x, axis=0)
 
         # 初始化权重
         if not self.has_inited:
@@ -51,20 +67,14 @@ class FC(operations.Operation):
 
             # print(x.ndim, x.shape, x.size)
 
-            self.weights = np.zeros(shape=(self.out_size, self.in_size))
-            self.biases = np.zeros(shape=(self.out_size, 1))
+            self.weights = np.zeros(shape=(self.out_size, self.in_size), dtype=backend.floatx())
+            self.biases = np.zeros(shape=(self.out_size, 1), dtype=backend.floatx())
 
             # 初始化
             self._init_weights()
+            self._init_grads()
             self.has_inited = True
 
-        # conv是3->4，fc是2->3
-        if x.ndim == 2:
-            x = np.expand_dims(x, axis=0)
-
-        # 记录输入
-        self.input = x
-
         # 激活函数
         self.outputs = self._forward_cpu(x)
 
@@ -93,47 +103,87 @@ class FC(operations.Operation):
         if isinstance(inputs, Layer):
             return self
         else:
-            return self.outputs
+            return self._trace(inputs, self.outputs)
 
     def backprop(self, delta):
 
-        # 记录梯度 反向传播输入
-        self.delta = delta
+        # 目前默认cpu
         delta = self._backprop_cpu(delta)
         return delta
 
-    def cal_prime(self):
+    def cal_prime(self, per_sample=False):
+        """计算权重和偏置的梯度，直接使用_backprop_cpu中GEMM的结果
+        默认返回整个batch求和后的梯度 (out, in) (out, 1)
+        per_sample=True时返回每个样本的梯度 (N, out, in) (N, out, 1)"""
 
-        nabla_w, nabla_b = [], []
+        if not per_sample:
+            return self.dW, self.db
 
-        for i in range(self.delta.shape[0]):
-            nabla_w.append(np.dot(self.delta[i], self.input[i].transpose()))
-            nabla_b.append(self.delta[i])
-
-        nabla_w, nabla_b = np.asarray(nabla_w), np.asarray(nabla_b)
+        nabla_w = self.delta[:, :, np.newaxis] * backend.from_storage(self.input)[:, np.newaxis, :]
+        nabla_b = self.delta[:, :, np.newaxis]
 
         return nabla_w, nabla_b
 
     def _forward_cpu(self, x):
-        """cpu通过循环实现，也可以通过多进程并行计算
-        fc层如果合并到一起计算量太大(80000,1)->(200,400,1)，循环跑比较好"""
-        out = []
-        for i in range(x.shape[0]):
-            out.append(np.dot(self.weights, x[i]) + self.biases)
-        out = np.asarray(out)
+        """整个batch展开成(N, in)，一次GEMM得到(N, out)
+        输出还原成与输入相同的维数，(N, in, 1) -> (N, out, 1)"""
+
+        self.x_shape = x.shape
+
+        N = x.shape[0]
+        x = x.reshape(N, -1)
+
+        # 记录输入
+        if self.caching:
+            self.input = backend.to_storage(x)
+
+        out = np.dot(x, self.weights.T, out=self._buffer('output', (N, self.weights.shape[0]), x.dtype))
+        out += self.biases.T
+
+        if len(self.x_shape) == 3:
+            return out.reshape(N, -1, 1)
+
         return out
 
     def _backprop_cpu(self, delta):
-        """反向传播 乘转置矩阵"""
-        out = []
-        for i in range(delta.shape[0]):
-            out.append(np.dot(self.weights.transpose(), delta[i]))
-        out = np.asarray(out)
-        return out
+        """反向传播 乘转置矩阵，同时用一次GEMM求出整个batch的梯度"""
+
+        N = delta.shape[0]
+        delta = backend.cast_to_floatx(delta).reshape(N, -1)
+
+        # 记录梯度 反向传播输入
+        self.delta = delta
+
+        # 一次GEMM完成整个batch梯度的累加，直接写入梯度缓存
+        np.dot(delta.T, backend.from_storage(self.input), out=self.dW)
+        np.sum(delta, axis=0, out=self.db.reshape(-1))
+
+        out = np.dot(delta, self.weights, out=self._buffer('dx', (N, self.weights.shape[1]), delta.dtype))
+
+        return out.reshape(self.x_shape)
 
     def _init_weights(self):
 
         if self.initializer == 'normal':
-            self.weights = np.random.randn(self.weights.shape[0], self.weights.shape[1])
-            self.biases = np.random.randn(self.biases.shape[0], self.biases.shape[1])
+            self.weights = np.random.randn(self.weights.shape[0], self.weights.shape[1]).astype(backend.floatx())
+            self.biases = np.random.randn(self.biases.shape[0], self.biases.shape[1]).astype(backend.floatx())
+
+    def memory(self, input_shape, output_shape):
+
+        N = input_shape[0]
+
+        return [
+            ('output', (N, self.units), backend.floatx(), 'output'),
+            ('dx', (N, int(np.prod(input_shape[1:]))), backend.floatx(), 'grad'),
+        ]
+
+    def release(self):
+
+        self.input = None
+        self.delta = None
+
+    def _init_grads(self):
 
+        # 梯度缓存与参数同形状，内存只和参数量有关，与batch大小无关
+        self.dW = np.zeros(self.weights.shape, dtype=self.weights.dtype)
+        self.db = np.zeros(self.biases.shape, dtype=self.biases.dtype)
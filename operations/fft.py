@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+
+
+def fft_shape(input_shape, kernel_size, stride=1, pad=0):
+    """NHWC输入对应的 (out_h, out_w, 步幅1时的输出大小full_h、full_w, FFT大小Hp、Wp)
+
+    FFT大小取填充后的输入大小，循环相关中有效的输出不会发生回绕
+    """
+
+    N, H, W, C = input_shape
+
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    full_h, full_w = Hp - kernel_size + 1, Wp - kernel_size + 1
+    out_h, out_w = (full_h - 1) // stride + 1, (full_w - 1) // stride + 1
+
+    return out_h, out_w, full_h, full_w, Hp, Wp
+
+
+def fft_weights(weights, size):
+    """卷积核的频域表示，(F, C, r, r) -> (Hp, Wp // 2 + 1, C, F)，前向反向传播共用"""
+
+    Wf = np.fft.rfft2(weights, s=size, axes=(2, 3))
+    return np.ascontiguousarray(Wf.transpose(2, 3, 1, 0))
+
+
+def fft_forward(x, Wf, kernel_size, stride=1, pad=0, padded=None, out=None):
+    """基于rfft2的卷积（相关），对N和C批量计算
+
+    频域中每个频率是一个 (N, C) x (C, F) 的复数GEMM，
+    计算量与卷积核大小无关，中间数据只有输入大小，不需要k * k倍的im2col矩阵。
+
+    Parameters
+    ----------
+    x : NHWC输入 (N, H, W, C)
+    Wf : fft_weights得到的卷积核频域表示
+    padded : 可复用的填充缓存 (N, H + 2 * pad, W + 2 * pad, C)
+    out : 可复用的输出缓存 (N, out_h, out_w, F)
+
+    Returns
+    -------
+    out : (N, out_h, out_w, F)
+    X : 输入的频域表示 (Hp, Wp // 2 + 1, N, C)，反向传播求卷积核梯度时使用
+    """
+
+    N, H, W, C = x.shape
+    FN = Wf.shape[-1]
+    out_h, out_w, full_h, full_w, Hp, Wp = fft_shape(x.shape, kernel_size, stride, pad)
+
+    if pad > 0:
+        if padded is None:
+            padded = np.empty((N, Hp, Wp, C), dtype=x.dtype)
+        padded.fill(0)
+        padded[:, pad:pad + H, pad:pad + W, :] = x
+        x = padded
+
+    # (Hp, Wq, N, C)，每个频率一个矩阵
+    X = np.ascontiguousarray(np.fft.rfft2(x, axes=(1, 2)).transpose(1, 2, 0, 3))
+
+    # 相关对应频域乘共轭
+    Y = np.matmul(X, Wf.conj())
+    y = np.fft.irfft2(Y, s=(Hp, Wp), axes=(0, 1))
+
+    if out is None:
+        out = np.empty((N, out_h, out_w, FN), dtype=x.dtype)
+    np.copyto(out, y[:full_h:stride, :full_w:stride].transpose(2, 0, 1, 3))
+
+    return out, X
+
+
+def fft_backward(dout, X, Wf, kernel_size, input_shape, stride=1, pad=0, dx=None):
+    """FFT卷积的反向传播
+
+    dx 是delta误差与卷积核的卷积，频域中乘卷积核
+    dW 是输入与delta误差的相关，频域中输入乘delta误差的共轭，对N求和
+    步幅大于1时delta误差先按步幅插0，还原为步幅1的输出大小
+
+    Parameters
+    ----------
+    dout : NHWC的delta误差 (N, out_h, out_w, F)
+    X, Wf : 前向传播中输入和卷积核的频域表示
+    input_shape : 输入的形状 (N, H, W, C)
+    dx : 可复用的输入梯度缓存 (N, H, W, C)
+
+    Returns
+    -------
+    dx : (N, H, W, C)
+    dW : (F, C, r, r)
+    """
+
+    N, H, W, C = input_shape
+    FN = Wf.shape[-1]
+    out_h, out_w, full_h, full_w, Hp, Wp = fft_shape(input_shape, kernel_size, stride, pad)
+
+    # delta误差补0到FFT大小，(Hp, Wp, N, F)
+    full = np.zeros((Hp, Wp, N, FN), dtype=dout.dtype)
+    full[:full_h:stride, :full_w:stride] = dout.transpose(1, 2, 0, 3)
+
+    D = np.fft.rfft2(full, axes=(0, 1))
+
+    # 输入的梯度 (Hp, Wq, N, F) x (Hp, Wq, F, C)
+    dX = np.matmul(D, Wf.transpose(0, 1, 3, 2))
+    dpadded = np.fft.irfft2(dX, s=(Hp, Wp), axes=(0, 1))
+
+    if dx is None:
+        dx = np.empty(input_shape, dtype=dout.dtype)
+    np.copyto(dx, dpadded[pad:pad + H, pad:pad + W].transpose(2, 0, 1, 3))
+
+    # 卷积核的梯度 (Hp, Wq, F, N) x (Hp, Wq, N, C)，在GEMM中对N求和
+    dWf = np.matmul(D.conj().transpose(0, 1, 3, 2), X)
+    dW = np.fft.irfft2(dWf, s=(Hp, Wp), axes=(0, 1))[:kernel_size, :kernel_size]
+
+    return dx, dW.transpose(2, 3, 0, 1)
+
+
+def fft_flops(input_shape, filters, kernel_size, stride=1, pad=0):
+    """FFT卷积一次前向传播的大致浮点运算次数，用于和im2col比较"""
+
+    N, H, W, C = input_shape
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+
+    # 实数FFT约 2.5 * n * log2(n)，输入、输出各一次，卷积核一次
+    size = Hp * Wp
+    transforms = 2.5 * size * np.log2(max(size, 2)) * (N * C + N * filters + C * filters)
+
+    # 每个频率一个复数GEMM，复数乘加8次
+    products = 8. * Hp * (Wp // 2 + 1) * N * C * filters
+
+    return transforms + products
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from taurus import backend
+from taurus import operations
+
+
+class Fused(operations.Operation):
+    """融合算子，把静态执行计划中相邻的几层合成一次计算，见core/fusion.py
+
+    参数和梯度仍然保存在被融合的层中，被融合的层计算时使用的缓存
+    在memory中声明为属于该层，内存规划分配到该层的regions
+    """
+
+    def __init__(self, layers):
+        super(Fused, self).__init__()
+
+        self.fused = layers
+
+        head = layers[0]
+        self.id = head.id
+        self.name = '+'.join(str(layer.name) for layer in layers)
+        self.type = head.type
+
+    @property
+    def caching(self):
+        """训练/推理模式跟随被融合的层"""
+        return self.fused[0].caching
+
+    def release(self):
+
+        for layer in self.fused:
+            layer.release()
+
+
+class FusedConv2D(Fused):
+    """Conv2D + 偏置 + Relu + MaxPooling2D
+
+    GEMM的输出 (N * out_h * out_w, FN) 的行顺序就是NHWC，直接在上面做池化，不再转置和im2col。
+    Relu单调不减、偏置每个通道是常数，max(relu(z + b)) = relu(max(z) + b)，
+    所以先池化，再在池化后的小数组上原地加偏置和激活，激活和池化的掩码只有池化输出大小
+    """
+
+    def __init__(self, conv, activation=None, pool=None):
+        super(FusedConv2D, self).__init__([layer for layer in [conv, activation, pool] if layer is not None])
+
+        self.conv = conv
+        self.activation = activation
+        self.pool = pool
+
+        self.saves_input = conv.saves_input
+        self.layout = conv.layout
+
+        # 池化窗口中最大值的序号，Relu的掩码，都只有输出大小
+        self.arg_max = None
+        self.mask = None
+
+        self.conv_shape = None
+
+    def __call__(self, inputs, *args, **kwargs):
+
+        x = backend.cast_to_floatx(inputs)
+
+        out = self.conv._convolve(x)
+
+        N, H, W, C = self.conv.x_shape
+        self.conv_shape = (N, self.conv._out_size(H), self.conv._out_size(W), out.shape[1])
+        out = out.reshape(self.conv_shape)
+
+        if self.pool is not None:
+            out = self._pool(out)
+
+        out += self.conv.biases
+
+        if self.activation is not None:
+            if self.caching:
+                self.mask = np.greater(out, 0, out=self._buffer('mask', out.shape, bool))
+            np.maximum(out, 0, out=out)
+
+        return self._trace(inputs, out)
+
+    def backward(self, delta):
+
+        if self.activation is not None:
+            delta = np.multiply(delta, self.mask, out=self._buffer('ddot', delta.shape, delta.dtype))
+
+        if self.pool is not None:
+            delta = self._unpool(delta)
+
+        return self.conv.backprop(delta)
+
+    def _windows(self):
+        """池化窗口中每个位置在卷积输出上对应的切片，(序号, 切片)"""
+
+        size, stride = self.pool.pool_h, self.pool.stride
+        N, H, W, C = self.conv_shape
+
+        out_h = (H - size) // stride + 1
+        out_w = (W - size) // stride + 1
+
+        for i in range(size):
+            for j in range(size):
+                yield i * size + j, np.s_[:, i:i + stride * (out_h - 1) + 1:stride, j:j + stride * (out_w - 1) + 1:stride]
+
+    def _pool(self, z):
+        """逐个窗口位置取最大值，记录最大值在窗口中的序号，相等时取第一个，与np.argmax一致"""
+
+        windows = self._windows()
+
+        index, window = next(windows)
+        out = self._buffer('output', z[window].shape, z.dtype)
+        np.copyto(out, z[window])
+
+        if self.caching:
+            self.arg_max = self._buffer('arg_max', out.shape, np.uint8)
+            self.arg_max.fill(index)
+            greater = self._buffer('greater', out.shape, bool)
+
+        for index, window in windows:
+
+            if self.caching:
+                np.greater(z[window], out, out=greater)
+                np.copyto(self.arg_max, index, where=greater)
+
+            np.maximum(out, z[window], out=out)
+
+        return out
+
+    def _unpool(self, delta):
+        """delta误差散射回各窗口最大值的位置，窗口重叠时累加"""
+
+        dz = self._buffer('dz', self.conv_shape, delta.dtype)
+        dz.fill(0)
+
+        hit = self._buffer('hit', delta.shape, bool)
+
+        for index, window in self._windows():
+            np.equal(self.arg_max, index, out=hit)
+            np.add(dz[window], delta, out=dz[window], where=hit)
+
+        return dz
+
+    def memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        conv_shape = (N, self.conv._out_size(H), self.conv._out_size(W), self.conv.filters)
+
+        buffers = []
+        for entry in self.conv.memory(input_shape, conv_shape):
+            name, shape, dtype, phase = entry[:4]
+
+            # 有池化时卷积的输出只是前向传播的临时缓存
+            if phase == 'output' and self.pool is not None:
+                phase = 'forward'
+
+            # 卷积层内部的层（例如SeparableConv2D的depthwise）声明的缓存保持原来的所属
+            buffers.append((name, shape, dtype, phase, entry[4] if len(entry) > 4 else self.conv))
+
+        if self.pool is not None:
+            buffers += [
+                ('output', output_shape, backend.floatx(), 'output'),
+                ('arg_max', output_shape, np.uint8, 'saved'),
+                ('greater', output_shape, bool, 'forward'),
+                ('dz', conv_shape, backend.floatx(), 'backward'),
+                ('hit', output_shape, bool, 'backward'),
+            ]
+
+        if self.activation is not None:
+            buffers += [
+                ('mask', output_shape, bool, 'saved'),
+                ('ddot', output_shape, backend.floatx(), 'backward'),
+            ]
+
+        return buffers
+
+    def release(self):
+
+        super(FusedConv2D, self).release()
+
+        self.arg_max = None
+        self.mask = None
+
+
+class FusedFC(Fused):
+    """FC + 偏置 + Relu，在GEMM的输出上原地加偏置和激活"""
+
+    def __init__(self, fc, activation=None):
+        super(FusedFC, self).__init__([layer for layer in [fc, activation] if layer is not None])
+
+        self.fc = fc
+        self.activation = activation
+
+        self.saves_input = fc.saves_input
+
+        self.mask = None
+
+    def __call__(self, inputs, *args, **kwargs):
+
+        x = backend.cast_to_floatx(inputs)
+
+        # 单个样本(in, 1)扩展为(1, in, 1)
+        if x.ndim == 2:
+            x = np.expand_dims(x, axis=0)
+
+        out = self.fc._forward_cpu(x)
+
+        if self.activation is not None:
+            if self.caching:
+                self.mask = np.greater(out, 0, out=self._buffer('mask', out.shape, bool))
+            np.maximum(out, 0, out=out)
+
+        return self._trace(inputs, out)
+
+    def backward(self, delta):
+
+        if self.activation is not None:
+            delta = np.multiply(delta, self.mask, out=self._buffer('ddot', delta.shape, delta.dtype))
+
+        return self.fc.backprop(delta)
+
+    def memory(self, input_shape, output_shape):
+
+        buffers = [buffer + (self.fc,) for buffer in self.fc.memory(input_shape, output_shape)]
+
+        if self.activation is not None:
+            buffers += [
+                ('mask', output_shape, bool, 'saved'),
+                ('ddot', output_shape, backend.floatx(), 'backward'),
+            ]
+
+        return buffers
+
+    def release(self):
+
+        super(FusedFC, self).release()
+
+        self.mask = None
@@ -3,6 +3,7 @@
 # Author:Speciallan
 
 import numpy as np
+from taurus import backend
 from taurus import operations
 
 
@@ -22,7 +23,10 @@ class Input(operations.Operation):
 
         self.input_shape = None
         self.output_shape = shape
-        self.outputs = np.zeros(self.output_shape)
+        self.outputs = np.zeros(self.output_shape, dtype=backend.floatx())
+
+        # 模型输入的内存布局，图片为NHWC
+        self.layout = 'NHWC'
 
     def __call__(self, inputs, *args, **kwargs):
 
@@ -5,7 +5,8 @@
 import numpy as np
 import time
 from taurus import operations
-from taurus.operations.common import im2col, col2im
+from taurus import backend
+from taurus.operations.common import im2col_strided, col2im_strided
 from taurus.core.layer import Layer
 from taurus.utils.spe import spe
 
@@ -47,6 +48,16 @@ class MaxPooling2D(Pooling2D):
         self.pool_h = size
         self.pad = pad
 
+        # 中间数据（backward时使用）
+        self.x = None
+        self.arg_max = None
+
+        # arg_max每行的行号，用于反向传播时散射，batch大小不变时复用
+        self.rows = None
+
+        # 输入输出都是NHWC
+        self.layout = 'NHWC'
+
     def __call__(self, inputs, *args, **kwargs):
 
         # time1 = time.time()
@@ -58,7 +69,7 @@ class MaxPooling2D(Pooling2D):
 
         # print('pooling:{}'.format(time.time() - time1))
 
-        return pool_out
+        return self._trace(inputs, pool_out)
 
     def backprop(self, pool_out_delta):
 
@@ -68,35 +79,60 @@ class MaxPooling2D(Pooling2D):
 
         return delta
 
+    def memory(self, input_shape, output_shape):
+
+        N, H, W, C = input_shape
+        _, out_h, out_w, _ = output_shape
+        pool_size = self.pool_h * self.pool_w
+        rows = N * out_h * out_w * C
+
+        buffers = [
+            ('col', (N * out_h * out_w, C * pool_size), backend.floatx(), 'forward'),
+            ('output', (rows,), backend.floatx(), 'output'),
+            ('arg_max', (rows,), np.intp, 'saved'),
+            ('dmax', (rows, pool_size), backend.floatx(), 'backward'),
+            ('dx', input_shape, backend.floatx(), 'grad'),
+        ]
+
+        if self.pad > 0:
+            buffers.append(('padded', (N, H + 2 * self.pad, W + 2 * self.pad, C), backend.floatx(), 'forward'))
+
+        return buffers
+
+    def release(self):
+
+        self.x = None
+        self.arg_max = None
+        self.rows = None
+
     def _forward_cpu(self, x):
 
         if x.ndim == 3:
             x = np.expand_dims(x, axis=0)
 
-        x = x.transpose(0, 3, 1, 2)
-
-        N, C, H, W = x.shape
+        # 直接使用NHWC，im2col按strides读取，不转置
+        N, H, W, C = x.shape
 
         out_h = int(1 + (H - self.pool_h) / self.stride)
         out_w = int(1 + (W - self.pool_w) / self.stride)
         # spe(self.pool_h, self.pool_w, out_h, out_w)
 
-        # 展开
-        col = im2col(x, self.pool_h, self.pool_w, self.stride, self.pad)
-        col = col.reshape(-1, self.pool_h * self.pool_w)
-
-        # 最大值
-        arg_max = np.argmax(col, axis=1)
-        out = np.max(col, axis=1)
+        # 展开，行顺序为(N, out_h, out_w, C)
+        pool_size = self.pool_h * self.pool_w
+        padded = self._buffer('padded', (N, H + 2 * self.pad, W + 2 * self.pad, C), x.dtype) if self.pad > 0 else None
+        col = im2col_strided(x, self.pool_h, self.pool_w, self.stride, self.pad,
+                             out=self._buffer('col', (N * out_h * out_w, C * pool_size), x.dtype), padded=padded, layout=self.layout)
+        col = col.reshape(-1, pool_size)
 
-        # 转换
-        out = out.reshape(N, out_h, out_w, C).transpose(0, 3, 1, 2)
+        # 最大值，推理时不需要最大值位置
+        out = np.max(col, axis=1, out=self._buffer('output', (col.shape[0],), x.dtype))
 
-        self.x = x
-        self.arg_max = arg_max
+        # 行顺序(N, out_h, out_w, C)就是NHWC
+        out = out.reshape(N, out_h, out_w, C)
 
-        # 还原shape
-        out = out.transpose(0, 2, 3, 1)
+        if self.caching:
+            self.x = x
+            self.arg_max = np.argmax(col, axis=1, out=self._buffer('arg_max', (col.shape[0],), np.intp))
 
         return out
 
@@ -105,18 +141,20 @@ class MaxPooling2D(Pooling2D):
         if dout.ndim == 3:
             dout = np.expand_dims(dout, axis=0)
 
-        dout = dout.transpose(0, 3, 1, 2)
+        # dout是NHWC，展开后的顺序(N, out_h, out_w, C)与arg_max的行顺序一致
+        N, out_h, out_w, C = dout.shape
 
-        pool_size = self.pool_h * self.pool_w
-        dmax = np.zeros((dout.size, pool_size))
-        dmax[np.arange(self.arg_max.size), self.arg_max.flatten()] = dout.flatten()
-        dmax = dmax.reshape(dout.shape + (pool_size,))
+        if self.rows is None or self.rows.size != self.arg_max.size:
+            self.rows = np.arange(self.arg_max.size)
 
-        dcol = dmax.reshape(dmax.shape[0] * dmax.shape[1] * dmax.shape[2], -1)
-        dx = col2im(dcol, self.x.shape, self.pool_h, self.pool_w, self.stride, self.pad)
+        pool_size = self.pool_h * self.pool_w
+        dmax = self._buffer('dmax', (self.arg_max.size, pool_size), dout.dtype)
+        dmax.fill(0)
+        dmax[self.rows, self.arg_max] = dout.reshape(-1)
 
-        # 还原shape
-        dx = dx.transpose(0, 2, 3, 1)
+        dcol = dmax.reshape(N * out_h * out_w, -1)
+        dx = col2im_strided(dcol, self.x.shape, self.pool_h, self.pool_w, self.stride, self.pad,
+                            out=self._buffer('dx', self.x.shape, dcol.dtype), layout=self.layout)
 
         return dx
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+# Winograd F(2x2, rxr) 的变换矩阵，插值点为 0, 1, -1, (2, -2,) 无穷远
+# 一维 y = AT [(G g) * (BT d)]，二维 Y = AT [(G g GT) * (BT d B)] A
+# 每个2x2输出块的乘法次数 F(2x2,3x3) 16次（直接计算36次），F(2x2,5x5) 36次（直接计算100次）
+WINOGRAD_M = 2
+
+WINOGRAD = {
+    3: (
+        # AT (m, n)
+        np.array([[1, 1, 1, 0],
+                  [0, 1, -1, -1]]),
+        # G (n, r)
+        np.array([[1, 0, 0],
+                  [1 / 2, 1 / 2, 1 / 2],
+                  [1 / 2, -1 / 2, 1 / 2],
+                  [0, 0, 1]]),
+        # BT (n, n)
+        np.array([[1, 0, -1, 0],
+                  [0, 1, 1, 0],
+                  [0, -1, 1, 0],
+                  [0, 1, 0, -1]]),
+    ),
+    5: (
+        np.array([[1, 1, 1, 1, 1, 0],
+                  [0, 1, -1, 2, -2, 1]]),
+        np.array([[1 / 4, 0, 0, 0, 0],
+                  [-1 / 6, -1 / 6, -1 / 6, -1 / 6, -1 / 6],
+                  [-1 / 6, 1 / 6, -1 / 6, 1 / 6, -1 / 6],
+                  [1 / 24, 1 / 12, 1 / 6, 1 / 3, 2 / 3],
+                  [1 / 24, -1 / 12, 1 / 6, -1 / 3, 2 / 3],
+                  [0, 0, 0, 0, 1]]),
+        np.array([[4, 0, -5, 0, 1, 0],
+                  [0, -4, -4, 1, 1, 0],
+                  [0, 4, -4, -1, 1, 0],
+                  [0, -2, -1, 2, 1, 0],
+                  [0, 2, -1, -2, 1, 0],
+                  [0, 4, 0, -5, 0, 1]]),
+    ),
+}
+
+
+def winograd_matrices(kernel_size, dtype):
+    """AT, G, BT，转换为计算精度"""
+
+    if kernel_size not in WINOGRAD:
+        raise ValueError('Winograd只支持{}的卷积核，当前为{}'.format(sorted(WINOGRAD), kernel_size))
+
+    return [m.astype(dtype) for m in WINOGRAD[kernel_size]]
+
+
+def winograd_shape(input_shape, kernel_size, pad=0):
+    """NHWC输入对应的 (out_h, out_w, 块的行数, 块的列数, 块大小n)，输出按2x2分块，不够的部分补0"""
+
+    N, H, W, C = input_shape
+    m = WINOGRAD_M
+
+    out_h = H + 2 * pad - kernel_size + 1
+    out_w = W + 2 * pad - kernel_size + 1
+    tiles_h = (out_h + m - 1) // m
+    tiles_w = (out_w + m - 1) // m
+
+    return out_h, out_w, tiles_h, tiles_w, m + kernel_size - 1
+
+
+def winograd_weights(weights, out=None):
+    """卷积核变换 U = G g GT，(F, C, r, r) -> (n * n, C, F)"""
+
+    AT, G, BT = winograd_matrices(weights.shape[-1], weights.dtype)
+    n = G.shape[0]
+
+    FN, C = weights.shape[:2]
+    if out is None:
+        out = np.empty((n * n, C, FN), dtype=weights.dtype)
+
+    np.einsum('ij,fcjk,lk->ilcf', G, weights, G, out=out.reshape(n, n, C, FN), optimize=True)
+
+    return out
+
+
+def winograd_forward(x, U, kernel_size, pad=0, buffer=None):
+    """步幅为1的Winograd卷积
+
+    变换都写成 (n, n) 的小矩阵左乘，每一步都是连续数组上的一次GEMM，不经过einsum的转置拷贝：
+    块按 (n, n, P, C) 排列，BT先乘第一维，再对第一维的每个位置乘第二维
+
+    Parameters
+    ----------
+    x : NHWC输入 (N, H, W, C)
+    U : winograd_weights变换后的卷积核 (n * n, C, F)
+    buffer : buffer(名称, 形状)返回可复用的缓存，默认新分配，名称见Conv2D._winograd_memory
+
+    Returns
+    -------
+    out : (N, tiles_h * 2, tiles_w * 2, F)，超出out_h、out_w的部分由调用方裁掉
+    V : 输入变换 (n * n, P, C)，反向传播时使用，P = N * tiles_h * tiles_w
+    """
+
+    if buffer is None:
+        buffer = lambda name, shape: np.empty(shape, dtype=x.dtype)
+
+    AT, G, BT = winograd_matrices(kernel_size, x.dtype)
+    m = WINOGRAD_M
+
+    N, H, W, C = x.shape
+    FN = U.shape[-1]
+    out_h, out_w, tiles_h, tiles_w, n = winograd_shape(x.shape, kernel_size, pad)
+    P = N * tiles_h * tiles_w
+
+    # 填充，右下方多补的0使输出正好分成整数个块
+    padded = buffer('padded', (N, tiles_h * m + n - m, tiles_w * m + n - m, C))
+    padded.fill(0)
+    padded[:, pad:pad + H, pad:pad + W, :] = x
+
+    # 相邻块重叠n - m，(n, n, N, tiles_h, tiles_w, C) 的步幅视图，拷贝一次得到连续的块
+    s0, s1, s2, s3 = padded.strides
+    tiles = as_strided(padded, shape=(n, n, N, tiles_h, tiles_w, C),
+                       strides=(s1, s2, s0, s1 * m, s2 * m, s3), writeable=False)
+
+    V = buffer('V', (n * n, P, C))
+    np.copyto(V.reshape(tiles.shape), tiles)
+
+    # 输入变换 V = BT d B，两次GEMM在D和V之间来回
+    D = buffer('D', (n * n, P, C))
+    np.dot(BT, V.reshape(n, -1), out=D.reshape(n, -1))
+    np.matmul(BT, D.reshape(n, n, -1), out=V.reshape(n, n, -1))
+
+    # n * n 个 (P, C) x (C, F) 的批量GEMM
+    M = buffer('M', (n * n, P, FN))
+    np.matmul(V, U, out=M)
+
+    # 输出变换 Y = AT M A
+    Y1 = buffer('Y1', (m * n, P, FN))
+    Y = buffer('Y', (m * m, P, FN))
+    np.dot(AT, M.reshape(n, -1), out=Y1.reshape(m, -1))
+    np.matmul(AT, Y1.reshape(m, n, -1), out=Y.reshape(m, m, -1))
+
+    # (m, m, N, tiles_h, tiles_w, F) 写成NHWC
+    out = buffer('tiles', (N, tiles_h * m, tiles_w * m, FN))
+    np.copyto(out.reshape(N, tiles_h, m, tiles_w, m, FN), Y.reshape(m, m, N, tiles_h, tiles_w, FN).transpose(2, 3, 0, 4, 1, 5))
+
+    return out, V
+
+
+def winograd_backward(dout, V, U, kernel_size, input_shape, pad=0, buffer=None):
+    """Winograd卷积的反向传播，是前向传播各步的转置
+
+    Z  = A dY AT
+    dU = VT Z      dW = GT dU G
+    dV = Z UT      dd = B dV BT，相邻块重叠的部分累加
+
+    Parameters
+    ----------
+    dout : NHWC的delta误差 (N, out_h, out_w, F)
+    V, U : 前向传播的输入变换和卷积核变换
+    input_shape : 输入的形状 (N, H, W, C)
+    buffer : 同winograd_forward
+
+    Returns
+    -------
+    dx : (N, H, W, C)，去掉填充的视图
+    dW : (F, C, r, r)
+    """
+
+    if buffer is None:
+        buffer = lambda name, shape: np.empty(shape, dtype=dout.dtype)
+
+    AT, G, BT = winograd_matrices(kernel_size, dout.dtype)
+    A, B = AT.T.copy(), BT.T.copy()
+    m = WINOGRAD_M
+
+    N, H, W, C = input_shape
+    FN = U.shape[-1]
+    out_h, out_w, tiles_h, tiles_w, n = winograd_shape(input_shape, kernel_size, pad)
+    P = N * tiles_h * tiles_w
+
+    # delta误差按 (m, m, N, tiles_h, tiles_w, F) 排列，补齐块的部分为0
+    if tiles_h * m != out_h or tiles_w * m != out_w:
+        full = np.zeros((N, tiles_h * m, tiles_w * m, FN), dtype=dout.dtype)
+        full[:, :out_h, :out_w, :] = dout
+        dout = full
+
+    dY = buffer('dY', (m * m, P, FN))
+    np.copyto(dY.reshape(m, m, N, tiles_h, tiles_w, FN).transpose(2, 3, 0, 4, 1, 5), dout.reshape(N, tiles_h, m, tiles_w, m, FN))
+
+    dY1 = buffer('dY1', (n * m, P, FN))
+    Z = buffer('Z', (n * n, P, FN))
+    np.dot(A, dY.reshape(m, -1), out=dY1.reshape(n, -1))
+    np.matmul(A, dY1.reshape(n, m, -1), out=Z.reshape(n, n, -1))
+
+    # 卷积核的梯度
+    dU = np.matmul(V.transpose(0, 2, 1), Z)
+    dW = np.einsum('ij,ilcf,lk->fcjk', G, dU.reshape(n, n, C, FN), G, optimize=True)
+
+    # 输入的梯度，两次GEMM在dV和dD之间来回
+    dV = buffer('dV', (n * n, P, C))
+    dD = buffer('dD', (n * n, P, C))
+    np.matmul(Z, U.transpose(0, 2, 1), out=dV)
+    np.dot(B, dV.reshape(n, -1), out=dD.reshape(n, -1))
+    np.matmul(B, dD.reshape(n, n, -1), out=dV.reshape(n, n, -1))
+
+    dtiles = dV.reshape(n, n, N, tiles_h, tiles_w, C)
+
+    dpadded = buffer('dx', (N, tiles_h * m + n - m, tiles_w * m + n - m, C))
+    dpadded.fill(0)
+
+    for j in range(n):
+        for k in range(n):
+            dpadded[:, j:j + tiles_h * m:m, k:k + tiles_w * m:m, :] += dtiles[j, k]
+
+    return dpadded[:, pad:pad + H, pad:pad + W, :], dW
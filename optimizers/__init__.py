@@ -2,11 +2,45 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+import numpy as np
+
 
 class Optimizer():
-    pass
+    """优化器基类
 
+    update对参数内存池做原地更新，params和grads都是连续的一维数组，
+    grads是整个batch求和后的梯度。所有中间结果和状态都写入预分配的缓存，
+    每一步更新不再分配新的数组。
+    """
 
-from taurus.optimizers.sgd import SGD
+    def __init__(self, learning_rate=0.001, loss='l1'):
+        self.learning_rate = learning_rate
+        self.loss = loss
+
+        # 已经更新的步数
+        self.iterations = 0
+
+        # 与参数同形状的状态和临时缓存
+        self.slots = {}
+
+    def __call__(self, *args, **kwargs):
+        pass
 
+    def update(self, params, grads, batch_size):
+        raise NotImplementedError
 
+    def get_slot(self, name, params):
+        """取出预分配的缓存，第一次使用或参数形状变化时初始化为0"""
+
+        slot = self.slots.get(name)
+        if slot is None or slot.shape != params.shape or slot.dtype != params.dtype:
+            slot = np.zeros_like(params)
+            self.slots[name] = slot
+
+        return slot
+
+
+from taurus.optimizers.sgd import SGD
+from taurus.optimizers.momentum import Momentum, Nesterov
+from taurus.optimizers.rmsprop import RMSProp
+from taurus.optimizers.adam import Adam
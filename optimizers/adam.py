@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from taurus import optimizers
+
+
+class Adam(optimizers.Optimizer):
+
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7, loss='l1'):
+        super(Adam, self).__init__(learning_rate=learning_rate, loss=loss)
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+        self.epsilon = epsilon
+
+    def update(self, params, grads, batch_size):
+        """g为batch平均梯度
+        m = beta_1 * m + (1 - beta_1) * g
+        v = beta_2 * v + (1 - beta_2) * g^2
+        w = w - lr_t * m / (sqrt(v) + epsilon)，lr_t带偏差修正"""
+
+        m = self.get_slot('m', params)
+        v = self.get_slot('v', params)
+        g = self.get_slot('g', params)
+        tmp = self.get_slot('tmp', params)
+
+        self.iterations += 1
+        t = self.iterations
+
+        lr_t = self.learning_rate * float(np.sqrt(1 - self.beta_2 ** t)) / (1 - self.beta_1 ** t)
+
+        np.multiply(grads, 1.0 / batch_size, out=g)
+
+        np.multiply(m, self.beta_1, out=m)
+        np.multiply(g, 1 - self.beta_1, out=tmp)
+        np.add(m, tmp, out=m)
+
+        np.multiply(v, self.beta_2, out=v)
+        np.multiply(g, g, out=tmp)
+        np.multiply(tmp, 1 - self.beta_2, out=tmp)
+        np.add(v, tmp, out=v)
+
+        np.sqrt(v, out=tmp)
+        np.add(tmp, self.epsilon, out=tmp)
+        np.divide(m, tmp, out=tmp)
+        np.multiply(tmp, lr_t, out=tmp)
+        np.subtract(params, tmp, out=params)
+
+        return params
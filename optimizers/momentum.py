@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from taurus import optimizers
+
+
+class Momentum(optimizers.Optimizer):
+
+    def __init__(self, learning_rate=0.001, momentum=0.9, loss='l1'):
+        super(Momentum, self).__init__(learning_rate=learning_rate, loss=loss)
+        self.momentum = momentum
+
+    def update(self, params, grads, batch_size):
+        """v = momentum * v - lr * g
+        w = w + v"""
+
+        velocity = self.get_slot('velocity', params)
+        step = self.get_slot('step', params)
+
+        np.multiply(grads, self.learning_rate / batch_size, out=step)
+
+        np.multiply(velocity, self.momentum, out=velocity)
+        np.subtract(velocity, step, out=velocity)
+        np.add(params, velocity, out=params)
+
+        self.iterations += 1
+
+        return params
+
+
+class Nesterov(Momentum):
+
+    def update(self, params, grads, batch_size):
+        """v = momentum * v - lr * g
+        w = w + momentum * v - lr * g"""
+
+        velocity = self.get_slot('velocity', params)
+        step = self.get_slot('step', params)
+
+        np.multiply(grads, self.learning_rate / batch_size, out=step)
+
+        np.multiply(velocity, self.momentum, out=velocity)
+        np.subtract(velocity, step, out=velocity)
+        np.subtract(params, step, out=params)
+
+        # step复用为momentum * v
+        np.multiply(velocity, self.momentum, out=step)
+        np.add(params, step, out=params)
+
+        self.iterations += 1
+
+        return params
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# Author:Speciallan
+
+import numpy as np
+from taurus import optimizers
+
+
+class RMSProp(optimizers.Optimizer):
+
+    def __init__(self, learning_rate=0.001, rho=0.9, epsilon=1e-7, loss='l1'):
+        super(RMSProp, self).__init__(learning_rate=learning_rate, loss=loss)
+        self.rho = rho
+        self.epsilon = epsilon
+
+    def update(self, params, grads, batch_size):
+        """g为batch平均梯度
+        s = rho * s + (1 - rho) * g^2
+        w = w - lr * g / (sqrt(s) + epsilon)"""
+
+        square = self.get_slot('square', params)
+        g = self.get_slot('g', params)
+        tmp = self.get_slot('tmp', params)
+
+        np.multiply(grads, 1.0 / batch_size, out=g)
+
+        np.multiply(g, g, out=tmp)
+        np.multiply(tmp, 1 - self.rho, out=tmp)
+        np.multiply(square, self.rho, out=square)
+        np.add(square, tmp, out=square)
+
+        np.sqrt(square, out=tmp)
+        np.add(tmp, self.epsilon, out=tmp)
+        np.divide(g, tmp, out=tmp)
+        np.multiply(tmp, self.learning_rate, out=tmp)
+        np.subtract(params, tmp, out=params)
+
+        self.iterations += 1
+
+        return params
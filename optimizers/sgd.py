@@ -2,22 +2,23 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+import numpy as np
 from taurus import optimizers
 
 
 class SGD(optimizers.Optimizer):
 
     def __init__(self, learning_rate=0.001, loss='l1'):
-        self.learning_rate = learning_rate
-        self.loss = loss
+        super(SGD, self).__init__(learning_rate=learning_rate, loss=loss)
 
-    def __call__(self, *args, **kwargs):
-        pass
+    def update(self, params, grads, batch_size):
+        """w = w - lr / batch_size * nw"""
 
-    def optimize(self, weights, biases, nabla_w, nabla_b, batch_size):
+        step = self.get_slot('step', params)
 
-        weights = [w - (self.learning_rate / batch_size) * nw for w, nw in zip(weights, nabla_w)]
-        biases = [b - (self.learning_rate / batch_size) * nb for b, nb in zip(biases, nabla_b)]
+        np.multiply(grads, self.learning_rate / batch_size, out=step)
+        np.subtract(params, step, out=params)
 
-        return weights, biases
+        self.iterations += 1
 
+        return params
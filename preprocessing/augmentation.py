@@ -1,3 +1,49 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
-# Author:Speciallan
\ No newline at end of file
+# Author:Speciallan
+
+import numpy as np
+
+
+class RandomFlip(object):
+    """随机水平翻转，batch格式为NHWC，原地修改"""
+
+    def __init__(self, probability=0.5):
+        self.probability = probability
+
+    def __call__(self, batch, random):
+
+        flip = np.flatnonzero(random.rand(len(batch)) < self.probability)
+        if len(flip) > 0:
+            batch[flip] = batch[flip, :, ::-1, :]
+
+        return batch
+
+
+class RandomShift(object):
+    """随机平移，移出的部分补0，batch格式为NHWC，原地修改
+
+    和padding配合使用相当于随机裁剪
+    """
+
+    def __init__(self, max_shift=2):
+        self.max_shift = max_shift
+
+    def __call__(self, batch, random):
+
+        shifts = random.randint(-self.max_shift, self.max_shift + 1, size=(len(batch), 2))
+
+        for img, (dy, dx) in zip(batch, shifts):
+            if dy == 0 and dx == 0:
+                continue
+            img[...] = np.roll(img, (dy, dx), axis=(0, 1))
+            if dy > 0:
+                img[:dy] = 0
+            elif dy < 0:
+                img[dy:] = 0
+            if dx > 0:
+                img[:, :dx] = 0
+            elif dx < 0:
+                img[:, dx:] = 0
+
+        return batch
@@ -2,15 +2,209 @@
 # -*- coding:utf-8 -*-
 # Author:Speciallan
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from taurus import backend
+from taurus.preprocessing.normalization import normalize
+
 
 class Generator(object):
 
     def __init__(self, x, y):
-        pass
+        self.x = x
+        self.y = y
+
+
+class BatchIterator(Generator):
+    """mini-batch迭代器
+
+    每个epoch通过打乱索引来打乱数据，不移动原始数据。
+    每个batch用np.take按索引直接取到预分配的缓存中，所有batch复用同一块内存，
+    返回的x_batch、y_batch在下一次迭代时会被覆盖。
+
+    drop_last   丢弃最后不足batch_size的batch
+    fixed_shape 最后不足batch_size的batch从本epoch开头补齐，保证每个batch形状一致，
+                后续层可以复用按batch形状分配的工作区
+    """
+
+    def __init__(self, x, y, batch_size, shuffle=True, drop_last=False, fixed_shape=False, seed=None):
+        super(BatchIterator, self).__init__(x, y)
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.fixed_shape = fixed_shape
+
+        self.random = np.random.RandomState(seed)
+        self.index = np.arange(len(x))
+
+        self.x_buffer = np.empty((batch_size,) + x.shape[1:], dtype=x.dtype)
+        self.y_buffer = np.empty((batch_size,) + y.shape[1:], dtype=y.dtype)
+
+    def __len__(self):
+
+        num = len(self.index) // self.batch_size
+        if len(self.index) % self.batch_size != 0 and not self.drop_last:
+            num += 1
+
+        return num
+
+    def __iter__(self):
+
+        if self.shuffle:
+            self.random.shuffle(self.index)
+
+        for start in range(0, len(self.index), self.batch_size):
+
+            index = self.index[start:start + self.batch_size]
+
+            if len(index) < self.batch_size:
+
+                if self.drop_last:
+                    break
+
+                if self.fixed_shape:
+                    index = np.concatenate([index, self.index[:self.batch_size - len(index)]])
+
+            num = len(index)
+
+            # mode='clip'时np.take直接写入out，不经过中间缓存
+            x_batch = np.take(self.x, index, axis=0, out=self.x_buffer[:num], mode='clip')
+            y_batch = np.take(self.y, index, axis=0, out=self.y_buffer[:num], mode='clip')
+
+            yield x_batch, y_batch
 
 
 class ImageGenerator(Generator):
+    """后台预取的图片batch生成器
+
+    工作线程池负责取数据、padding、归一化和数据增强，准备好的batch放进有界队列，
+    和训练步骤形成双缓冲，训练时不需要等待数据准备。numpy的大部分运算会释放GIL，线程即可并行。
 
-    def __init__(self, x, y, batch_size, image_size=(512,512)):
+    x           ndarray，或者配合loader使用的任意序列（例如图片路径）
+    loader      loader(items) -> ndarray，按batch加载原始数据，为空时直接按索引从x中取
+    image_size  输出图片的(H, W)，原图较小时居中补0，为空时保持原尺寸
+    pad         四周额外补0的宽度
+    augmentations 增强操作列表，每个是callable(batch, random)，原地修改NHWC的batch
+    max_queue_size 最多预取的batch数量
+
+    返回的batch在缓存中循环使用，只在下一次迭代前有效。
+    """
+
+    def __init__(self, x, y, batch_size, image_size=None, pad=0, scale=1. / 255, mean=None, std=None,
+                 augmentations=None, loader=None, shuffle=True, workers=2, max_queue_size=2, seed=None):
         super(ImageGenerator, self).__init__(x, y)
 
+        self.batch_size = batch_size
+        self.pad = pad
+        self.scale = scale
+        self.mean = mean
+        self.std = std
+        self.augmentations = augmentations or []
+        self.loader = loader
+        self.shuffle = shuffle
+        self.workers = workers
+        self.max_queue_size = max(max_queue_size, 1)
+
+        self.random = np.random.RandomState(seed)
+        self.index = np.arange(len(x))
+
+        # 用第一个样本确定输出形状
+        sample = self._load(self.index[:1])[0]
+        if image_size is None:
+            image_size = sample.shape[:2]
+        self.image_size = tuple(image_size)
+
+        if len(sample.shape) == 3:
+            h, w = self.image_size
+            if sample.shape[0] > h or sample.shape[1] > w:
+                raise ValueError('图片尺寸{}大于image_size{}'.format(sample.shape[:2], self.image_size))
+            self.output_shape = (h + 2 * pad, w + 2 * pad, sample.shape[2])
+        else:
+            self.output_shape = sample.shape
+
+        # 队列中的batch + 训练正在使用的batch
+        num_buffers = self.max_queue_size + 1
+        self.x_buffers = [np.empty((batch_size,) + self.output_shape, dtype=backend.floatx()) for _ in range(num_buffers)]
+        self.y_buffers = [np.empty((batch_size,) + np.shape(y)[1:], dtype=np.asarray(y[:1]).dtype) for _ in range(num_buffers)]
+
+    def __len__(self):
+        return (len(self.index) + self.batch_size - 1) // self.batch_size
+
+    def _load(self, index):
+
+        if self.loader is not None:
+            return self.loader([self.x[i] for i in index])
+
+        return np.take(self.x, index, axis=0)
+
+    def _prepare(self, index, slot, seed):
+        """在工作线程中准备一个batch，写入第slot块缓存"""
+
+        num = len(index)
+        x_batch = self.x_buffers[slot][:num]
+        y_batch = self.y_buffers[slot][:num]
+
+        images = self._load(index)
+
+        if len(self.output_shape) == 3:
+            # 居中放置，四周补0
+            h, w = images.shape[1:3]
+            top = (self.output_shape[0] - h) // 2
+            left = (self.output_shape[1] - w) // 2
+            if h != self.output_shape[0] or w != self.output_shape[1]:
+                x_batch.fill(0)
+            normalize(images, self.scale, self.mean, self.std, out=x_batch[:, top:top + h, left:left + w, :])
+        else:
+            normalize(images, self.scale, self.mean, self.std, out=x_batch)
+
+        random = np.random.RandomState(seed)
+        for augmentation in self.augmentations:
+            augmentation(x_batch, random)
+
+        np.take(self.y, index, axis=0, out=y_batch, mode='clip')
+
+        return x_batch, y_batch
+
+    def __iter__(self):
+
+        if self.shuffle:
+            self.random.shuffle(self.index)
+
+        starts = iter(range(0, len(self.index), self.batch_size))
+        free = list(range(len(self.x_buffers)))
+        pending = deque()
+        using = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def submit():
+                # 预取到队列满为止
+                while len(pending) < self.max_queue_size and len(free) > 0:
+                    start = next(starts, None)
+                    if start is None:
+                        return
+                    slot = free.pop()
+                    # 随机种子在主线程生成，保证结果与线程调度无关
+                    seed = self.random.randint(2 ** 31)
+                    index = self.index[start:start + self.batch_size]
+                    pending.append((slot, executor.submit(self._prepare, index, slot, seed)))
+
+            submit()
+
+            while len(pending) > 0:
+
+                slot, future = pending.popleft()
+                batch = future.result()
+
+                # 上一个batch训练完，缓存可以复用
+                if using is not None:
+                    free.append(using)
+                using = slot
+
+                submit()
+
+                yield batch
+
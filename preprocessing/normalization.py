@@ -1,3 +1,26 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
-# Author:Speciallan
\ No newline at end of file
+# Author:Speciallan
+
+import numpy as np
+from taurus import backend
+
+
+def normalize(image, scale=1. / 255, mean=None, std=None, out=None):
+    """归一化 (image * scale - mean) / std
+
+    out不为空时结果直接写入out（例如预分配batch缓存中的一块视图），不产生临时数组
+    """
+
+    if out is None:
+        out = np.empty(image.shape, dtype=backend.floatx())
+
+    np.multiply(image, scale, out=out, casting='unsafe')
+
+    if mean is not None:
+        np.subtract(out, mean, out=out, casting='unsafe')
+
+    if std is not None:
+        np.divide(out, std, out=out, casting='unsafe')
+
+    return out
@@ -7,7 +7,8 @@ sys.path.append('..')
 import argparse
 
 import numpy as np
-from taurus.datasets.mnist import load_data
+from taurus.datasets.mnist import load_data, normalize
+from taurus.datasets.stream import ArrayStream
 from taurus.models.mlp import MLP, NewMLP
 from taurus.models.cnn import CNN, NewCNN
 from taurus.models.model import Model
@@ -84,21 +85,14 @@ def new_cnn(args):
     data_path = config.data_path + '/MNIST/'
     model_path = './model_weights_cnn.h5'
 
-    (X_train, y_train), _ = load_data(data_path)
-
-    X_train, X_valid, y_train, y_valid = train_test_split(X_train, y_train, test_size=0.2, random_state=42)
+    # uint8的映射文件，不把整个训练集读入内存
+    (X_train, y_train), _ = load_data(data_path, lazy=True)
 
-    X_train = X_train[:600]
-    y_train = y_train[:600]
-    X_valid = X_valid[:100]
-    y_valid = y_valid[:100]
+    # MLP可以用784 做卷积需要28x28，每个batch读取时reshape并归一化，零填充在第一层卷积中虚拟完成
+    train_stream = ArrayStream(X_train[:600], y_train[:600], batch_size=100, image_shape=(28, 28, 1))
 
-    # MLP可以用784 做卷积需要28x28
-    X_train = np.reshape(X_train, (len(X_train), 28, 28, 1))
-    X_valid = np.reshape(X_valid, (len(X_valid), 28, 28, 1))
-
-    X_train = padding(X_train, 2)  # 对初始图像进行零填充，保证与LeNet输入结构一致60000*32*32*1
-    X_valid = padding(X_valid, 2)
+    X_valid = normalize(X_train[48000:48100]).reshape(-1, 28, 28, 1)
+    y_valid = y_train[48000:48100]
 
     # 3e-5
     optimizer = SGD(learning_rate=3e-5, loss='l1')
@@ -106,8 +100,8 @@ def new_cnn(args):
     model = NewCNN()
     model.set_optimizer(optimizer)
 
-    history = model.train(x=X_train,
-                          y=y_train,
+    history = model.train(x=train_stream,
+                          y=None,
                           batch_size=100,
                           epochs=10,
                           x_valid=X_valid,